@@ -28,9 +28,29 @@ Created on 10/12/2015
 '''
 
 from flask import Flask
+from flask.json import JSONEncoder
+from google.appengine.ext import ndb
+
+from .profiling import ProfilingMiddleware
+
+class CompactJSONEncoder(JSONEncoder):
+    "JSON without whitespace between the tokens"
+    def __init__(self, *args, **kwargs):
+        if kwargs.get('separators') is None:
+            kwargs['separators'] = (',', ':')
+        super(CompactJSONEncoder, self).__init__(*args, **kwargs)
 
 app = Flask(__name__)
 app.debug = True
+app.json_encoder = CompactJSONEncoder
+# jsonify would indent (even outside debug) and sort the keys, which also
+# disables the C speedups of the json module
+app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+app.config['JSON_SORT_KEYS'] = False
+# wait for the async writes (e.g. audit events) started by a request
+app.wsgi_app = ndb.toplevel(app.wsgi_app)
+# outermost, so the profile includes the RPCs waited by toplevel
+app.wsgi_app = ProfilingMiddleware(app.wsgi_app, app.url_map)
 
 __all__ = ['app']
 
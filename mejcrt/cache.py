@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Iuri Gomes Diniz
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Created on 18/10/2026
+
+@author: Iuri Diniz <iuridiniz@gmail.com>
+'''
+
+import hashlib
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+COUNT_EXACT = 'exact'
+COUNT_APPROX = 'approx'
+COUNT_NONE = 'none'
+
+count_strategies = (COUNT_EXACT, COUNT_APPROX, COUNT_NONE)
+
+# approx counts stop scanning the index after this many results
+APPROX_LIMIT = 1000
+
+GENERATION_KEY = 'generation.%s'
+COUNT_KEY = 'count.%s.%s.%s'
+ENTITY_VERSION_KEY = 'version.%s'
+ENTITY_VERSION_TIME = 24 * 3600
+# longer than a request that read an entity before it was deleted
+FORGET_LOCK_TIME = 60
+PAYLOAD_KEY = 'payload.%s.%s'
+PAYLOAD_TIME = 3600
+STATS_KEY = 'stats.entity.%s.%s'
+AUTHZ_KEY = 'authz.%s'
+# global queries are eventually consistent, the results of one run shortly
+# after a write may still miss it (see settling)
+SETTLE_KEY = 'settle.%s'
+SETTLE_TIME = 30
+AUTHZ_TIME = 600
+# rejected users are asked again sooner (but an update still invalidates them)
+AUTHZ_NEGATIVE_TIME = 60
+
+_cache = memcache.Client()
+
+def _new_generation():
+    # never reuse a generation that could still have cached entries
+    return int(time.time() * 1000)
+
+@ndb.tasklet
+def get_generation_async(kind):
+    key = GENERATION_KEY % kind
+    ctx = ndb.get_context()
+    generation = yield ctx.memcache_get(key)
+    if generation is None:
+        yield ctx.memcache_add(key, _new_generation())
+        generation = yield ctx.memcache_get(key)
+    raise ndb.Return(generation)
+
+def get_generation(kind):
+    "return the write generation of kind, it changes on every write"
+    return get_generation_async(kind).get_result()
+
+def bump_generation(kind, settle=False):
+    """invalidate everything cached for kind, with settle also mark its
+    queries as settling for a while"""
+    key = GENERATION_KEY % kind
+    if _cache.incr(key) is None:
+        _cache.set(key, _new_generation())
+    if settle:
+        _cache.set(SETTLE_KEY % kind, True, time=SETTLE_TIME)
+
+def settling(kind):
+    "True shortly after a write on kind, a query on it may not see it yet"
+    return _cache.get(SETTLE_KEY % kind) is not None
+
+def timeline_scope(patient_key):
+    "the generation (as the one of a kind) of the transfusions of a patient"
+    return 'Patient.timeline.%s' % patient_key.urlsafe()
+
+def authz_scope(userid):
+    "the generation (as the one of a kind) of the authorization of a user"
+    return 'UserPrefs.authz.%s' % userid
+
+def get_authz(userid):
+    """Return (generation, decision) of the user with a single memcache round
+    trip, decision is the cached (authorized, admin) or None.
+
+    A decision is only valid for the generation it was made at, see set_authz.
+    """
+    keys = [GENERATION_KEY % authz_scope(userid), AUTHZ_KEY % userid]
+    found = _cache.get_multi(keys)
+    generation = found.get(keys[0])
+    if generation is None:
+        generation = get_generation(authz_scope(userid))
+    cached = found.get(keys[1])
+    if cached is not None and cached[0] == generation:
+        return generation, cached[1]
+    return generation, None
+
+def set_authz(userid, generation, decision):
+    "cache decision, read from the datastore after generation (see get_authz)"
+    authorized, _ = decision
+    _cache.set(AUTHZ_KEY % userid, (generation, decision),
+               time=AUTHZ_TIME if authorized else AUTHZ_NEGATIVE_TIME)
+
+def get_generations(kinds):
+    "return a dict {kind: generation} with a single memcache round trip"
+    keys = dict((GENERATION_KEY % kind, kind) for kind in kinds)
+    found = _cache.get_multi(keys.keys())
+    ret = dict((keys[key], generation) for key, generation in found.iteritems())
+    for kind in set(kinds) - set(ret):
+        ret[kind] = get_generation(kind)
+    return ret
+
+def etag(*parts):
+    return hashlib.md5(repr(parts)).hexdigest()
+
+def list_etag(kinds, *parts):
+    """ETag of a list of kinds, it changes on every write on any of them.
+
+    None while any kind is settling (see bump_generation): its queries may
+    not see the last write yet, and a list tagged now would stay valid
+    after they do.
+    """
+    if _cache.get_multi([SETTLE_KEY % kind for kind in kinds]):
+        return None
+    generations = get_generations(kinds)
+    return etag(sorted(generations.items()), *parts)
+
+def entity_etag(key, kinds=()):
+    """ETag of the entity with key, from memcache only.
+
+    Return None if the entity version (see set_entity_version) or any
+    generation of kinds, the kinds it embeds, is not cached.
+    """
+    return entity_etags([key], kinds)[key]
+
+def entity_etags(keys, kinds=()):
+    "entity_etag of each key, a dict {key: etag or None}, in a single round trip"
+    generation_keys = [GENERATION_KEY % kind for kind in sorted(kinds)]
+    version_keys = dict((key, ENTITY_VERSION_KEY % key.urlsafe()) for key in keys)
+    found = _cache.get_multi(generation_keys + version_keys.values())
+    if any(k not in found for k in generation_keys):
+        return dict.fromkeys(keys)
+    generations = [found[k] for k in generation_keys]
+    return dict((key, etag(found[k], *generations) if k in found else None)
+                for key, k in version_keys.iteritems())
+
+def remember_entity_version(key, version, kinds=()):
+    "cache the version read from the datastore, return the entity ETag"
+    return remember_entity_versions({key: version}, kinds)[key]
+
+def remember_entity_versions(versions, kinds=()):
+    "remember_entity_version of each {key: version}, return {key: etag}"
+    _cache.add_multi(dict((ENTITY_VERSION_KEY % key.urlsafe(), version)
+                          for key, version in versions.iteritems()),
+                     time=ENTITY_VERSION_TIME)
+    generations = get_generations(kinds)
+    generations = [generations[kind] for kind in sorted(kinds)]
+    return dict((key, etag(version, *generations)) for key, version in versions.iteritems())
+
+def set_entity_version(key, version):
+    "called when an entity is written, after the commit"
+    _cache.set(ENTITY_VERSION_KEY % key.urlsafe(), version, time=ENTITY_VERSION_TIME)
+
+def forget_entity_version(key):
+    "called when an entity is deleted, after the commit"
+    # a reader that got the entity before the delete must not add its version
+    # back (see remember_entity_versions): memcache refuses adds meanwhile
+    _cache.delete(ENTITY_VERSION_KEY % key.urlsafe(), seconds=FORGET_LOCK_TIME)
+
+def get_payload(key, etag):
+    "the serialized entity with key at the version of etag, or None"
+    return _cache.get(PAYLOAD_KEY % (key.urlsafe(), etag))
+
+def get_payloads(etags):
+    "get_payload of each {key: etag}, return {key: payload} of those cached"
+    names = dict((PAYLOAD_KEY % (key.urlsafe(), etag), key)
+                 for key, etag in etags.iteritems())
+    return dict((names[name], payload)
+                for name, payload in _cache.get_multi(names.keys()).iteritems())
+
+def set_payload(key, etag, payload):
+    # keys are versioned, a new version never reads an old payload
+    _cache.set(PAYLOAD_KEY % (key.urlsafe(), etag), payload, time=PAYLOAD_TIME)
+
+def set_payloads(payloads):
+    "set_payload of each {key: (etag, payload)}"
+    _cache.set_multi(dict((PAYLOAD_KEY % (key.urlsafe(), etag), payload)
+                          for key, (etag, payload) in payloads.iteritems()),
+                     time=PAYLOAD_TIME)
+
+def count_access(kind, hit, n=1):
+    "update the hit/miss metrics of the entity cache (it does not wait)"
+    name = 'hits' if hit else 'misses'
+    return ndb.get_context().memcache_incr(STATS_KEY % (kind, name), delta=n,
+                                           initial_value=0)
+
+def get_access_stats(kinds):
+    "return a dict {kind: {hits, misses}} of the entity cache"
+    keys = [STATS_KEY % (kind, name) for kind in kinds for name in ('hits', 'misses')]
+    found = _cache.get_multi(keys)
+    return dict((kind, dict((name, int(found.get(STATS_KEY % (kind, name), 0)))
+                            for name in ('hits', 'misses')))
+                for kind in kinds)
+
+def query_signature(query):
+    "normalized signature of the result set of query (orders are ignored)"
+    return hashlib.md5(repr(query.filters)).hexdigest()
+
+@ndb.tasklet
+def count_query_async(query, strategy=COUNT_APPROX):
+    if strategy == COUNT_NONE:
+        raise ndb.Return((None, False))
+
+    ctx = ndb.get_context()
+    generation, settle = yield (get_generation_async(query.kind),
+                                ctx.memcache_get(SETTLE_KEY % query.kind))
+    key = COUNT_KEY % (query.kind, generation, query_signature(query))
+    cached = yield ctx.memcache_get(key)
+    if cached is not None:
+        count, exact = cached
+        if exact or strategy == COUNT_APPROX:
+            raise ndb.Return((count, exact))
+
+    if strategy == COUNT_EXACT:
+        count = yield query.count_async()
+        exact = True
+    else:
+        count = yield query.count_async(limit=APPROX_LIMIT + 1)
+        exact = count <= APPROX_LIMIT
+        count = min(count, APPROX_LIMIT)
+
+    # a just written entity may still be missing from the count
+    if settle is None:
+        yield ctx.memcache_set(key, (count, exact), time=3600)
+    raise ndb.Return((count, exact))
+
+def count_query(query, strategy=COUNT_APPROX):
+    """Count the results of query, return a tuple (count, exact).
+
+    If exact is False, count is a lower bound ("at least count"). Counts are
+    cached per query signature until the next write on the query kind, but
+    not while its queries are settling.
+    """
+    return count_query_async(query, strategy).get_result()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Iuri Gomes Diniz
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Created on 18/10/2026
+
+@author: Iuri Diniz <iuridiniz@gmail.com>
+'''
+
+import functools
+import logging
+import time
+
+from flask import request
+from flask.helpers import make_response, url_for
+from flask.json import jsonify
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
+
+from mejcrt import profiling, rebuild
+from mejcrt.cache import get_access_stats
+from mejcrt.controllers.decorators import require_admin
+from mejcrt.controllers.patient import str2bool
+from mejcrt.models import AggregatesLocked, Patient
+
+from ..app import app
+
+# a task request lasts at most 10 minutes, a shard is resumed by a new task
+TASK_DEADLINE = 8 * 60
+
+def require_task(fn):
+    "only App Engine task queue requests (it strips this header from others)"
+    @functools.wraps(fn)
+    def handler(*args, **kwargs):
+        if 'X-AppEngine-QueueName' not in request.headers:
+            return make_response(jsonify(code="Forbidden"), 403, {})
+        return fn(*args, **kwargs)
+    return handler
+
+@app.errorhandler(AggregatesLocked)
+def aggregates_locked(e):
+    "a write while a rebuild job replaces the aggregates, or a second job"
+    logging.warning("Aggregates locked: %r" % e)
+    return make_response(jsonify(code="Service Unavailable"), 503,
+                         {'Retry-After': str(AggregatesLocked.RETRY_AFTER)})
+
+def _enqueue_shard(shard_key):
+    taskqueue.add(url=url_for('admin.rebuild.shard'),
+                  params=dict(shard=shard_key.urlsafe()))
+
+@app.route("/api/v1/admin/cache/stats", methods=['GET'], endpoint="admin.cache.stats")
+@require_admin()
+def cache_stats():
+    stats = get_access_stats(['Patient', 'Transfusion'])
+    return make_response(jsonify(code="OK", data=dict(entity=stats)), 200, {})
+
+@app.route("/api/v1/admin/profile", methods=['GET'], endpoint="admin.profile")
+@require_admin()
+def profile_ranking():
+    limit = int(request.args.get('max', 20))
+    data = profiling.ranking()[:max(1, limit)]
+    return make_response(jsonify(code="OK", data=data), 200, {})
+
+@app.route("/api/v1/admin/profile", methods=['DELETE'], endpoint="admin.profile.reset")
+@require_admin()
+def profile_reset():
+    profiling.reset()
+    return make_response(jsonify(code="OK"), 200, {})
+
+@app.route("/api/v1/admin/rebuild", methods=['POST'], endpoint="admin.rebuild")
+@require_admin()
+def rebuild_start():
+    shards = int(request.args.get('shards', rebuild.DEFAULT_SHARDS))
+    backfill = str2bool(request.args.get('backfill', None)) or False
+    aggregate = str2bool(request.args.get('aggregate', None))
+    try:
+        # raises AggregatesLocked (503) while another job counts
+        job = rebuild.start(shards=max(1, min(shards, 16)), backfill=backfill,
+                            aggregate=aggregate is not False)
+    except ValueError as e:
+        logging.error("Cannot start a rebuild: %r" % e)
+        return make_response(jsonify(code="Bad Request"), 400, {})
+    for key in job.shards:
+        _enqueue_shard(key)
+    return make_response(jsonify(code="OK", data=job.report()), 200, {})
+
+@app.route("/api/v1/admin/rebuild/<int:job>", methods=['GET'],
+           endpoint="admin.rebuild.get")
+@require_admin()
+def rebuild_get(job):
+    job = rebuild.RebuildJob.get_by_id(job)
+    if job is None:
+        return make_response(jsonify(code="Not Found"), 404, {})
+    return make_response(jsonify(code="OK", data=job.report()), 200, {})
+
+@app.route("/api/v1/admin/rebuild/<int:job>", methods=['DELETE'],
+           endpoint="admin.rebuild.abort")
+@require_admin()
+def rebuild_abort(job):
+    job_key = ndb.Key(rebuild.RebuildJob, job)
+    if not rebuild.abort(job_key):
+        return make_response(jsonify(code="Not Found"), 404, {})
+    return make_response(jsonify(code="OK", data=job_key.get().report()), 200, {})
+
+@app.route("/api/v1/admin/rebuild/shard", methods=['POST'],
+           endpoint="admin.rebuild.shard")
+@require_task
+def rebuild_shard():
+    try:
+        shard_key = ndb.Key(urlsafe=request.form['shard'])
+    except (KeyError, TypeError, ProtocolBufferDecodeError) as e:
+        logging.error("Invalid rebuild shard: %r" % e)
+        # do not retry
+        return make_response(jsonify(code="Bad Request"), 200, {})
+
+    shard = rebuild.process_shard_async(
+        shard_key, deadline=time.time() + TASK_DEADLINE).get_result()
+    # None: the job was aborted
+    if shard is not None and not shard.done:
+        _enqueue_shard(shard_key)
+    elif shard is not None:
+        rebuild.finish(shard.job)
+    return make_response(jsonify(code="OK"), 200, {})
+
+@app.route(Patient.SYNC_URL, methods=['POST'], endpoint="admin.patient.sync")
+@require_task
+def patient_sync():
+    try:
+        patient_key = ndb.Key(urlsafe=request.form['patient'])
+    except (KeyError, TypeError, ProtocolBufferDecodeError) as e:
+        logging.error("Invalid patient to sync: %r" % e)
+        # do not retry
+        return make_response(jsonify(code="Bad Request"), 200, {})
+
+    patient = patient_key.get()
+    cursor = request.form.get('cursor', None) or None
+    deadline = time.time() + TASK_DEADLINE
+    # a failed batch fails the task, it is retried from its cursor
+    while patient is not None:
+        _, cursor = patient.sync_transfusions(cursor)
+        if cursor is None:
+            break
+        if time.time() >= deadline:
+            patient.enqueue_sync(cursor)
+            break
+    return make_response(jsonify(code="OK"), 200, {})
@@ -28,12 +28,44 @@ Created on 10/12/2015
 
 import functools
 
+from flask.globals import request
 from flask.helpers import make_response
 from flask.json import jsonify
 
 from mejcrt.models import UserPrefs
 
 
+_CURRENT_USER = 'mejcrt.current_user'
+_CURRENT_AUTHZ = 'mejcrt.current_authz'
+
+def get_current_user():
+    "return the UserPrefs of the logged user, it is resolved once per request"
+    if _CURRENT_USER not in request.environ:
+        request.environ[_CURRENT_USER] = UserPrefs.get_current()
+    return request.environ[_CURRENT_USER]
+
+def get_current_authz():
+    "return (authorized, admin) of the logged user or None, from the authorization cache"
+    if _CURRENT_AUTHZ not in request.environ:
+        request.environ[_CURRENT_AUTHZ] = UserPrefs.get_current_authz()
+    return request.environ[_CURRENT_AUTHZ]
+
+# the enums only change with a deploy
+ENUM_MAX_AGE = 24 * 3600
+
+def cache_control(max_age):
+    "let the browser (only, the responses are private) reuse a 200 for max_age seconds"
+    def decorate(fn):
+        @functools.wraps(fn)
+        def handler(*args, **kwargs):
+            response = fn(*args, **kwargs)
+            if response.status_code == 200:
+                response.cache_control.private = True
+                response.cache_control.max_age = max_age
+            return response
+        return handler
+    return decorate
+
 def require_admin():
     return _require_login(require_admin=True)
 
@@ -44,14 +76,16 @@ def _require_login(require_admin=False):
     def decorate(fn):
         @functools.wraps(fn)
         def handler(*args, **kwargs):
-            user = UserPrefs.get_current()
-            if user is None:
+            # the handler reads the user only if it needs it
+            authz = get_current_authz()
+            if authz is None:
                 return make_response(jsonify(code="Unauthorized"), 401, {})
+            authorized, admin = authz
 
-            if user.authorized is False:
+            if authorized is False:
                 return make_response(jsonify(code="Forbidden"), 403, {})
 
-            if require_admin and not user.admin:
+            if require_admin and not admin:
                 return make_response(jsonify(code="Forbidden"), 403, {})
 
             return fn(*args, **kwargs)
@@ -28,20 +28,26 @@ Created on 10/12/2015
 
 import logging
 
-from flask import request
+from flask import json, request
 from flask.helpers import make_response, url_for
 from flask.json import jsonify
-from google.appengine.api.datastore_errors import BadValueError
+from google.appengine.api.datastore_errors import BadValueError, NeedIndexError
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
 
+from mejcrt.cache import count_query_async, count_strategies, COUNT_EXACT, \
+    COUNT_NONE, entity_etag, list_etag, remember_entity_version, get_payload, \
+    set_payload, count_access, timeline_scope, entity_etags, get_payloads, \
+    remember_entity_versions, set_payloads
 from mejcrt.controllers.decorators import require_admin
-from mejcrt.models import UserPrefs, patient_types
+from mejcrt.models import patient_types
 from mejcrt.util import onlynumbers
 
 from ..app import app
-from ..models import Patient, LogEntry
-from .decorators import require_login
+from ..models import Model, Patient, AuditEvent, Transfusion
+from .decorators import require_login, get_current_user, cache_control, \
+    ENUM_MAX_AGE
 
 def str2bool(f):
     if f == '1' or f == 'true':
@@ -73,29 +79,247 @@ def generic_delete(key, class_):
     o = _get_object(key)
     if o and isinstance(o, class_):
         o.delete()
+        AuditEvent.record_async([o.key], get_current_user(), 'delete')
         return make_response(jsonify(data={}, code='OK'), 200, {})
     return make_response(jsonify(code="Not Found"), 404, {})
 
+def not_modified(etag):
+    "a 304 response if the client already has etag, else None"
+    if etag is not None and etag in request.if_none_match:
+        response = make_response('', 304, {})
+        response.set_etag(etag)
+        return response
+    return None
+
 def generic_get(key, class_):
-    o = _get_object(key)
-    if o and isinstance(o, class_):
-        return make_response(jsonify(data=[o.to_dict()], code='OK'), 200, {})
-    return make_response(jsonify(code="Not Found"), 404, {})
+    """Answer a request for the object with key.
 
-def make_response_list_paginator(max_, offset, dbquery, total, endpoint, **extra):
-    if offset < 0:
-        offset = 0
+    The serialized object is cached in memcache by key and ETag, so a hit
+    costs two memcache calls and no datastore access.
+    """
+    try:
+        entity_key = ndb.Key(urlsafe=key)
+    except (TypeError, ProtocolBufferDecodeError) as e:
+        logging.error("Error while decoding key %r: %r" % (key, e))
+        return make_response(jsonify(code="Not Found"), 404, {})
+    kind = class_._get_kind()
+    if entity_key.kind() != kind:
+        return make_response(jsonify(code="Not Found"), 404, {})
+
+    depends = class_.__etag_depends__ or ()
+    etag = entity_etag(entity_key, depends)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    payload = get_payload(entity_key, etag) if etag else None
+    count_access(kind, payload is not None)
+    if payload is None:
+        o = entity_key.get()
+        if o is None:
+            return make_response(jsonify(code="Not Found"), 404, {})
+        payload = o.to_dict()
+        etag = remember_entity_version(o.key, o.etag_version(), depends)
+        set_payload(o.key, etag, payload)
+
+    response = make_response(jsonify(data=[payload], code='OK'), 200, {})
+    response.set_etag(etag)
+    return response
+
+def generic_get_multi(kinds, get_multi):
+    """Answer a list request with an ETag built from the generations of kinds.
+
+    The ETag is checked before get_multi runs any query, there is none while
+    a kind is settling.
+    """
+    etag = list_etag(kinds, request.full_path)
+    response = not_modified(etag)
+    if response is None:
+        response = get_multi()
+        if response.status_code == 200 and etag is not None:
+            response.set_etag(etag)
+    return response
+
+MAX_BATCH_GET = 300
+
+def generic_batch_get(class_):
+    """Answer a request for many objects of class_ by key.
+
+    The body is {"keys": [urlsafe keys]}, the response has one result per
+    key, in the same order: the object or a marker of a key not found (or
+    invalid). Payloads come from the entity cache, the others from a single
+    get_multi.
+    """
+    body = request.get_json(silent=True)
+    keys = body.get('keys', None) if isinstance(body, dict) else None
+    if not isinstance(keys, list) or len(keys) > MAX_BATCH_GET:
+        logging.error("Cannot batch get %s: %r" % (class_.__name__, 'invalid keys'))
+        return make_response(jsonify(code="Bad Request"), 400, {})
 
-    if max_ > 50:
-        max_ = 50
-    if max_ < 0:
-        max_ = 0
+    kind = class_._get_kind()
+    decoded = []
+    for urlsafe in keys:
+        key = None
+        if isinstance(urlsafe, basestring):
+            try:
+                key = ndb.Key(urlsafe=urlsafe)
+            except (TypeError, ProtocolBufferDecodeError) as e:
+                logging.error("Error while decoding key %r: %r" % (urlsafe, e))
+        if key is not None and key.kind() != kind:
+            key = None
+        decoded.append(key)
+
+    wanted = list(set(key for key in decoded if key is not None))
+    depends = class_.__etag_depends__
+    payloads = {}
+    if depends is not None:
+        etags = entity_etags(wanted, depends)
+        payloads = get_payloads(dict((key, etag) for key, etag in etags.iteritems() if etag))
+        for hit, n in ((True, len(payloads)), (False, len(wanted) - len(payloads))):
+            if n:
+                count_access(kind, hit, n)
+
+    objs = [o for o in ndb.get_multi([key for key in wanted if key not in payloads])
+            if o is not None]
+    for o, payload in zip(objs, Model.to_dict_multi(objs)):
+        payloads[o.key] = payload
+    if objs and depends is not None:
+        etags = remember_entity_versions(dict((o.key, o.etag_version()) for o in objs), depends)
+        set_payloads(dict((o.key, (etags[o.key], payloads[o.key])) for o in objs))
+
+    results = []
+    for urlsafe, key in zip(keys, decoded):
+        if key is None:
+            results.append(dict(key=urlsafe, code='Bad Request'))
+        elif key not in payloads:
+            results.append(dict(key=urlsafe, code='Not Found'))
+        else:
+            results.append(dict(key=urlsafe, code='OK', data=payloads[key]))
+    found = len([r for r in results if r['code'] == 'OK'])
+
+    return make_response(jsonify(code="OK", data=dict(found=found,
+                                                      missing=len(results) - found,
+                                                      results=results)), 200, {})
+
+def generic_history(key, class_, endpoint):
+    "paginated changes of the object (even a deleted one) with key"
+    try:
+        entity_key = ndb.Key(urlsafe=key)
+    except (TypeError, ProtocolBufferDecodeError) as e:
+        logging.error("Error while decoding key %r: %r" % (key, e))
+        return make_response(jsonify(code="Not Found"), 404, {})
+    if entity_key.kind() != class_._get_kind():
+        return make_response(jsonify(code="Not Found"), 404, {})
+
+    query = AuditEvent.build_query(entity_key)
+    return make_response_list_paginator(max_=int(request.args.get("max", '20')),
+                                        offset=int(request.args.get('offset', '0')),
+                                        cursor=request.args.get('cursor', None) or None,
+                                        count_strategy=request.args.get('count', COUNT_EXACT),
+                                        dbquery=query,
+                                        total=None,
+                                        endpoint=endpoint,
+                                        key=key)
+
+MAX_IMPORT = 1000
+IMPORT_BATCH = 100
+
+def parse_records():
+    "return the records of a request body with a JSON array or JSON Lines"
+    body = request.get_data()
+    if body.lstrip().startswith('['):
+        return json.loads(body)
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+def generic_import(class_, build):
+    """Create objects of class_ from the records of the request, in batches.
+
+    build(record) must return a new object or raise BadValueError, the
+    response has one result per record, in the same order.
+    """
+    try:
+        records = parse_records()
+    except ValueError as e:
+        logging.error("Cannot import %s: %r" % (class_.__name__, e))
+        return make_response(jsonify(code="Bad Request"), 400, {})
 
-    objs = []
-    count = 0
+    if not isinstance(records, list) or len(records) > MAX_IMPORT:
+        logging.error("Cannot import %s: %r" % (class_.__name__, 'too many records'))
+        return make_response(jsonify(code="Bad Request"), 400, {})
+
+    results = [None] * len(records)
+    batch = []
+    user = get_current_user()
+
+    def flush():
+        created = class_.put_new_multi([o for _, o in batch])
+        for (n, _), r in zip(batch, created):
+            results[n] = r
+        AuditEvent.record_async([r for r in created if isinstance(r, ndb.Key)],
+                                user, 'create')
+        del batch[:]
+
+    for n, record in enumerate(records):
+        try:
+            if not isinstance(record, dict):
+                raise BadValueError("Record %r is not an object" % record)
+            o = build(record)
+            o._check_initialized()
+        except (BadValueError, ValueError) as e:
+            results[n] = e
+            continue
+        batch.append((n, o))
+        if len(batch) >= IMPORT_BATCH:
+            flush()
+    flush()
+
+    report = []
+    for n, r in enumerate(results):
+        if isinstance(r, ndb.Key):
+            report.append(dict(index=n, code='OK', key=r.urlsafe()))
+        else:
+            report.append(dict(index=n, code='Bad Request', error=str(r)))
+    created = len([r for r in report if r['code'] == 'OK'])
+
+    return make_response(jsonify(code="OK", data=dict(created=created,
+                                                      failed=len(report) - created,
+                                                      results=report)), 200, {})
+
+CURSOR_NEXT = 'n'
+CURSOR_PREV = 'p'
+
+def encode_cursor(direction, cursor):
+    "build an opaque token from a direction and a forward cursor"
+    return '%s.%s' % (direction, cursor.urlsafe())
+
+def decode_cursor(token):
+    "return a tuple (direction, cursor) from a token built by encode_cursor"
+    direction, _, urlsafe = str(token).partition('.')
+    if direction not in (CURSOR_NEXT, CURSOR_PREV) or not urlsafe:
+        raise BadValueError("Invalid cursor %r" % token)
+    return direction, Cursor(urlsafe=urlsafe)
+
+def reverse_query(query):
+    "return a copy of query (that must be ordered) with all orders reversed"
+    return ndb.Query(kind=query.kind,
+                     ancestor=query.ancestor,
+                     filters=query.filters,
+                     orders=query.orders.reversed(),
+                     app=query.app,
+                     namespace=query.namespace,
+                     default_options=query.default_options,
+                     projection=query.projection,
+                     group_by=query.group_by)
+
+@ndb.tasklet
+def _fetch_page_offset(dbquery, max_, offset, extra, **options):
+    # legacy mode: datastore still reads and skips ``offset`` entities, but
+    # only for this page, the next one starts from its cursor
+    model = ndb.Model._lookup_model(dbquery.kind)
+    objs, end = [], None
     if max_:
-        count = dbquery.count()
-        objs = dbquery.fetch(limit=max_, offset=offset)
+        objs, end, _ = yield dbquery.order(model.key).fetch_page_async(
+            max_, offset=offset, **options)
 
     query_next = extra.copy()
     query_next.update({'max': max_,
@@ -103,6 +327,8 @@ def make_response_list_paginator(max_, offset, dbquery, total, endpoint, **extra
     length = len(objs)
     if length < max_:
         query_next['offset'] = length + offset
+    if end is not None:
+        query_next['cursor'] = encode_cursor(CURSOR_NEXT, end)
 
     query_prev = extra.copy()
     query_prev.update({'max': max_,
@@ -112,19 +338,142 @@ def make_response_list_paginator(max_, offset, dbquery, total, endpoint, **extra
         query_prev['offset'] = 0
         query_prev['max'] = offset
 
+    raise ndb.Return((objs, offset, query_next, query_prev))
+
+@ndb.tasklet
+def _fetch_page_cursor(dbquery, max_, offset, token, extra, **options):
+    # cursor mode: ``offset`` is only the logical position of the page
+    model = ndb.Model._lookup_model(dbquery.kind)
+    query = dbquery.order(model.key)
+
+    direction, start = CURSOR_NEXT, None
+    if token:
+        direction, start = decode_cursor(token)
+
+    objs = []
+    first, last = start, start
+    if max_ and direction == CURSOR_NEXT:
+        objs, end, _ = yield query.fetch_page_async(max_, start_cursor=start, **options)
+        last = end or start
+    elif max_:
+        # walk backwards from the start of the current page, the indexes of
+        # the projections (see Model.PROJECTION_INDEXES) only walk forward
+        options.pop('projection', None)
+        objs, end, more = yield reverse_query(query).fetch_page_async(
+            max_, start_cursor=start.reversed(), **options)
+        objs.reverse()
+        first = end.reversed() if end else start
+        if not more:
+            # reached the first page
+            first = None
+            offset = 0
+
+    query_next = extra.copy()
+    query_next.update({'max': max_,
+                       'offset': offset + len(objs)})
+    if last is not None:
+        query_next['cursor'] = encode_cursor(CURSOR_NEXT, last)
+
+    query_prev = extra.copy()
+    query_prev.update({'max': max_,
+                       'offset': max(offset - max_, 0)})
+    if first is not None:
+        query_prev['cursor'] = encode_cursor(CURSOR_PREV, first)
+
+    raise ndb.Return((objs, offset, query_next, query_prev))
+
+def _fetch_page(dbquery, max_, offset, cursor, extra, **options):
+    if cursor is None and offset > 0:
+        return _fetch_page_offset(dbquery, max_, offset, extra, **options)
+    return _fetch_page_cursor(dbquery, max_, offset, cursor, extra, **options)
+
+@ndb.tasklet
+def _fetch_page_async(dbquery, max_, offset, cursor, extra, only=None, projection=None):
+    """fetch a page and serialize it, return (data, offset, query_next, query_prev)
+
+    only and projection come from select_fields and select_projection.
+    """
+    try:
+        page = yield _fetch_page(dbquery, max_, offset, cursor, extra,
+                                 **(dict(projection=projection) if projection else {}))
+    except NeedIndexError as e:
+        if not projection:
+            raise
+        # a declared index may still be building, whole entities are trimmed
+        logging.warning("No index to project %r on %r: %r" % (projection, dbquery, e))
+        page = yield _fetch_page(dbquery, max_, offset, cursor, extra)
+    objs, offset, query_next, query_prev = page
+    data = yield Model.to_dict_multi_async(objs, only)
+    raise ndb.Return((data, offset, query_next, query_prev))
+
+def _result(value):
+    "value itself or, if it is a future, its result"
+    if isinstance(value, ndb.Future):
+        return value.get_result()
+    return value
+
+def make_response_list_paginator(max_, offset, dbquery, total, endpoint,
+                                  cursor=None, count_strategy=COUNT_EXACT,
+                                  select=None, **extra):
+    """Answer a page of dbquery.
+
+    select is a comma separated list of the fields of each object (the key is
+    always there), the others are not serialized and, when possible, not even
+    read (see Model.select_projection).
+    """
+    if count_strategy not in count_strategies:
+        logging.error("Invalid count strategy %r" % count_strategy)
+        return make_response(jsonify(code="Bad Request"), 400, {})
+
+    only = projection = None
+    if select:
+        model = ndb.Model._lookup_model(dbquery.kind)
+        try:
+            only = model.select_fields(parse_fields(select))
+        except BadValueError as e:
+            logging.error("Invalid select %r: %r" % (select, e))
+            return make_response(jsonify(code="Bad Request"), 400, {})
+        projection = model.select_projection(only, dbquery)
+        extra['select'] = select
+
+    if offset < 0:
+        offset = 0
+
+    if max_ > 50:
+        max_ = 50
+    if max_ < 0:
+        max_ = 0
+
+    # page (with its referenced entities), count and total run concurrently,
+    # total may be a future started by the caller
+    page = _fetch_page_async(dbquery, max_, offset, cursor, extra, only, projection)
+    count = count_query_async(dbquery, count_strategy if max_ else COUNT_NONE)
+
+    try:
+        data, offset, query_next, query_prev = page.get_result()
+    except BadValueError as e:
+        logging.error("Invalid cursor %r: %r" % (cursor, e))
+        return make_response(jsonify(code="Bad Request"), 400, {})
+
+    query_next['count'] = query_prev['count'] = count_strategy
+    count, count_exact = count.get_result()
+    if not max_:
+        count, count_exact = 0, True
+
     next_ = url_for(endpoint, **query_next)
     prev = url_for(endpoint, **query_prev)
 
 
     ret = extra.copy()
-    ret.update(dict(data=[p.to_dict() for p in objs],
+    ret.update(dict(data=data,
                     code='OK',
-                    total=total,
+                    total=_result(total),
                     next=next_,
                     prev=prev,
                     offset=offset,
                     max=max_,
-                    count=count))
+                    count=count,
+                    count_exact=count_exact))
 
     return make_response(jsonify(ret), 200, {})
 
@@ -136,6 +485,33 @@ def stats():
     return make_response(
          jsonify(code="OK", data={'stats': stats}), 200, {})
 
+def _populate(patient, data, is_new):
+    patient.touch(get_current_user())
+
+    name = data.get('name', None)
+
+    type_ = data.get('type', '')
+    blood_type = data.get('blood_type', None)
+    patient.populate(name=name, type_=type_, blood_type=blood_type)
+
+def _build(record):
+    code = onlynumbers(record.get('code', 0))
+    if not code or int(code) == 0:
+        raise BadValueError("Invalid code %r" % record.get('code'))
+    patient = Patient(id=code)
+    _populate(patient, record, is_new=True)
+    return patient
+
+@app.route("/api/v1/patient/batch-get", methods=['POST'], endpoint="patient.batch.get")
+@require_login()
+def batch_get():
+    return generic_batch_get(Patient)
+
+@app.route("/api/v1/patient/import", methods=['POST'], endpoint="patient.import")
+@require_admin()
+def import_():
+    return generic_import(Patient, _build)
+
 @app.route("/api/v1/patient", methods=['POST', 'PUT'], endpoint="patient.upinsert")
 @require_login()
 def create_or_update():
@@ -160,38 +536,37 @@ def create_or_update():
         logging.error("Invalid request %r for json %r" % (request.method, request.json))
         return make_response(jsonify(code="Bad Request"), 400, {})
 
-    logs = patient.logs or []
-    logs.append(LogEntry.from_user(UserPrefs.get_current(), is_new))
-
-    name = request.json.get('name', None)
-
-    type_ = request.json.get('type', '')
-    blood_type = request.json.get('blood_type', None)
     try:
-        patient.populate(name=name, type_=type_, blood_type=blood_type, logs=logs)
+        _populate(patient, request.json, is_new)
         key = patient.put(update=not is_new)
     except BadValueError as e:
         logging.error("Cannot create Patient from %r: %r" % (request.json, e))
         return make_response(jsonify(code="Bad Request"), 400, {})
+    AuditEvent.record_async([key], get_current_user(), "create" if is_new else "update")
 
     return make_response(jsonify(code="OK", data=dict(key=key.urlsafe())), 200, {})
 
 def _get_multi():
     max_ = int(request.args.get("max", '20'))
     offset = int(request.args.get('offset', '0'))
+    cursor = request.args.get('cursor', None) or None
+    count_strategy = request.args.get('count', COUNT_EXACT)
     q = request.args.get('q', '') or None
     exact = str2bool(request.args.get('exact', None)) or False
     fields = dict([(f, q) for f in parse_fields(request.args.get('fields', 'name'))])
 
-    total = Patient.count()
+    total = Patient.count_async()
     query = Patient.build_query(exact=exact, name=fields.get('name'), code=fields.get('code'))
     endpoint = "patient.get"
 
     return make_response_list_paginator(max_=max_,
                                         offset=offset,
+                                        cursor=cursor,
+                                        count_strategy=count_strategy,
                                         q=q,
                                         exact=bool2int(exact),
                                         fields=','.join(fields.keys()),
+                                        select=request.args.get('select', None) or None,
                                         dbquery=query,
                                         total=total,
                                         endpoint=endpoint)
@@ -201,10 +576,90 @@ def _get_multi():
 @require_login()
 def get(key=None):
     if key is None:
-        return _get_multi()
+        return generic_get_multi(['Patient', 'UserPrefs'], _get_multi)
 
     return generic_get(key, Patient)
 
+@app.route("/api/v1/patient/<key>/history", methods=["GET"], endpoint="patient.history")
+@require_login()
+def history(key):
+    return generic_history(key, Patient, "patient.history")
+
+TIMELINE_MAX = 50
+
+@ndb.tasklet
+def _timeline_page_async(patient_key, max_, token):
+    """a page of the timeline of the patient, None if there is no patient
+
+    The query reads only keys, the transfusions come from a single get_multi
+    (served by the ndb memcache).
+    """
+    start = None
+    if token:
+        direction, start = decode_cursor(token)
+        if direction != CURSOR_NEXT:
+            raise BadValueError("Invalid cursor %r" % token)
+
+    query = Transfusion.build_timeline_query(patient_key)
+    patient, (keys, end, more) = yield (patient_key.get_async(),
+                                        query.fetch_page_async(max_, start_cursor=start,
+                                                               keys_only=True))
+    if patient is None:
+        raise ndb.Return(None)
+    trs = yield ndb.get_multi_async(keys)
+    # the keys may be stale, the transfusions are not
+    data = yield Model.to_dict_multi_async([tr for tr in trs
+                                            if tr is not None and tr.patient == patient_key])
+
+    next_ = None
+    if more and end is not None:
+        next_ = url_for('patient.timeline', key=patient_key.urlsafe(), max=max_,
+                        cursor=encode_cursor(CURSOR_NEXT, end))
+    raise ndb.Return(dict(data=data, next=next_, max=max_))
+
+@app.route("/api/v1/patient/<key>/timeline", methods=["GET"], endpoint="patient.timeline")
+@require_login()
+def timeline(key):
+    """transfusions of the patient by date, paged by cursor
+
+    Pages are cached until a transfusion of the patient (or the patient
+    itself) is written, see timeline_scope. The query is eventually
+    consistent: a page built while the timeline is settling is neither
+    cached nor tagged.
+    """
+    try:
+        patient_key = ndb.Key(urlsafe=key)
+    except (TypeError, ProtocolBufferDecodeError) as e:
+        logging.error("Error while decoding key %r: %r" % (key, e))
+        return make_response(jsonify(code="Not Found"), 404, {})
+    if patient_key.kind() != Patient._get_kind():
+        return make_response(jsonify(code="Not Found"), 404, {})
+
+    max_ = max(1, min(int(request.args.get("max", '20')), TIMELINE_MAX))
+    cursor = request.args.get('cursor', None) or None
+
+    etag = list_etag([timeline_scope(patient_key), 'UserPrefs'], max_, cursor)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    page = get_payload(patient_key, etag) if etag else None
+    if page is None:
+        try:
+            page = _timeline_page_async(patient_key, max_, cursor).get_result()
+        except BadValueError as e:
+            logging.error("Invalid cursor %r: %r" % (cursor, e))
+            return make_response(jsonify(code="Bad Request"), 400, {})
+        if page is None:
+            return make_response(jsonify(code="Not Found"), 404, {})
+        if etag:
+            set_payload(patient_key, etag, page)
+
+    response = make_response(jsonify(code='OK', **page), 200, {})
+    if etag:
+        response.set_etag(etag)
+    return response
+
 @app.route("/api/v1/patient/<key>", methods=["DELETE"], endpoint="patient.delete")
 @require_admin()
 def delete(key):
@@ -213,6 +668,7 @@ def delete(key):
 @app.route("/api/v1/patient/types",
            methods=["GET"],
            endpoint="patient.types")
+@cache_control(ENUM_MAX_AGE)
 @require_login()
 def get_blood_contents():
     return make_response(jsonify(data=dict(types=patient_types), code="OK"), 200, {})
@@ -27,37 +27,247 @@ Created on 10/12/2015
 # SOFTWARE.
 
 
+from StringIO import StringIO
+import csv
 from datetime import datetime
 import logging
 
-from flask import request
-from flask.helpers import make_response
+from flask import json, request, stream_with_context
+from flask.helpers import make_response, url_for
+from flask.wrappers import Response
 from flask.json import jsonify
-from google.appengine.api.datastore_errors import BadValueError
+from google.appengine.api.datastore_errors import BadValueError, BadRequestError
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
 
+from mejcrt.cache import COUNT_EXACT
 from mejcrt.controllers.decorators import require_admin
 from mejcrt.controllers.patient import parse_fields, \
     make_response_list_paginator, generic_delete, str2bool, bool2int, \
-    generic_get
-from mejcrt.models import valid_locals, blood_types, blood_contents, UserPrefs, \
+    generic_get, generic_import, generic_history, generic_get_multi, \
+    generic_batch_get
+from mejcrt.models import valid_locals, blood_types, blood_contents, \
     transfusion_tags
 from mejcrt.util import onlynumbers
 
 from ..app import app
-from ..models import Transfusion, Patient, BloodBag, LogEntry
-from .decorators import require_login
+from ..models import Transfusion, Patient, BloodBag, AuditEvent, Rollup, TooManyGroups
+from .decorators import require_login, get_current_user, cache_control, \
+    ENUM_MAX_AGE
 
 def parse_date(text):
     valid_formats = ('%Y-%m-%d', "%Y-%m-%dT%H:%M:%S.%fZ")
     for fmt in valid_formats:
         try:
             return datetime.strptime(text, fmt)
-        except ValueError:
+        except (ValueError, TypeError):
             pass
     raise ValueError("time data %r does not match format %r" % (text, valid_formats),)
 
+EXPORT_BATCH = 200
+# the python27 runtime buffers a whole response before sending it, so an
+# export answers at most EXPORT_MAX transfusions and links to the next part
+EXPORT_MAX = 5000
+EXPORT_FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+EXPORT_CSV_HEADER = ('code', 'date', 'local', 'patient.code', 'patient.name',
+                     'patient.blood_type', 'patient.type', 'tags', 'bags', 'text')
+
+def _export_records(keys):
+    "get keys by batches, yield a dict per transfusion with its patient"
+    ctx = ndb.get_context()
+    for n in xrange(0, len(keys), EXPORT_BATCH):
+        trs = [tr for tr in ndb.get_multi(keys[n:n + EXPORT_BATCH]) if tr is not None]
+        patient_keys = list(set(tr.patient for tr in trs))
+        patients = dict(zip(patient_keys, ndb.get_multi(patient_keys)))
+        for tr in trs:
+            p = patients[tr.patient]
+            yield dict(code=tr.code,
+                       date=str(tr.date),
+                       local=tr.local,
+                       patient=p and dict(code=p.code, name=p.name,
+                                          blood_type=p.blood_type, type=p.type_),
+                       tags=tr.tags,
+                       bags=[dict(type=b.type_, content=b.content) for b in tr.bags],
+                       text=tr.text)
+        # the context cache would keep every entity of the part
+        ctx.clear_cache()
+
+def _export_csv(records, header=True):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    if header:
+        writer.writerow(EXPORT_CSV_HEADER)
+    for r in records:
+        p = r['patient'] or {}
+        row = (r['code'], r['date'], r['local'],
+               p.get('code'), p.get('name'), p.get('blood_type'), p.get('type'),
+               '|'.join(r['tags']),
+               '|'.join('%s:%s' % (b['type'], b['content'] or '') for b in r['bags']),
+               r['text'])
+        writer.writerow([(v or u'').encode('utf-8') if isinstance(v, unicode) else v
+                         for v in row])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+def _export_jsonl(records):
+    for r in records:
+        yield json.dumps(r) + '\n'
+
+def _build_date_query(start=None, end=None, tags=None):
+    "Transfusion.build_date_query from request values, raise ValueError if invalid"
+    start = start and parse_date(start).date()
+    end = end and parse_date(end).date()
+    if tags and set(tags) - set(transfusion_tags):
+        raise ValueError("Invalid tags %r" % tags)
+    return Transfusion.build_date_query(start=start, end=end, tags=tags or None)
+
+@app.route("/api/v1/transfusion/export", methods=['GET'], endpoint="transfusion.export")
+@require_admin()
+def export():
+    format_ = request.args.get('format', 'csv')
+    if format_ not in EXPORT_FORMATS:
+        logging.error("Cannot export TR: invalid format %r" % format_)
+        return make_response(jsonify(code="Bad Request"), 400, {})
+
+    tags = request.args.get('tags', '') or None
+    try:
+        query = _build_date_query(start=request.args.get('start', None) or None,
+                                  end=request.args.get('end', None) or None,
+                                  tags=tags and parse_fields(tags))
+    except ValueError as e:
+        logging.error("Cannot export TR: %r" % e)
+        return make_response(jsonify(code="Bad Request"), 400, {})
+
+    cursor = request.args.get('cursor', None) or None
+    try:
+        keys, end, more = query.fetch_page(EXPORT_MAX, keys_only=True,
+                                           start_cursor=cursor and Cursor(urlsafe=cursor))
+    except (BadValueError, BadRequestError, ProtocolBufferDecodeError) as e:
+        logging.error("Cannot export TR: invalid cursor %r: %r" % (cursor, e))
+        return make_response(jsonify(code="Bad Request"), 400, {})
+
+    records = _export_records(keys)
+    if format_ == 'csv':
+        # the parts concatenate to a single file
+        body = _export_csv(records, header=cursor is None)
+    else:
+        body = _export_jsonl(records)
+
+    filename = "transfusions.%s" % format_
+    headers = {'Content-Disposition': 'attachment; filename=%s' % filename}
+    if more and end:
+        args = request.args.to_dict()
+        args['cursor'] = end.urlsafe()
+        headers['Link'] = '<%s>; rel="next"' % url_for('transfusion.export', **args)
+    # streamed by the development server, buffered by the python27 runtime
+    return Response(stream_with_context(body),
+                    mimetype=EXPORT_FORMATS[format_],
+                    headers=headers)
+
+BULK_BATCH = 100
+MAX_BULK = 1000
+
+def _bulk_keys(data):
+    """Return (keys, more) for a bulk request.
+
+    data has either 'keys', a list of transfusion keys, or 'query', a dict
+    with the filters of the export (start, end and tags). A query selects at
+    most MAX_BULK transfusions, more is True if it has other ones.
+    """
+    if not isinstance(data, dict):
+        raise BadValueError("Invalid request %r" % data)
+    if 'keys' in data:
+        try:
+            keys = [ndb.Key(urlsafe=key) for key in data['keys']]
+        except (TypeError, ProtocolBufferDecodeError):
+            raise BadValueError("Invalid keys %r" % data['keys'])
+        if len(keys) > MAX_BULK or [k for k in keys if k.kind() != Transfusion._get_kind()]:
+            raise BadValueError("Invalid keys %r" % data['keys'])
+        return keys, False
+
+    query = data.get('query', None)
+    if not isinstance(query, dict):
+        raise BadValueError("No keys or query")
+    try:
+        query = _build_date_query(start=query.get('start', None),
+                                  end=query.get('end', None),
+                                  tags=query.get('tags', None))
+    except ValueError as e:
+        raise BadValueError(str(e))
+    keys = query.fetch(MAX_BULK + 1, keys_only=True)
+    return keys[:MAX_BULK], len(keys) > MAX_BULK
+
+def _bulk(apply, action):
+    "apply(keys) in batches to the keys of the request, it returns the changed keys"
+    try:
+        keys, more = _bulk_keys(request.get_json(silent=True))
+    except BadValueError as e:
+        logging.error("Cannot apply %s to TRs: %r" % (action, e))
+        return make_response(jsonify(code="Bad Request"), 400, {})
+
+    user = get_current_user()
+    changed = []
+    for n in xrange(0, len(keys), BULK_BATCH):
+        batch = apply(keys[n:n + BULK_BATCH])
+        AuditEvent.record_async(batch, user, action)
+        changed.extend(batch)
+    return make_response(jsonify(code="OK", data=dict(count=len(changed),
+                                                      keys=[k.urlsafe() for k in changed],
+                                                      more=more)), 200, {})
+
+@app.route("/api/v1/transfusion/bulk/delete", methods=['POST'],
+           endpoint="transfusion.bulk.delete")
+@require_admin()
+def bulk_delete():
+    return _bulk(Transfusion.delete_multi, 'delete')
+
+@app.route("/api/v1/transfusion/bulk/tags", methods=['POST'],
+           endpoint="transfusion.bulk.tags")
+@require_admin()
+def bulk_tags():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    add = data.get('add', None) or []
+    remove = data.get('remove', None) or []
+    if not isinstance(add, list) or not isinstance(remove, list) or \
+            [tag for tag in add + remove if not isinstance(tag, basestring)] or \
+            set(add + remove) - set(transfusion_tags):
+        logging.error("Cannot update tags of TRs: %r" % data)
+        return make_response(jsonify(code="Bad Request"), 400, {})
+
+    apply = lambda keys: Transfusion.update_tags_multi(keys, add=add, remove=remove)
+    return _bulk(apply, 'update')
+
+def parse_month(text):
+    "validate a 'YYYY-MM' month"
+    return datetime.strptime(text, '%Y-%m').strftime('%Y-%m')
+
+@app.route("/api/v1/transfusion/analytics", methods=['GET'],
+           endpoint="transfusion.analytics")
+@require_login()
+def analytics():
+    group = parse_fields(request.args.get('group', 'month'))
+    filters = dict((d, request.args.get(d, None) or None) for d in Rollup.DIMENSIONS
+                   if d != 'month')
+    try:
+        start = request.args.get('start', None) or None
+        end = request.args.get('end', None) or None
+        start = start and parse_month(start)
+        end = end and parse_month(end)
+    except ValueError as e:
+        logging.error("Invalid analytics range: %r" % e)
+        return make_response(jsonify(code="Bad Request"), 400, {})
+    if set(group) - set(Rollup.DIMENSIONS):
+        logging.error("Invalid analytics group %r" % group)
+        return make_response(jsonify(code="Bad Request"), 400, {})
+
+    data = Rollup.breakdown(group, start=start, end=end, **filters)
+    return make_response(jsonify(code="OK", data=data, group=group,
+                                 total=sum(d['count'] for d in data)), 200, {})
+
 @app.route("/api/v1/transfusion/stats", methods=['GET'], endpoint="transfusion.stats")
 @require_login()
 def stats():
@@ -65,10 +275,10 @@ def stats():
     tags_str = request.args.get("tags", None)
     if tags_str:
         tags = tags_str.strip().lower().split(',')
-    stats = {}
-    for tag in tags:
-        stats[tag] = Transfusion.count(tag)
-    stats['all'] = Transfusion.count()
+    # all counters are read concurrently
+    futures = dict((tag, Transfusion.count_async(tag)) for tag in tags)
+    futures['all'] = Transfusion.count_async()
+    stats = dict((tag, f.get_result()) for tag, f in futures.iteritems())
     return make_response(
          jsonify(code="OK", data=dict(stats=stats)), 200, {})
 
@@ -79,7 +289,7 @@ def stats():
 @require_login()
 def get(key=None):
     if key is None:
-        return _get_multi()
+        return generic_get_multi(['Transfusion', 'Patient', 'UserPrefs'], _get_multi)
 
     return generic_get(key, Transfusion)
 
@@ -87,6 +297,8 @@ def _get_multi():
     # get_multi
     max_ = int(request.args.get("max", '20'))
     offset = int(request.args.get('offset', '0'))
+    cursor = request.args.get('cursor', None) or None
+    count_strategy = request.args.get('count', COUNT_EXACT)
     q = request.args.get('q', '') or None
     exact = str2bool(request.args.get('exact', None)) or False
 
@@ -106,7 +318,7 @@ def _get_multi():
     if max_ < 0:
         max_ = 0
 
-    total = Transfusion.count()
+    total = Transfusion.count_async()
     endpoint = "transfusion.get"
 
     patient_key_urlsafe = fields.get('patient.key', '') or None
@@ -132,14 +344,77 @@ def _get_multi():
                                         code=fields.get('code'))
     return make_response_list_paginator(max_=max_,
                                         offset=offset,
+                                        cursor=cursor,
+                                        count_strategy=count_strategy,
                                         q=q,
                                         fields=','.join(fields.keys()),
                                         exact=bool2int(exact),
+                                        select=request.args.get('select', None) or None,
                                         dbquery=query,
                                         tags=','.join(tags) if tags else '',
                                         total=total,
                                         endpoint=endpoint)
 
+def _get_patient_key(data):
+    patient_key = None
+    patient_key_url_safe = data.get('patient_key', None)
+    patient_record_code = data.get('record', None)
+    patient_dict = data.get('patient', dict())
+
+    if patient_key_url_safe is None and isinstance(patient_dict, dict):
+        patient_key_url_safe = patient_dict.get('key')
+
+    if patient_key_url_safe is not None:
+        try:
+            patient_key = ndb.Key(urlsafe=patient_key_url_safe)
+        except (ProtocolBufferDecodeError, TypeError):
+            pass
+    elif patient_record_code:
+        patient_key = ndb.Key(Patient, onlynumbers(patient_record_code))
+    return patient_key
+
+def _populate(tr, data, patient_key, is_new):
+    transfusion_date = data.get('date', None)
+    transfusion_local = data.get('local', None)
+    bags = []
+    for bag in data.get('bags', []):
+        if not isinstance(bag, dict):
+            raise BadValueError("Invalid bag %r" % bag)
+        bags.append(BloodBag(type_=bag.get('type'), content=bag.get('content')))
+    text = data.get('text', None) or None
+    tags = data.get('tags', [])
+
+    tr.touch(get_current_user())
+    tr.populate(patient=patient_key,
+                date=parse_date(transfusion_date),
+                local=transfusion_local,
+                bags=bags,
+                tags=tags,
+                text=text)
+
+def _build(record):
+    tr_code = onlynumbers(record.get('code', '0'))
+    if not tr_code or int(tr_code) == 0:
+        raise BadValueError("Invalid code %r" % record.get('code'))
+    patient_key = _get_patient_key(record)
+    if patient_key is None:
+        raise BadValueError("No patient key")
+    tr = Transfusion(id=tr_code)
+    _populate(tr, record, patient_key, is_new=True)
+    return tr
+
+@app.route("/api/v1/transfusion/batch-get", methods=['POST'],
+           endpoint="transfusion.batch.get")
+@require_login()
+def batch_get():
+    return generic_batch_get(Transfusion)
+
+@app.route("/api/v1/transfusion/import", methods=['POST'],
+           endpoint="transfusion.import")
+@require_admin()
+def import_():
+    return generic_import(Transfusion, _build)
+
 @app.route("/api/v1/transfusion", methods=['POST', 'PUT'],
            endpoint="transfusion.upinsert")
 @require_login()
@@ -167,21 +442,7 @@ def create_or_update():
         if int(tr_code) == 0:
             logging.error("Cannot create TR from %r: %r" % (request.json, 'no transfusion code'))
             return make_response(jsonify(code="Bad Request"), 400, {})
-        patient_key = None
-        patient_key_url_safe = request.json.get('patient_key', None)
-        patient_record_code = request.json.get('record', None)
-        patient_dict = request.json.get('patient', dict())
-
-        if patient_key_url_safe is None and isinstance(patient_dict, dict):
-            patient_key_url_safe = patient_dict.get('key')
-
-        if patient_key_url_safe is not None:
-            try:
-                patient_key = ndb.Key(urlsafe=patient_key_url_safe)
-            except ProtocolBufferDecodeError:
-                pass
-        elif patient_record_code:
-            patient_key = Patient.get_by_code(patient_record_code, onlykey=True)
+        patient_key = _get_patient_key(request.json)
 
         if patient_key is None:
             # no patient key
@@ -193,42 +454,32 @@ def create_or_update():
         logging.error("Cannot create TR from %r: %r (%r)" % (request.json, 'incorrect method', request.method))
         return make_response(jsonify(code="Bad Request"), 400, {})
 
-    transfusion_date = request.json.get('date', None)
-    transfusion_local = request.json.get('local', None)
-    bags = []
-    for bag in request.json.get('bags', []):
-        try:
-            bags.append(BloodBag(type_=bag['type'], content=bag['content']))
-        except BadValueError as e:
-            logging.error("Cannot create TR from %r: %r" % (request.json, e))
-            return make_response(jsonify(code="Bad Request"), 400, {})
-    text = request.json.get('text', None) or None
-    tags = request.json.get('tags', [])
-
-    logs = tr.logs or []
-
-    logs.append(LogEntry.from_user(UserPrefs.get_current(), is_new))
     try:
-        tr.populate(patient=patient_key,
-                    date=parse_date(transfusion_date),
-                    local=transfusion_local,
-                    bags=bags,
-                    logs=logs,
-                    tags=tags,
-                    text=text)
+        _populate(tr, request.json, patient_key, is_new)
         key = tr.put(update=not is_new)
+    except TooManyGroups as e:
+        logging.error("Cannot create TR from %r: %r" % (request.json, e))
+        return make_response(jsonify(code="Bad Request", error=str(e)), 400, {})
     except (BadValueError, ValueError) as e:
         logging.error("Cannot create TR from %r: %r" % (request.json, e))
         return make_response(jsonify(code="Bad Request"), 400, {})
+    AuditEvent.record_async([key], get_current_user(), "create" if is_new else "update")
 
     return make_response(jsonify(code="OK", data=dict(key=key.urlsafe())), 200, {})
 
+@app.route("/api/v1/transfusion/<key>/history", methods=["GET"],
+           endpoint="transfusion.history")
+@require_login()
+def history(key):
+    return generic_history(key, Transfusion, "transfusion.history")
+
 @app.route("/api/v1/transfusion/<key>", methods=["DELETE"], endpoint="transfusion.delete")
 @require_admin()
 def delete(key):
     return generic_delete(key, Transfusion)
 
 @app.route("/api/v1/transfusion/locals", methods=["GET"], endpoint="transfusion.locals")
+@cache_control(ENUM_MAX_AGE)
 @require_login()
 def get_locals():
     return make_response(jsonify(data=dict(locals=valid_locals), code="OK"), 200, {})
@@ -236,6 +487,7 @@ def get_locals():
 @app.route("/api/v1/transfusion/blood/types",
            methods=["GET"],
            endpoint="transfusion.blood.types")
+@cache_control(ENUM_MAX_AGE)
 @require_login()
 def get_blood_types():
     return make_response(jsonify(data=dict(types=blood_types), code="OK"), 200, {})
@@ -243,6 +495,7 @@ def get_blood_types():
 @app.route("/api/v1/transfusion/blood/contents",
            methods=["GET"],
            endpoint="transfusion.blood.contents")
+@cache_control(ENUM_MAX_AGE)
 @require_login()
 def get_blood_contents():
     return make_response(jsonify(data=dict(contents=blood_contents), code="OK"), 200, {})
@@ -33,22 +33,31 @@ from flask.globals import request
 from flask.helpers import make_response
 from flask.json import jsonify
 from google.appengine.api import users
+from google.appengine.ext import ndb
 from google.appengine.ext.db import BadValueError
 
+from mejcrt.cache import count_query_async, COUNT_EXACT
 from mejcrt.controllers.patient import parse_fields, \
-    make_response_list_paginator, str2bool
+    make_response_list_paginator, str2bool, generic_get_multi
 
 from ..app import app
 from ..models import UserPrefs
-from .decorators import require_login
+from .decorators import require_login, get_current_user, get_current_authz
+
+@ndb.tasklet
+def _count_all_async():
+    total, _ = yield count_query_async(UserPrefs.build_query(), COUNT_EXACT)
+    raise ndb.Return(total)
 
 def _get_multi():
     max_ = int(request.args.get("max", '20'))
     offset = int(request.args.get('offset', '0'))
+    cursor = request.args.get('cursor', None) or None
+    count_strategy = request.args.get('count', COUNT_EXACT)
     q = request.args.get('q', '') or None
     fields = dict([(f, q) for f in parse_fields(request.args.get('fields', ''))])
 
-    total = UserPrefs.build_query().count()
+    total = _count_all_async()
     admin = str2bool(fields.get('admin', None))
     authorized = str2bool(fields.get('admin', None))
 
@@ -57,8 +66,11 @@ def _get_multi():
 
     return make_response_list_paginator(max_=max_,
                                         offset=offset,
+                                        cursor=cursor,
+                                        count_strategy=count_strategy,
                                         q=q,
                                         fields=','.join(fields.keys()),
+                                        select=request.args.get('select', None) or None,
                                         dbquery=query,
                                         total=total,
                                         endpoint=endpoint)
@@ -70,8 +82,8 @@ def _get_multi():
 @require_login()
 def get(who=None):
     if who is None:
-        return _get_multi()
-    cur = UserPrefs.get_current()
+        return generic_get_multi(['UserPrefs'], _get_multi)
+    cur = get_current_user()
 
     if who == 'me':
         u = cur
@@ -123,14 +135,17 @@ def update():
     # check for restricted fields
     authorized = request.json.get('authorized', None)
     admin = request.json.get('admin', None)
-    cur = UserPrefs.get_current()
-    if (authorized is not None or admin is not None) and not cur.admin:
+    cur = get_current_user()
+    # cur may be a cached copy from before a revocation, the authorization
+    # cache is invalidated by every write of the user
+    _, is_admin = get_current_authz()
+    if (authorized is not None or admin is not None) and not is_admin:
         # only if admin could do this
         # forbidden
         logging.error("User %r is not admin, but tried to update user %r using %r" % (cur, u, request.json))
         return make_response(jsonify(code="Forbidden"), 403, {})
 
-    if cur.userid != u.userid and not cur.admin:
+    if cur.userid != u.userid and not is_admin:
         # only admin could change anyone
         logging.error("User %r cannot change user %r" % (cur, u))
         return make_response(jsonify(code="Forbidden"), 403, {})
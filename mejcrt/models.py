@@ -20,13 +20,19 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+from collections import Counter
 import datetime
+import random
 
-from google.appengine.api import users, memcache
+from google.appengine.api import users, memcache, taskqueue
 from google.appengine.api.datastore_errors import BadValueError
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
-from .util import iconv, tokenize
+from . import search
+from .cache import bump_generation, set_entity_version, forget_entity_version, \
+    timeline_scope, authz_scope, get_authz, set_authz
+from .util import bool2str, iconv
 
 # Models
 blood_types = ('O-',
@@ -67,26 +73,81 @@ transfusion_tags = ('semrt',
                     'anvisa',
                     'naovisitado')
 
-valid_actions = ["create", 'update']
+valid_actions = ["create", 'update', 'delete']
 
 class Model(ndb.Model):
     __dict_include__ = None
     __dict_exclude__ = None
+    # the projections with a composite index in index.yaml, pairs (names
+    # with an equality filter, projected names), see select_projection
+    PROJECTION_INDEXES = ()
 
     @classmethod
-    def _parse_data(cls, d):
-        # FIXME: does not check if there's circular objects (make a set of ids?)
+    def _collect_keys(cls, d, keys):
+        "add to keys every ndb.Key found in d"
+        if isinstance(d, ndb.Key):
+            keys.add(d)
+        elif isinstance(d, dict):
+            for v in d.itervalues():
+                cls._collect_keys(v, keys)
+        elif isinstance(d, (list, tuple)):
+            for v in d:
+                cls._collect_keys(v, keys)
+        return keys
+
+    @classmethod
+    def _raw_dict(cls, o):
+        if isinstance(o, Model):
+            return o._to_raw_dict()
+        if isinstance(o, ndb.Model):
+            return o.to_dict()
+        return o
+
+    @classmethod
+    @ndb.tasklet
+    def _resolve_keys_async(cls, raws, resolved=None):
+        if resolved is None:
+            resolved = {}
+        pending = cls._collect_keys(raws, set()) - set(resolved)
+        while pending:
+            keys = list(pending)
+            pending = set()
+            objs = yield ndb.get_multi_async(keys)
+            for key, o in zip(keys, objs):
+                resolved[key] = cls._raw_dict(o)
+                cls._collect_keys(resolved[key], pending)
+            pending -= set(resolved)
+        raise ndb.Return(resolved)
+
+    @classmethod
+    def _resolve_keys(cls, raws, resolved=None):
+        """Fetch every entity referenced by raws, return a dict {key: raw dict}.
+
+        Each level of references costs a single ndb.get_multi.
+        """
+        return cls._resolve_keys_async(raws, resolved).get_result()
+
+    @classmethod
+    def _parse_data(cls, d, resolved=None, path=frozenset()):
+        # path holds the keys being expanded, it breaks circular references
+        if resolved is None:
+            resolved = {}
         ret = d
         if isinstance(d, ndb.Key):
-            ret = cls._parse_data(d.get())
+            if d in path:
+                ret = {'key': d.urlsafe()}
+            else:
+                if d not in resolved:
+                    cls._resolve_keys([d], resolved)
+                ret = cls._parse_data(resolved[d], resolved, path | set([d]))
         elif isinstance(d, ndb.Model):
-            ret = cls._parse_data(d.to_dict())
+            ret = cls._parse_data(cls._raw_dict(d), resolved, path)
         elif isinstance(d, (datetime.datetime, datetime.date, datetime.time)):
             ret = cls._parse_data(str(d))
         elif isinstance(d, dict):
             ret = {}
             for k, v in d.iteritems():
-                v = cls._parse_data(v)
+                v = cls._parse_data(v, resolved, path)
 
                 # remove _ at end
                 new_key = k
@@ -97,12 +158,222 @@ class Model(ndb.Model):
         elif isinstance(d, (list, tuple)):
             ret = []
             for v in iter(d):
-                ret.append(cls._parse_data(v))
+                ret.append(cls._parse_data(v, resolved, path))
+
+        return ret
+
+    @classmethod
+    def _dict_plan(cls):
+        """The default to_dict of cls, compiled once per class.
+
+        Return (fields, with_key), fields is a list of (attribute, stored name,
+        name in the dict, converter, repeated, structured model class).
+        """
+        plan = cls.__dict__.get('_dict_plan_cache')
+        if plan is None:
+            include, exclude = cls.__dict_include__, cls.__dict_exclude__
+            fields = []
+            for prop in cls._properties.itervalues():
+                name = prop._code_name
+                if (include and name not in include) or (exclude and name in exclude):
+                    continue
+                modelclass = None
+                if isinstance(prop, (ndb.StructuredProperty, ndb.LocalStructuredProperty)) \
+                        and issubclass(prop._modelclass, Model):
+                    converter, modelclass = 'model', prop._modelclass
+                elif isinstance(prop, ndb.ComputedProperty):
+                    converter = 'generic'
+                elif isinstance(prop, (ndb.DateTimeProperty, ndb.TimeProperty)):
+                    converter = 'str'
+                elif isinstance(prop, ndb.KeyProperty):
+                    converter = 'key'
+                elif isinstance(prop, (ndb.TextProperty, ndb.IntegerProperty,
+                                       ndb.FloatProperty, ndb.BooleanProperty)):
+                    converter = 'plain'
+                else:
+                    converter = 'generic'
+                fields.append((name, prop._name, name.rstrip('_'), converter,
+                               prop._repeated, modelclass))
+            with_key = bool((include and 'key' in include) or (exclude and 'key' not in exclude))
+            plan = (fields, with_key)
+            # in the class itself, subclasses compile their own plan
+            setattr(cls, '_dict_plan_cache', plan)
+        return plan
+
+    def _dict_values(self, only=None):
+        """(field, value) of the fields of the plan loaded in self (see
+        projections), only those with attributes in only if it is not None"""
+        fields, _ = self._dict_plan()
+        projection = self._projection
+        for field in fields:
+            if projection and field[1] not in projection:
+                continue
+            if only is not None and field[0] not in only:
+                continue
+            yield field, getattr(self, field[0])
+
+    @classmethod
+    def select_fields(cls, names):
+        """Attributes of the fields of the default to_dict with names (as in
+        the dict, the key is always serialized).
+
+        Raise BadValueError if a name is not in the default to_dict.
+        """
+        fields, _ = cls._dict_plan()
+        attrs = dict((name, attr) for attr, _, name, _, _, _ in fields)
+        unknown = [n for n in names if n not in attrs and n != 'key']
+        if unknown:
+            raise BadValueError("Cannot select %r from %s" % (unknown, cls.__name__))
+        return frozenset(attrs[n] for n in names if n != 'key')
+
+    @classmethod
+    def _equality_filters(cls, node, names):
+        "add to names the properties with an equality filter in node, False for OR or post filters"
+        if node is None:
+            return names
+        if isinstance(node, ndb.FilterNode):
+            name, op, _ = node.__getnewargs__()
+            if op == '=':
+                names.add(name)
+            return names
+        if isinstance(node, ndb.ConjunctionNode):
+            for n in node:
+                if cls._equality_filters(n, names) is False:
+                    return False
+            return names
+        return False
+
+    @classmethod
+    def select_projection(cls, only, query):
+        """Stored names to project query on to serialize only, None if it
+        must fetch whole entities.
+
+        Only indexed, single and required (or computed) properties are
+        projected, entities without a value would be missing from the result.
+        Properties with an equality filter cannot be projected and OR queries
+        are left alone. A projection needs a composite index, only those of
+        PROJECTION_INDEXES are run.
+        """
+        if not only:
+            return None
+        filtered = cls._equality_filters(query.filters, set())
+        if filtered is False:
+            return None
+        projection = []
+        for attr in sorted(only):
+            prop = getattr(cls, attr)
+            if not prop._indexed or prop._repeated or prop._name in filtered or \
+                    isinstance(prop, (ndb.StructuredProperty, ndb.LocalStructuredProperty)) or \
+                    not (prop._required or isinstance(prop, ndb.ComputedProperty)):
+                return None
+            projection.append(prop._name)
+        projection = tuple(projection)
+        if (tuple(sorted(filtered)), projection) not in cls.PROJECTION_INDEXES:
+            return None
+        return projection
+
+    def _plan_keys(self, keys, only=None):
+        "add to keys every ndb.Key serialized by the default to_dict of self"
+        for (_, _, _, converter, repeated, _), value in self._dict_values(only):
+            if converter == 'key' or converter == 'generic':
+                self._collect_keys(value, keys)
+            elif converter == 'model':
+                for o in (value if repeated else [value]):
+                    if o is not None:
+                        o._plan_keys(keys)
+        return keys
+
+    @classmethod
+    def _serialize_key(cls, key, resolved, parsed, path):
+        if key in path:
+            return {'key': key.urlsafe()}
+        if key in parsed:
+            return parsed[key]
+        if key not in resolved:
+            cls._resolve_keys([key], resolved)
+        ret = cls._parse_data(resolved[key], resolved, path | set([key]))
+        if not cls._collect_keys(resolved[key], set()):
+            # it references nothing, the same dict serves every path
+            parsed[key] = ret
+        return ret
 
+    def _serialize(self, resolved, parsed, path, only=None):
+        """The default to_dict of self following the compiled plan, with
+        only the key and the attributes in only if it is not None.
+
+        resolved is {key: raw dict} (see _resolve_keys), parsed caches the
+        dicts of the referenced entities shared by a page.
+        """
+        ret = {}
+        with_key = only is not None or self._dict_plan()[1]
+        for (_, _, name, converter, repeated, _), value in self._dict_values(only):
+            if value is None:
+                pass
+            elif converter == 'plain':
+                if repeated:
+                    value = list(value)
+            elif converter == 'str':
+                value = [str(v) for v in value] if repeated else str(value)
+            elif converter == 'model':
+                value = [v._serialize(resolved, parsed, path) for v in value] \
+                    if repeated else value._serialize(resolved, parsed, path)
+            elif converter == 'key':
+                value = [self._serialize_key(v, resolved, parsed, path) for v in value] \
+                    if repeated else self._serialize_key(value, resolved, parsed, path)
+            else:
+                value = self._parse_data(value, resolved, path)
+            ret[name] = value
+        if with_key:
+            ret['key'] = self.key.urlsafe()
         return ret
 
+    @classmethod
+    @ndb.tasklet
+    def to_dict_multi_async(cls, objs, only=None):
+        keys = set()
+        for o in objs:
+            o._plan_keys(keys, only)
+        resolved = yield cls._resolve_keys_async(list(keys))
+        parsed = {}
+        raise ndb.Return([o._serialize(resolved, parsed, frozenset([o.key]), only)
+                          for o in objs])
+
+    @classmethod
+    def to_dict_multi(cls, objs, only=None):
+        """Serialize objs like to_dict does (only the key and the attributes
+        in only, see select_fields, if it is not None).
+
+        Referenced keys of all objs are collected first and fetched together,
+        instead of one get() per key.
+        """
+        return cls.to_dict_multi_async(objs, only).get_result()
+
+    # kinds embedded by to_dict, not None enables the entity ETag (see
+    # cache.entity_etag)
+    __etag_depends__ = None
+
+    def etag_version(self):
+        "changes whenever the entity is written"
+        return '%s.%s' % (self.object_version, self.updated_at)
+
+    def _post_put_hook(self, future):
+        kind = self._get_kind()
+        ctx = ndb.get_context()
+        ctx.call_on_commit(lambda: bump_generation(kind, settle=True))
+        if self.__etag_depends__ is not None:
+            key, version = future.get_result(), self.etag_version()
+            ctx.call_on_commit(lambda: set_entity_version(key, version))
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        kind = cls._get_kind()
+        ctx = ndb.get_context()
+        ctx.call_on_commit(lambda: bump_generation(kind, settle=True))
+        if cls.__etag_depends__ is not None:
+            ctx.call_on_commit(lambda: forget_entity_version(key))
+
     @ndb.utils.positional(1)
-    def to_dict(self, include=None, exclude=None):
+    def _to_raw_dict(self, include=None, exclude=None):
         if include is None and self.__dict_include__:
             include = self.__dict_include__
         if exclude is None and self.__dict_exclude__:
@@ -113,7 +384,498 @@ class Model(ndb.Model):
         if (include and 'key' in include) or (exclude and 'key' not in exclude):
             ret['key'] = self.key.urlsafe()
 
-        return self._parse_data(ret)
+        return ret
+
+    @ndb.utils.positional(1)
+    def to_dict(self, include=None, exclude=None):
+        if include is None and exclude is None:
+            resolved = self._resolve_keys(list(self._plan_keys(set())))
+            return self._serialize(resolved, {}, frozenset([self.key]))
+        ret = self._to_raw_dict(include=include, exclude=exclude)
+        return self._parse_data(ret, self._resolve_keys([ret]),
+                                frozenset([self.key]))
+
+# batch writes run their transactions (one per entity in transact_multi_async,
+# one per chunk in transact_chunks_async) this many at a time
+TRANSACTION_WINDOW = 5
+TRANSACTION_RETRIES = 5
+
+@ndb.tasklet
+def transact_multi_async(callback, items, window=TRANSACTION_WINDOW):
+    """Run the tasklet callback(item) in its own XG transaction for each item,
+    window transactions concurrently.
+
+    Return the result of each callback or the BadValueError it raised (its
+    transaction was rolled back).
+    """
+    @ndb.tasklet
+    def transact(item):
+        try:
+            result = yield ndb.transaction_async(lambda: callback(item), xg=True,
+                                                 retries=TRANSACTION_RETRIES)
+        except BadValueError as e:
+            result = e
+        raise ndb.Return(result)
+
+    results = []
+    for n in xrange(0, len(items), window):
+        done = yield [transact(item) for item in items[n:n + window]]
+        results.extend(done)
+    raise ndb.Return(results)
+
+def transact_multi(callback, items, window=TRANSACTION_WINDOW):
+    return transact_multi_async(callback, items, window).get_result()
+
+# an XG transaction spans at most 25 entity groups, the others are left to a
+# change that, read again in the transaction, writes other groups than planned
+TRANSACTION_GROUPS = 20
+
+class TooManyGroups(BadValueError):
+    "a change writes more entity groups than a transaction can"
+
+def check_groups(groups, limit=TRANSACTION_GROUPS):
+    "raise TooManyGroups if a change writing groups does not fit in a transaction"
+    if len(groups) > limit:
+        raise TooManyGroups("The change writes %d entity groups (counters, rollup "
+                            "buckets...), at most %d fit in a transaction" %
+                            (len(groups), limit))
+
+def chunk_by_groups(items, groups, limit=TRANSACTION_GROUPS):
+    """Split items in consecutive chunks writing at most limit entity groups.
+
+    groups(item) is the set of the groups written for item, anything hashable
+    naming them (a root key, a counter name...). An item over the limit is a
+    chunk of its own (see check_groups).
+    """
+    chunk, written = [], set()
+    for item in items:
+        touched = groups(item)
+        if chunk and len(written | touched) > limit:
+            yield chunk
+            chunk, written = [], set()
+        chunk.append(item)
+        written |= touched
+    if chunk:
+        yield chunk
+
+@ndb.tasklet
+def transact_chunks_async(callback, items, groups, window=TRANSACTION_WINDOW):
+    """Run the tasklet callback(chunk) in its own XG transaction for each
+    chunk of items (see chunk_by_groups), window transactions concurrently.
+
+    callback returns a result for each item of its chunk. Return the results
+    of all items, those of a chunk whose transaction raised a BadValueError
+    are that error, those of an item over the limit a TooManyGroups.
+    """
+    results = [None] * len(items)
+    fit = []
+    for n, item in enumerate(items):
+        try:
+            check_groups(groups(item))
+            fit.append(n)
+        except TooManyGroups as e:
+            results[n] = e
+    chunks = list(chunk_by_groups(fit, lambda n: groups(items[n])))
+    done = yield transact_multi_async(lambda chunk: callback([items[n] for n in chunk]),
+                                      chunks, window)
+    for chunk, result in zip(chunks, done):
+        if isinstance(result, BadValueError):
+            result = [result] * len(chunk)
+        for n, r in zip(chunk, result):
+            results[n] = r
+    raise ndb.Return(results)
+
+def transact_chunks(callback, items, groups, window=TRANSACTION_WINDOW):
+    return transact_chunks_async(callback, items, groups, window).get_result()
+
+class AggregatesLocked(Exception):
+    """the aggregates cannot change now (see AggregatesLock), try again later
+
+    Not a BadValueError: nothing is wrong with the change, the controllers
+    answer 503 (see controllers/admin.py).
+    """
+    # seconds, a job replaces the aggregates in a few of them
+    RETRY_AFTER = 10
+
+# the contributions of an entity to the aggregates, a pair of Counters
+# (counters, rollups), see the _contribution of Patient and Transfusion
+NO_CONTRIBUTION = (Counter(), Counter())
+
+class AggregatesJournal(ndb.Model):
+    """The changes of the aggregates in the key range of a shard of a
+    rebuild job (see rebuild.py) while the shard counts it.
+
+    The shard counts its range in key order, in batches, up to scanned_until.
+    A change of an entity is recorded (see record) after where the shard is:
+
+    - counted by the shard: its delta is added to counters and rollups, the
+      job adds them to its totals;
+    - maybe in the batch being read (reading): the contributions of the
+      entity after the change are kept in pending, the shard replaces what it
+      read by them when it saves the batch (see resolve);
+    - not read yet: nothing, the shard reads the changed entity.
+    """
+    _use_memcache = False
+
+    kind = ndb.StringProperty(required=True, indexed=False)
+    scanned_until = ndb.KeyProperty(indexed=False)
+    reading = ndb.BooleanProperty(default=False, indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+    counters = ndb.PickleProperty(compressed=True)
+    rollups = ndb.PickleProperty(compressed=True)
+    # {key: contributions}
+    pending = ndb.PickleProperty(compressed=True)
+
+    def _counted(self, key):
+        return self.done or (self.scanned_until is not None and key <= self.scanned_until)
+
+    def _add(self, contributions, sign):
+        for totals, deltas in zip((self.counters, self.rollups), contributions):
+            for name, delta in deltas.iteritems():
+                totals[name] += sign * delta
+
+    def record(self, key, before, after):
+        """record the change of the contributions of the entity with key
+        from before to after, return False if there was nothing to record"""
+        if self._counted(key):
+            self._add(after, 1)
+            self._add(before, -1)
+        elif self.reading:
+            self.pending[key] = after
+        else:
+            return False
+        return True
+
+    def resolve(self, scanned_until, done, read):
+        """The shard counted a batch up to the key scanned_until (None if
+        empty), to the end of its range if done, read is {key: contributions}
+        of the entities counted; end the reading."""
+        if scanned_until is not None:
+            self.scanned_until = scanned_until
+        self.done = done
+        self.reading = False
+        for key, after in self.pending.iteritems():
+            # the others are read by the next batches, as they are then
+            if self._counted(key):
+                self._add(after, 1)
+                self._add(read.get(key, NO_CONTRIBUTION), -1)
+        self.pending = {}
+
+class AggregatesLock(ndb.Model):
+    """Present while a rebuild job (see rebuild.py) recomputes the aggregates.
+
+    Every transaction that changes them reads it (see journal_async) and
+    records the changes in the journal of the shard of each entity changed,
+    so the totals of the job are still exact when they replace the
+    aggregates. Only while the job replaces them (finishing, see freeze) the
+    changes fail with AggregatesLocked.
+    """
+    _use_memcache = False
+
+    job = ndb.IntegerProperty(required=True, indexed=False)
+    finishing = ndb.BooleanProperty(default=False, indexed=False)
+    # (kind, start, end, journal key) of each shard counted by the job
+    ranges = ndb.PickleProperty()
+
+    @classmethod
+    def _lock_key(cls):
+        return ndb.Key(cls, 'rebuild')
+
+    @classmethod
+    def get_running(cls):
+        "the lock of the running job or None, to plan transactions (see journal_key)"
+        return cls._lock_key().get()
+
+    def journal_key(self, kind, key):
+        "the key of the journal of the entity of kind with key, None if the job does not count it"
+        for kind_, start, end, journal in self.ranges:
+            if kind_ == kind and (start is None or key >= start) and (end is None or key < end):
+                return journal
+        return None
+
+    @classmethod
+    @ndb.tasklet
+    def journal_async(cls, kind, changes, planned=False):
+        """Record the changes of the aggregates in the journals of the running
+        job (call it in their transaction). changes are triples (key, before,
+        after) of the entities of kind, with their contributions before and
+        after the change.
+
+        planned is the lock (or None) the transaction was planned with, its
+        entity groups include the journals (see journal_key). Raise
+        AggregatesLocked while the job replaces the aggregates, or if planned
+        is not the running job anymore.
+        """
+        changes = [change for change in changes if change[1] != change[2]]
+        if not changes:
+            return
+        lock = yield cls._lock_key().get_async()
+        if planned is not False and (planned and planned.job) != (lock and lock.job):
+            raise AggregatesLocked("A rebuild started or finished, try again later")
+        if lock is None:
+            return
+        if lock.finishing:
+            raise AggregatesLocked("Rebuild %s is replacing the aggregates, try again later" %
+                                   lock.job)
+        journal_keys = [lock.journal_key(kind, key) for key, _, _ in changes]
+        unique = list(set(key for key in journal_keys if key is not None))
+        journals = dict(zip(unique, (yield ndb.get_multi_async(unique))))
+        changed = {}
+        for journal_key, (key, before, after) in zip(journal_keys, changes):
+            journal = journals.get(journal_key)
+            if journal is not None and journal.record(key, before, after):
+                changed[journal_key] = journal
+        yield ndb.put_multi_async(changed.values())
+
+    @classmethod
+    def acquire(cls, job, ranges):
+        """lock for the job id, that counts ranges (see journal_key), raise
+        AggregatesLocked if another job holds it"""
+        @ndb.transactional
+        def acquire():
+            lock = cls._lock_key().get()
+            if lock is not None and lock.job != job:
+                raise AggregatesLocked("Rebuild %s is running" % lock.job)
+            cls(key=cls._lock_key(), job=job, ranges=ranges).put()
+        acquire()
+
+    @classmethod
+    def freeze(cls, job):
+        """stop the changes of the aggregates while the job id replaces them,
+        the transactions that read the lock before fail and are retried"""
+        @ndb.transactional
+        def freeze():
+            lock = cls._lock_key().get()
+            if lock is not None and lock.job == job and not lock.finishing:
+                lock.finishing = True
+                lock.put()
+        freeze()
+
+    @classmethod
+    def release(cls, job):
+        "unlock if the job id holds it (it may run in the transaction of the job)"
+        lock = cls._lock_key().get()
+        if lock is not None and lock.job == job:
+            lock.key.delete()
+
+class CounterSeed(ndb.Model):
+    """Marks a counter whose shards hold its whole count.
+
+    Only the rebuild job seeds counters (see CounterShard.reset), until then
+    the shards miss what was written before they existed.
+    """
+    seeded_at = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class SearchBackfill(ndb.Model):
+    """Marks a kind whose entities all have their search_keys.
+
+    Only the rebuild job with backfill marks kinds (see rebuild.finish), until
+    then a search also runs the filters of the version before search_keys
+    (see the _legacy_filters of each model), on the properties of the
+    entities it wrote.
+    """
+    finished_at = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+    _cache = memcache.Client()
+    CACHE_KEY = 'SearchBackfill.%s'
+    CACHE_TIME = 60
+
+    @classmethod
+    def done(cls, kind):
+        key = cls.CACHE_KEY % kind
+        done = cls._cache.get(key)
+        if done is None:
+            done = ndb.Key(cls, kind).get() is not None
+            cls._cache.set(key, done, time=cls.CACHE_TIME)
+        return done
+
+    @classmethod
+    def mark(cls, kinds):
+        ndb.put_multi([cls(id=kind) for kind in kinds])
+        cls._cache.delete_multi([cls.CACHE_KEY % kind for kind in kinds])
+
+class CounterShard(ndb.Model):
+    """One shard of a named durable counter.
+
+    Shards must be changed inside the transaction that changes the counted
+    data (see incr), memcache is only a read-through cache of the sum.
+    """
+    SHARDS = 20
+
+    count = ndb.IntegerProperty(default=0, required=True, indexed=False)
+
+    _cache = memcache.Client()
+
+    @classmethod
+    def _shard_key(cls, name, index):
+        return ndb.Key(cls, "%s.%d" % (name, index))
+
+    @classmethod
+    def _shard_keys(cls, name):
+        return [cls._shard_key(name, i) for i in xrange(cls.SHARDS)]
+
+    @classmethod
+    @ndb.tasklet
+    def get_count_async(cls, name, fallback=None):
+        """The count of name, or of the query fallback (an exact count from
+        the datastore) while the counter was not seeded by the rebuild job."""
+        ctx = ndb.get_context()
+        c = yield ctx.memcache_get(name)
+        if c is None:
+            entities = yield ndb.get_multi_async(cls._shard_keys(name) +
+                                                 [ndb.Key(CounterSeed, name)])
+            shards, seeded = entities[:-1], entities[-1]
+            if fallback is not None and seeded is None:
+                c = yield fallback.count_async()
+                # writes invalidate it too (see incr), this bounds a racing read
+                yield ctx.memcache_set(name, c, time=60)
+            else:
+                c = sum(shard.count for shard in shards if shard)
+                yield ctx.memcache_set(name, c, time=3600)
+        raise ndb.Return(c)
+
+    @classmethod
+    def get_count(cls, name, fallback=None):
+        return cls.get_count_async(name, fallback).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def incr_async(cls, deltas):
+        "apply a mapping {name: delta} to the counters (call it in a transaction)"
+        deltas = dict((name, delta) for name, delta in deltas.iteritems() if delta)
+        if not deltas:
+            return
+        keys = [cls._shard_key(name, random.randint(0, cls.SHARDS - 1))
+                for name in deltas]
+        shards = []
+        olds = yield ndb.get_multi_async(keys)
+        for key, shard, name in zip(keys, olds, deltas):
+            if shard is None:
+                shard = cls(key=key)
+            shard.count += deltas[name]
+            shards.append(shard)
+        yield ndb.put_multi_async(shards)
+
+        names = deltas.keys()
+        ndb.get_context().call_on_commit(
+            lambda: cls._cache.delete_multi(names))
+
+    @classmethod
+    def incr(cls, deltas):
+        cls.incr_async(deltas).get_result()
+
+    @classmethod
+    def reset(cls, name, value):
+        "replace, in a single transaction, all the shards of name by value and seed it"
+        keys = cls._shard_keys(name)
+
+        @ndb.transactional(xg=True)
+        def reset():
+            stale = [shard.key for shard in ndb.get_multi(keys[1:]) if shard]
+            ndb.delete_multi(stale)
+            ndb.put_multi([cls(key=keys[0], count=value), CounterSeed(id=name)])
+            ndb.get_context().call_on_commit(lambda: cls._cache.delete(name))
+        reset()
+
+class Rollup(ndb.Model):
+    """Number of blood bags transfused by month, local, blood type and content.
+
+    Like CounterShard, rollups are changed inside the transaction that
+    changes the transfusions (see Transfusion._update_aggregates_async).
+    Each bucket is split in up to SHARDS entities, the count of a bucket is
+    the sum of its entities.
+    """
+    DIMENSIONS = ('month', 'local', 'blood_type', 'content')
+    # concurrent transactions on a bucket mostly write different shards
+    SHARDS = 5
+
+    month = ndb.StringProperty(required=True, indexed=True)
+    local = ndb.StringProperty(required=True, indexed=False)
+    blood_type = ndb.StringProperty(required=True, indexed=False)
+    content = ndb.StringProperty(required=True, indexed=False)
+    count = ndb.IntegerProperty(default=0, required=True, indexed=False)
+
+    @classmethod
+    def bucket(cls, date, local, bag):
+        "the tuple of dimensions of a bag transfused at date in local"
+        return (date.strftime('%Y-%m'), local, bag.type_, bag.content or '')
+
+    @classmethod
+    def _bucket_key(cls, bucket, shard=0):
+        name = '|'.join(bucket)
+        return ndb.Key(cls, '%s#%d' % (name, shard) if shard else name)
+
+    @classmethod
+    @ndb.tasklet
+    def incr_async(cls, deltas):
+        "apply a mapping {bucket: delta} to the rollups (call it in a transaction)"
+        deltas = dict((bucket, delta) for bucket, delta in deltas.iteritems() if delta)
+        if not deltas:
+            return
+        buckets = deltas.keys()
+        keys = [cls._bucket_key(bucket, random.randint(0, cls.SHARDS - 1))
+                for bucket in buckets]
+        rollups = yield ndb.get_multi_async(keys)
+        changed, empty = [], []
+        for key, bucket, rollup in zip(keys, buckets, rollups):
+            if rollup is None:
+                rollup = cls(key=key, **dict(zip(cls.DIMENSIONS, bucket)))
+            rollup.count += deltas[bucket]
+            (changed if rollup.count else empty).append(rollup)
+        yield (ndb.put_multi_async(changed) +
+               ndb.delete_multi_async([rollup.key for rollup in empty]))
+
+    @classmethod
+    def incr(cls, deltas):
+        cls.incr_async(deltas).get_result()
+
+    @classmethod
+    def reset(cls, totals, batch=500):
+        """Replace all rollups by totals, a mapping {bucket: count}, one
+        entity per bucket.
+
+        Each rollup is replaced atomically, not the whole set: call it while
+        the rebuild job freezes the AggregatesLock, nothing else writes them.
+        """
+        stale = set(cls.query().fetch(keys_only=True))
+        rollups = []
+        for bucket, count in totals.iteritems():
+            if count:
+                key = cls._bucket_key(bucket)
+                stale.discard(key)
+                rollups.append(cls(key=key, count=count,
+                                   **dict(zip(cls.DIMENSIONS, bucket))))
+        for n in xrange(0, len(rollups), batch):
+            ndb.put_multi(rollups[n:n + batch])
+        stale = list(stale)
+        for n in xrange(0, len(stale), batch):
+            ndb.delete_multi(stale[n:n + batch])
+
+    @classmethod
+    def build_query(cls, start=None, end=None):
+        "rollups from month start to month end (inclusive, 'YYYY-MM')"
+        query = cls.query()
+        if start is not None:
+            query = query.filter(cls.month >= start)
+        if end is not None:
+            query = query.filter(cls.month <= end)
+        return query
+
+    @classmethod
+    def breakdown(cls, group, start=None, end=None, **filters):
+        """Sum the rollups between start and end by the dimensions of group.
+
+        filters restrict the other dimensions to a value, it costs one read
+        per rollup (month x local x blood type x content).
+        """
+        totals = Counter()
+        for rollup in cls.build_query(start, end).iter(batch_size=500):
+            if [d for d, v in filters.iteritems() if v is not None and getattr(rollup, d) != v]:
+                continue
+            totals[tuple(getattr(rollup, d) for d in group)] += rollup.count
+        # a shard may be negative, only the sum of the bucket is meaningful
+        return [dict(zip(group, bucket), count=count)
+                for bucket, count in sorted(totals.iteritems()) if count]
 
 class UserPrefs(Model):
     __dict_include__ = ['userid', 'name', 'email', 'admin', 'added_at']
@@ -128,6 +890,18 @@ class UserPrefs(Model):
     admin = ndb.BooleanProperty(required=True, indexed=True)
     authorized = ndb.BooleanProperty(required=True, indexed=True)
 
+    SEARCH_GROUPS = [('admin', 'authorized')]
+    search_keys = ndb.ComputedProperty(lambda self: self._gen_search_keys(), repeated=True)
+
+    def _gen_search_keys(self):
+        return search.index_keys(dict(admin=bool2str(self.admin),
+                                      authorized=bool2str(self.authorized)),
+                                 self.SEARCH_GROUPS)
+
+    CACHE_KEY = 'UserPrefs.current.%s'
+
+    _cache = memcache.Client()
+
     @classmethod
     def get_current(cls):
         user = users.get_current_user()
@@ -137,53 +911,178 @@ class UserPrefs(Model):
         userid = user.user_id()
         is_admin = users.is_current_user_admin()
 
-        pref = cls.get_by_userid(userid)
+        cache_key = cls.CACHE_KEY % userid
+        pref = cls._cache.get(cache_key)
+        if pref is None:
+            pref = cls.get_by_userid(userid)
+            if pref is not None:
+                cls._cache.set(key=cache_key, value=pref, time=60)
 
+        changed = False
         # always create a new pref
         if pref is None:
             pref = cls(id=str(userid), email=user.email(),
                        authorized=False, admin=False, name=user.nickname())
+            changed = True
 
         # XXX: upgrade to admin account if is a cloud admin account
-        if is_admin:
+        if is_admin and not (pref.admin and pref.authorized):
             pref.admin = True
             pref.authorized = True
-        pref.put()
+            changed = True
+
+        if changed:
+            pref.put()
         return pref
 
+    @classmethod
+    def get_current_authz(cls):
+        """Return (authorized, admin) of the logged user, None if not logged.
+
+        The decision, even a rejection, is cached per user until the user is
+        written, the datastore is only read on a miss (never CACHE_KEY, a
+        request racing with the write may have put a stale copy there).
+        """
+        user = users.get_current_user()
+        if user is None:
+            return None
+        userid = user.user_id()
+
+        generation, decision = get_authz(userid)
+        # a cloud admin not yet upgraded (see get_current) must reach the datastore
+        if decision is not None and (decision[1] or not users.is_current_user_admin()):
+            return decision
+
+        pref = cls.get_by_userid(userid)
+        if pref is None or (users.is_current_user_admin() and
+                            not (pref.admin and pref.authorized)):
+            # a new user or a cloud admin to upgrade, get_current writes it
+            pref = cls.get_current()
+        decision = (pref.authorized, pref.admin)
+        set_authz(userid, generation, decision)
+        return decision
+
+    def _post_put_hook(self, future):
+        super(UserPrefs, self)._post_put_hook(future)
+        userid = self.key.id()
+        cache_key = self.CACHE_KEY % userid
+
+        def invalidate():
+            self._cache.delete(cache_key)
+            bump_generation(authz_scope(userid))
+        ndb.get_context().call_on_commit(invalidate)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        super(UserPrefs, cls)._post_delete_hook(key, future)
+        cache_key = cls.CACHE_KEY % key.id()
+
+        def invalidate():
+            cls._cache.delete(cache_key)
+            bump_generation(authz_scope(key.id()))
+        ndb.get_context().call_on_commit(invalidate)
+
     @classmethod
     def get_by_userid(cls, *args):
         return cls.get_by_id(*args)
 
     @classmethod
     def build_query(cls, admin=None, authorized=None):
+        terms = []
+        if admin is not None:
+            terms.append(('admin', bool2str(admin), True))
+        if authorized is not None:
+            terms.append(('authorized', bool2str(authorized), True))
+
+        if terms:
+            node = search.plan(cls.search_keys, terms, cls.SEARCH_GROUPS)
+            if not SearchBackfill.done(cls._get_kind()):
+                node = ndb.OR(node, *cls._legacy_filters(admin, authorized))
+            return cls.query(node)
+
+        return cls.query()
+
+    @classmethod
+    def _legacy_filters(cls, admin=None, authorized=None):
+        "the filters of build_query before search_keys"
         filters = []
         if admin is not None:
             filters.append(cls.admin == admin)
         if authorized is not None:
             filters.append(cls.authorized == authorized)
+        return filters
 
-        if filters:
-            return cls.query(ndb.OR(*filters))
-
-        return cls.query()
+class AuditEvent(Model):
+    "an append-only record of a change made by user on entity"
+    __dict_include__ = ['user', 'when', 'action']
 
-class LogEntry(Model):
-    user = ndb.KeyProperty(UserPrefs, required=True, indexed=True)
-    when = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    entity = ndb.KeyProperty(required=True, indexed=True)
+    user = ndb.KeyProperty(UserPrefs, required=True, indexed=False)
+    when = ndb.DateTimeProperty(auto_now_add=True, indexed=True)
     action = ndb.StringProperty(indexed=False, required=True, choices=valid_actions)
 
     @classmethod
-    def from_user(cls, user, is_new):
-        return cls(user=user.key,
-                   action="create" if is_new else "update")
+    def record_async(cls, keys, user, action):
+        """Store one event per entity key in a single batch, without waiting.
+
+        Return the future of the batch (the app waits for it at the end of
+        the request, see app.py).
+        """
+        events = [cls(entity=key, user=user.key, action=action) for key in keys]
+        return ndb.put_multi_async(events)
+
+    @classmethod
+    def build_query(cls, entity_key):
+        return cls.query(cls.entity == entity_key).order(cls.when)
+
+class AuditedModel(Model):
+    "a model that keeps only its last change, its history is on AuditEvent"
+    last_modified_by = ndb.KeyProperty(UserPrefs, indexed=False)
+    last_modified_at = ndb.DateTimeProperty(indexed=False)
+
+    def touch(self, user):
+        "mark the change being made as done by user"
+        self.last_modified_by = user.key
+        self.last_modified_at = datetime.datetime.now()
+
+    def pop_legacy_logs(self):
+        """Remove the 'logs' entries the entity kept before AuditEvent (loaded
+        as a property the model does not declare), return them as unsaved
+        AuditEvents whose ids are the same every time.
+        """
+        prop = self._properties.get('logs')
+        if prop is None or 'logs' in type(self)._properties:
+            return []
+        value = prop._get_value(self)
+        del self._properties['logs']
+        self._values.pop('logs', None)
+
+        events = []
+        for entry in value if isinstance(value, list) else [value]:
+            fields = [getattr(entry, name, None) for name in ('user', 'when', 'action')]
+            # a repeated structure may be loaded as a single one with lists
+            if not isinstance(fields[0], list):
+                fields = [[field] for field in fields]
+            for user, when, action in zip(*fields):
+                if user is None or action not in valid_actions:
+                    continue
+                events.append(AuditEvent(id='%s.log.%d' % (self.key.urlsafe(), len(events)),
+                                         entity=self.key, user=user, when=when,
+                                         action=action))
+        return events
 
 class PatientCode(Model):
     pass
 
-class Patient(Model):
-    __dict_exclude__ = ['name_tags', 'code_tags', 'object_version', 'added_at',
-                        'updated_at']
+class Patient(AuditedModel):
+    __dict_exclude__ = ['search_keys', 'object_version', 'added_at',
+                        'updated_at', 'logs']
+    __etag_depends__ = ['UserPrefs']
+
+    # get_by_code and key gets outside transactions read through memcache,
+    # ndb invalidates it on put/delete
+    _use_memcache = True
+    _memcache_timeout = 3600
 
     COUNT_KEY = 'Patient.count'
 
@@ -196,97 +1095,214 @@ class Patient(Model):
     blood_type = ndb.StringProperty(indexed=True, required=True, choices=blood_types)
     type_ = ndb.StringProperty(indexed=True, required=True,
         choices=patient_types)
-    logs = ndb.StructuredProperty(LogEntry, repeated=True)
 
-    name_tags = ndb.ComputedProperty(lambda self: self._gen_tokens_for_name(self.name), repeated=True)
-    code_tags = ndb.ComputedProperty(lambda self: self._gen_tokens_for_code(self.code), repeated=True)
+    SEARCH_GROUPS = [('name', 'code')]
+    PROJECTION_INDEXES = [((), ('code', 'name'))]
+    search_keys = ndb.ComputedProperty(lambda self: self._gen_search_keys(), repeated=True)
 
-    _cache = memcache.Client()
-
-    def _gen_tokens_for_name(self, name):
-        name = iconv(name.lower())
-        tokens = tokenize(name, minimum=4, maximum=16)
-        tokens.add(name)
-        return list(tokens)
-
-    def _gen_tokens_for_code(self, code):
-        code = iconv(code.lower())
-        tokens = tokenize(code, minimum=4, maximum=16)
-        tokens.add(code)
-        return list(tokens)
+    def _gen_search_keys(self):
+        return search.index_keys(dict(name=self.name, code=self.code),
+                                 self.SEARCH_GROUPS)
 
     def delete(self):
-        self.key.delete()
-        self._count_decr()
+        @ndb.transactional(xg=True)
+        def delete():
+            # a concurrent delete may have already counted it
+            if self.key.get() is None:
+                return
+            self.key.delete()
+            self._update_count([(self, None)])
+        delete()
 
     def put(self, update=False, **ctx_options):
-        @ndb.transactional
+        @ndb.transactional(xg=True)
         def put():
-            if self.get_by_code(self.code):
+            old = self.get_by_code(self.code)
+            if old:
                 if not update:
                     raise BadValueError("Code %r is duplicated" % self.code)
             elif update:
                 raise BadValueError("Code %r does not exist" % self.code)
-            return super(Patient, self).put(**ctx_options)
-        key = put()
-        if not update:
-            self._count_incr()
-        return key
+            key = super(Patient, self).put(**ctx_options)
+            if not update:
+                self._update_count([(None, self)])
+            if old and old.name != self.name:
+                # the transfusions follow in tasks, queued only if this commits
+                self.enqueue_sync()
+            return key
+        return put()
+
+    SYNC_BATCH = 100
+    # the task that runs sync_transfusions (see controllers/admin.py)
+    SYNC_URL = '/api/v1/admin/patient/sync'
+
+    def enqueue_sync(self, cursor=None):
+        "queue the copy of the search fields to the transfusions, from cursor"
+        params = dict(patient=self.key.urlsafe())
+        if cursor is not None:
+            params['cursor'] = cursor
+        taskqueue.add(url=self.SYNC_URL, params=params,
+                      transactional=ndb.in_transaction())
+
+    def sync_transfusions(self, cursor=None):
+        """Copy the search fields of this patient to a batch of its transfusions,
+        from cursor (urlsafe), each one in its own transaction.
+
+        The number of transfusions is unbounded, it runs in tasks (see
+        enqueue_sync). Return how many transfusions were changed and the
+        cursor of the next batch, None after the last.
+        """
+        query = Transfusion.query(Transfusion.patient == self.key)
+        start = Cursor(urlsafe=cursor) if cursor else None
+        keys, end, more = query.fetch_page(self.SYNC_BATCH, start_cursor=start,
+                                           keys_only=True)
+
+        @ndb.tasklet
+        def sync(key):
+            tr = yield key.get_async()
+            if tr is None or tr.patient != self.key or tr.patient_name == self.name:
+                raise ndb.Return(False)
+            tr.set_patient(self)
+            yield tr.put_async()
+            raise ndb.Return(True)
+
+        changed = len([r for r in transact_multi(sync, keys) if r is True])
+        return changed, end.urlsafe() if more and end else None
 
     @classmethod
-    def count(cls):
-        c = cls._cache.get(cls.COUNT_KEY)
-        if c is None:
-            c = cls.query().count()
-            cls._cache.set(key=cls.COUNT_KEY, value=c, time=3600)
-        return c
+    def _contribution(cls, patient):
+        "what patient (or None) adds to the aggregates (see AggregatesJournal)"
+        if patient is None:
+            return NO_CONTRIBUTION
+        return Counter({cls.COUNT_KEY: 1}), Counter()
+
+    @classmethod
+    @ndb.tasklet
+    def _update_count_async(cls, changes, planned=False):
+        """Apply the count delta of changes, pairs (old, new) of patients.
+
+        Call it inside the transaction that made the changes, planned as in
+        AggregatesLock.journal_async.
+        """
+        delta = sum((new is not None) - (old is not None) for old, new in changes)
+        yield (CounterShard.incr_async({cls.COUNT_KEY: delta}),
+               AggregatesLock.journal_async(
+                   cls._get_kind(), [((old or new).key, cls._contribution(old),
+                                      cls._contribution(new)) for old, new in changes],
+                   planned))
 
     @classmethod
-    def _count_incr(cls):
-        # It does nothing if KEY doesn't exists
-        cls._cache.incr(cls.COUNT_KEY)
-        return cls.count()
+    def _update_count(cls, changes):
+        cls._update_count_async(changes).get_result()
 
     @classmethod
-    def _count_decr(cls):
-        # It does nothing if KEY doesn't exists
-        cls._cache.decr(cls.COUNT_KEY)
-        return cls.count()
+    def count_async(cls):
+        return CounterShard.get_count_async(cls.COUNT_KEY, fallback=cls.query())
+
+    @classmethod
+    def count(cls):
+        return cls.count_async().get_result()
+
+    @classmethod
+    def put_new_multi(cls, patients):
+        """Create patients in batch (they must not exist).
+
+        The patients are checked and created by chunks, each in a transaction
+        with a single change of the count. Return a list with the key of each
+        created patient or the BadValueError that prevented its creation.
+        """
+        lock = AggregatesLock.get_running()
+
+        def groups(p):
+            groups = set([p.key, cls.COUNT_KEY, AggregatesLock._lock_key()])
+            if lock is not None:
+                groups.add(lock.journal_key(cls._get_kind(), p.key))
+            return groups
+
+        @ndb.tasklet
+        def create(chunk):
+            olds = yield ndb.get_multi_async([p.key for p in chunk])
+            new = [p for p, old in zip(chunk, olds) if old is None]
+            yield ndb.put_multi_async(new)
+            yield cls._update_count_async([(None, p) for p in new], planned=lock)
+            raise ndb.Return([p.key if old is None else
+                              BadValueError("Code %r is duplicated" % p.code)
+                              for p, old in zip(chunk, olds)])
+
+        ret = []
+        created = []
+        seen = set()
+        for p in patients:
+            if p.key in seen:
+                ret.append(BadValueError("Code %r is duplicated" % p.code))
+            else:
+                ret.append(None)
+                created.append(p)
+            seen.add(p.key)
+
+        results = iter(transact_chunks(create, created, groups))
+        return [r or next(results) for r in ret]
 
     @classmethod
     def get_by_code(cls, *args, **kwargs):
         result = cls.get_by_id(*args, **kwargs)
         return result
 
+    def _post_put_hook(self, future):
+        super(Patient, self)._post_put_hook(future)
+        # the timeline embeds the patient
+        key = self.key
+        ndb.get_context().call_on_commit(lambda: bump_generation(timeline_scope(key)))
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        super(Patient, cls)._post_delete_hook(key, future)
+        ndb.get_context().call_on_commit(lambda: bump_generation(timeline_scope(key)))
+
     @property
     def transfusions(self):
         return Transfusion.build_query(patient_key=self.key).fetch(keys_only=True)
 
     @classmethod
     def build_query(cls, name=None, code=None, exact=False):
-        filters = []
+        terms = []
         if name is not None:
-            if exact:
-                filters.append(cls.name == iconv(name).strip().lower())
-            else:
-                filters.append(cls.name_tags == iconv(name).strip().lower())
+            terms.append(('name', name, exact))
         if code is not None:
-            if exact:
-                filters.append(cls.code == code)
-            else:
-                filters.append(cls.code_tags == code)
+            terms.append(('code', code, exact))
 
-        if filters:
-            return cls.query(ndb.OR(*filters))
+        if terms:
+            node = search.plan(cls.search_keys, terms, cls.SEARCH_GROUPS)
+            if not SearchBackfill.done(cls._get_kind()):
+                node = ndb.OR(node, *cls._legacy_filters(name, code, exact))
+            return cls.query(node)
 
         return cls.query()
 
+    @classmethod
+    def _legacy_filters(cls, name=None, code=None, exact=False):
+        "the filters of build_query before search_keys, on the old name_tags and code_tags"
+        filters = []
+        if name is not None:
+            name = iconv(name).strip().lower()
+            filters.append(cls.name == name if exact else
+                           ndb.GenericProperty('name_tags') == name)
+        if code is not None:
+            filters.append(cls.code == code if exact else
+                           ndb.GenericProperty('code_tags') == code)
+        return filters
+
 class BloodBag(Model):
     type_ = ndb.StringProperty(indexed=False, required=True, choices=blood_types)
     content = ndb.StringProperty()
 
-class Transfusion(Model):
-    __dict_exclude__ = ['object_version', 'added_at', 'updated_at']
+class Transfusion(AuditedModel):
+    __dict_exclude__ = ['object_version', 'added_at', 'updated_at',
+                        'patient_name', 'search_keys', 'logs']
+    __etag_depends__ = ['Patient', 'UserPrefs']
+
+    _use_memcache = True
+    _memcache_timeout = 3600
 
     object_version = ndb.IntegerProperty(default=1, required=True)
     added_at = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
@@ -303,41 +1319,121 @@ class Transfusion(Model):
     tags = ndb.StringProperty(repeated=True, indexed=True,
         choices=transfusion_tags,)
     text = ndb.TextProperty(required=False)
-    logs = ndb.StructuredProperty(LogEntry, repeated=True)
 
-    _cache = memcache.Client()
+    # copied from the patient (see set_patient), it lets a search by patient
+    # be a single query on Transfusion
+    patient_name = ndb.StringProperty(indexed=False)
+
+    # only the fields searched by the list page: every group stores again
+    # the keys of its fields
+    SEARCH_GROUPS = [('code', 'patient.name', 'patient.code')]
+    PROJECTION_INDEXES = [((), ('code', 'date')), (('tags',), ('code', 'date'))]
+    search_keys = ndb.ComputedProperty(lambda self: self._gen_search_keys(), repeated=True)
+
+    def _gen_search_keys(self):
+        return search.index_keys({'code': self.code,
+                                  'patient.name': self.patient_name,
+                                  'patient.code': self.patient and self.patient.id()},
+                                 self.SEARCH_GROUPS)
+
+    def set_patient(self, patient):
+        "point to patient and copy its search fields"
+        self.patient = patient.key
+        self.patient_name = patient.name
+
+    @classmethod
+    def _get_counter_name(cls, tag):
+        return "%s.tag.%s" % (cls.__name__, tag)
+
+    @classmethod
+    def _counter_deltas(cls, old, new):
+        "counter changes when the stored transfusion old becomes new (both may be None)"
+        deltas = Counter()
+        for tr, sign in ((old, -1), (new, 1)):
+            if tr is not None:
+                for tag in set(tr.tags) | set(['all']):
+                    deltas[cls._get_counter_name(tag)] += sign
+        return deltas
+
+    @classmethod
+    def _rollup_deltas(cls, old, new):
+        "rollup changes when the stored transfusion old becomes new (both may be None)"
+        deltas = Counter()
+        for tr, sign in ((old, -1), (new, 1)):
+            if tr is not None:
+                for bag in tr.bags:
+                    deltas[Rollup.bucket(tr.date, tr.local, bag)] += sign
+        return deltas
 
     @classmethod
-    def _get_cache_key(cls, tag):
-        return "%s.tag.%s" % (cls.__class__.__name__, tag)
+    def _contribution(cls, tr):
+        "what tr (or None) adds to the aggregates (see AggregatesJournal)"
+        return cls._counter_deltas(None, tr), cls._rollup_deltas(None, tr)
+
+    @classmethod
+    @ndb.tasklet
+    def _update_aggregates_async(cls, changes, planned=False):
+        """Apply the counter and rollup deltas of changes, pairs (old, new).
+
+        Call it inside the transaction that made the changes, planned as in
+        AggregatesLock.journal_async. It writes one entity group per counter
+        and per rollup bucket changed (see _aggregate_groups), an XG
+        transaction spans at most 25 entity groups.
+        """
+        counters, rollups = Counter(), Counter()
+        patients = set()
+        for old, new in changes:
+            counters.update(cls._counter_deltas(old, new))
+            rollups.update(cls._rollup_deltas(old, new))
+            patients.update(tr.patient for tr in (old, new) if tr is not None)
+        journal = [((old or new).key, cls._contribution(old), cls._contribution(new))
+                   for old, new in changes if old is not None or new is not None]
+        yield (CounterShard.incr_async(counters), Rollup.incr_async(rollups),
+               AggregatesLock.journal_async(cls._get_kind(), journal, planned))
+        # and the timelines of the patients involved
+        patients.discard(None)
+        # the timeline query is eventually consistent
+        ndb.get_context().call_on_commit(
+            lambda: [bump_generation(timeline_scope(p), settle=True) for p in patients])
+
+    @classmethod
+    def _update_aggregates(cls, changes):
+        cls._update_aggregates_async(changes).get_result()
+
+    @classmethod
+    def _aggregate_groups(cls, old, new, lock=None):
+        """the entity groups written by the change of old to new, with its
+        aggregates and its journal if lock, the running job, counts them"""
+        groups = set(tr.key for tr in (old, new) if tr is not None)
+        groups.add(AggregatesLock._lock_key())
+        if lock is not None:
+            groups.add(lock.journal_key(cls._get_kind(), (old or new).key))
+        for deltas in (cls._counter_deltas(old, new), cls._rollup_deltas(old, new)):
+            groups.update(name for name, delta in deltas.iteritems() if delta)
+        return groups
 
     def put(self, update=False, **ctx_options):
         @ndb.transactional(xg=True)
         def put():
 
-            if self.patient.get() is None:
+            patient = self.patient.get()
+            if patient is None:
                 raise BadValueError("Patient %r does not exist" % self.patient)
+            self.set_patient(patient)
 
             old = self.get_by_code(self.code)
-            old_tags = []
             if old:
-                old_tags = list(self.tags)
                 if not update:
                     raise BadValueError("Code %r is duplicated" % self.code)
             elif update:
                 raise BadValueError("Code %r does not exist" % self.code)
+            check_groups(self._aggregate_groups(old, self) | set([patient.key]))
 
-            return super(Transfusion, self).put(**ctx_options), old_tags
-
-        r, old_tags = put()
-        self._update_count_tags(old_tags)
+            key = super(Transfusion, self).put(**ctx_options)
+            self._update_aggregates([(old, self)])
+            return key
 
-        if not update:
-            tag = 'all'
-            self._cache.incr(self._get_cache_key(tag))
-            self.count(tag)
-
-        return r
+        return put()
 
     @classmethod
     def get_by_code(cls, *args, **kwargs):
@@ -345,47 +1441,161 @@ class Transfusion(Model):
         return result
 
     @classmethod
-    def count(cls, tag=None):
+    def count_async(cls, tag=None):
         if tag is None:
             tag = 'all'
             query = cls.query()
         elif tag in transfusion_tags:
             query = cls.query(cls.tags == tag)
         else:
-            return None
+            f = ndb.Future()
+            f.set_result(None)
+            return f
 
-        key = cls._get_cache_key(tag)
-        c = cls._cache.get(key)
-        if c is None:
-            c = query.count()
-            cls._cache.set(key=key, value=c, time=3600)
-        return c
-
-    def _update_count_tags(self, old_tags):
-        old = set(list(old_tags))
-        cur = set(list(self.tags))
-        for tag in cur - old:
-            # tag was added
-            self._cache.incr(self._get_cache_key(tag))
-            self.count(tag)
-        for tag in old - cur:
-            # tag was removed
-            self._cache.decr(self._get_cache_key(tag))
-            self.count(tag)
+        return CounterShard.get_count_async(cls._get_counter_name(tag), fallback=query)
+
+    @classmethod
+    def count(cls, tag=None):
+        return cls.count_async(tag).get_result()
+
+    @classmethod
+    def put_new_multi(cls, transfusions):
+        """Create transfusions in batch (they must not exist).
+
+        The transfusions are checked and created by chunks, each in a
+        transaction with a single change of their aggregates. Return a list
+        with the key of each created transfusion or the BadValueError that
+        prevented its creation.
+        """
+        # the patients are read once, outside the transactions: they are not
+        # written, only their search fields are copied
+        patient_keys = list(set(tr.patient for tr in transfusions))
+        patients = dict(zip(patient_keys, ndb.get_multi(patient_keys)))
+
+        lock = AggregatesLock.get_running()
+
+        def groups(tr):
+            return cls._aggregate_groups(None, tr, lock)
+
+        @ndb.tasklet
+        def create(chunk):
+            olds = yield ndb.get_multi_async([tr.key for tr in chunk])
+            new = [tr for tr, old in zip(chunk, olds) if old is None]
+            yield ndb.put_multi_async(new)
+            yield cls._update_aggregates_async([(None, tr) for tr in new], planned=lock)
+            raise ndb.Return([tr.key if old is None else
+                              BadValueError("Code %r is duplicated" % tr.code)
+                              for tr, old in zip(chunk, olds)])
+
+        ret = []
+        created = []
+        seen = set()
+        for tr in transfusions:
+            if patients[tr.patient] is None:
+                ret.append(BadValueError("Patient %r does not exist" % tr.patient))
+            elif tr.key in seen:
+                ret.append(BadValueError("Code %r is duplicated" % tr.code))
+            else:
+                ret.append(None)
+                tr.set_patient(patients[tr.patient])
+                created.append(tr)
+            seen.add(tr.key)
+
+        results = iter(transact_chunks(create, created, groups))
+        return [r or next(results) for r in ret]
+
+    @classmethod
+    def delete_multi(cls, keys):
+        """Delete transfusions in batch, return the keys that existed.
+
+        The transfusions are deleted by chunks, each read again in a
+        transaction with a single change of their aggregates.
+        """
+        keys = list(set(keys))
+        # read once to plan the chunks
+        olds = dict(zip(keys, ndb.get_multi(keys)))
+        lock = AggregatesLock.get_running()
+
+        def groups(key):
+            return set([key]) | cls._aggregate_groups(olds[key], None, lock)
+
+        @ndb.tasklet
+        def delete(chunk):
+            trs = yield ndb.get_multi_async(chunk)
+            found = [tr for tr in trs if tr is not None]
+            yield ndb.delete_multi_async([tr.key for tr in found])
+            yield cls._update_aggregates_async([(tr, None) for tr in found], planned=lock)
+            raise ndb.Return([tr and tr.key for tr in trs])
+
+        results = transact_chunks(delete, keys, groups)
+        return [key for key in results if isinstance(key, ndb.Key)]
+
+    @classmethod
+    def update_tags_multi(cls, keys, add=(), remove=()):
+        """Add and remove tags of transfusions in batch, return the keys changed.
+
+        The transfusions are changed by chunks, each read again in a
+        transaction with a single change of their aggregates.
+        """
+        def retag(tr):
+            "the tags of tr after the change, None if they do not change"
+            tags = [tag for tag in tr.tags if tag not in remove]
+            tags += [tag for tag in add if tag not in tags]
+            return tags if tags != tr.tags else None
+
+        def copy(tr, tags):
+            "what the aggregates read of tr, with tags"
+            return cls(key=tr.key, date=tr.date, local=tr.local, bags=tr.bags,
+                       tags=tags, patient=tr.patient)
+
+        keys = list(set(keys))
+        # read once to plan the chunks
+        olds = dict(zip(keys, ndb.get_multi(keys)))
+        lock = AggregatesLock.get_running()
+
+        def groups(key):
+            tr = olds[key]
+            tags = retag(tr) if tr is not None else None
+            if tags is None:
+                return set([key])
+            return cls._aggregate_groups(tr, copy(tr, tags), lock)
+
+        @ndb.tasklet
+        def update(chunk):
+            trs = yield ndb.get_multi_async(chunk)
+            changes, results = [], []
+            for tr in trs:
+                tags = retag(tr) if tr is not None else None
+                if tags is None:
+                    results.append(None)
+                    continue
+                changes.append((copy(tr, tr.tags), tr))
+                tr.tags = tags
+                results.append(tr.key)
+            yield ndb.put_multi_async([tr for _, tr in changes])
+            yield cls._update_aggregates_async(changes, planned=lock)
+            raise ndb.Return(results)
+
+        results = transact_chunks(update, keys, groups)
+        return [key for key in results if isinstance(key, ndb.Key)]
 
     @classmethod
     def build_query(cls, exact=False, code=None, patient_code=None, patient_name=None, patient_key=None, tags=None):
         filters = []
 
-        if patient_code is not None or patient_name is not None:
-            keys = Patient.build_query(name=patient_name, code=patient_code, exact=exact).fetch(keys_only=True)
-            if len(keys) == 0:
-                keys = [ndb.Key(Patient, "NonExists")]
-            filters.append(cls.patient.IN(keys))
+        terms = []
+        if code is not None:
+            terms.append(('code', code, exact))
+        if patient_name is not None:
+            terms.append(('patient.name', patient_name, exact))
+        if patient_code is not None:
+            terms.append(('patient.code', patient_code, exact))
+        if terms:
+            filters.append(search.plan(cls.search_keys, terms, cls.SEARCH_GROUPS))
+            if not SearchBackfill.done(cls._get_kind()):
+                filters.extend(cls._legacy_filters(exact, code, patient_code, patient_name))
         if patient_key:
             filters.append(cls.patient == patient_key)
-        if code is not None:
-            filters.append(cls.code == code)
 
         query = cls.query()
         if tags:
@@ -396,9 +1606,40 @@ class Transfusion(Model):
 
         return query
 
+    @classmethod
+    def _legacy_filters(cls, exact=False, code=None, patient_code=None, patient_name=None):
+        "the filters of build_query before search_keys: the code and the keys of the patients found"
+        filters = []
+        if code is not None:
+            filters.append(cls.code == code)
+        if patient_code is not None or patient_name is not None:
+            keys = Patient.build_query(name=patient_name, code=patient_code,
+                                       exact=exact).fetch(keys_only=True)
+            if keys:
+                filters.append(cls.patient.IN(keys))
+        return filters
+
+    @classmethod
+    def build_date_query(cls, start=None, end=None, tags=None):
+        "transfusions between the dates start and end (inclusive), sorted by date"
+        query = cls.query()
+        if start is not None:
+            query = query.filter(cls.date >= start)
+        if end is not None:
+            query = query.filter(cls.date <= end)
+        if tags:
+            query = query.filter(cls.tags.IN(tags))
+        return query.order(cls.date, cls.key)
+
+    @classmethod
+    def build_timeline_query(cls, patient_key):
+        "transfusions of a patient by date (see timeline_scope)"
+        return cls.query(cls.patient == patient_key).order(cls.date, cls.key)
+
     def delete(self):
-        tags = self.tags
-        self.key.delete()
-        for tag in tags + ['all']:
-            self._cache.decr(self._get_cache_key(tag))
-            self.count(tag)
+        @ndb.transactional(xg=True)
+        def delete():
+            old = self.key.get()
+            self.key.delete()
+            self._update_aggregates([(old, None)])
+        delete()
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Iuri Gomes Diniz
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Created on 18/10/2026
+
+Request profiling: wall time plus the count and latency of the datastore and
+memcache RPCs of a request.
+
+RPCs are timed by apiproxy hooks (every ndb and memcache call goes through
+them) but only while a profiled request runs in the thread. A request is
+profiled if it is sampled (SAMPLE_RATE) or if an admin asks for it with the
+header X-Mejcrt-Profile or the argument _profile. A profile ends when the
+server closes the response, after a streamed body. Each profile is logged as
+one JSON line and added to per-endpoint totals in memcache, which admins
+can rank with GET /api/v1/admin/profile.
+
+@author: Iuri Diniz <iuridiniz@gmail.com>
+'''
+
+from collections import Counter
+from contextlib import contextmanager
+import json
+import logging
+import random
+import threading
+import time
+import urlparse
+
+from google.appengine.api import apiproxy_stub_map, memcache
+from werkzeug.exceptions import HTTPException
+
+from .models import UserPrefs
+
+# fraction of the requests profiled without being asked
+SAMPLE_RATE = 0.0
+
+HEADER = 'HTTP_X_MEJCRT_PROFILE'
+ARGUMENT = '_profile'
+
+DATASTORE_CALLS = {'Get': 'datastore.get',
+                   'Put': 'datastore.put',
+                   'Delete': 'datastore.delete',
+                   'RunQuery': 'datastore.query',
+                   'Next': 'datastore.query'}
+CATEGORIES = ('datastore.get', 'datastore.put', 'datastore.delete',
+              'datastore.query', 'datastore.other', 'memcache', 'other')
+
+ENDPOINTS_KEY = 'profile.endpoints'
+METRIC_KEY = 'profile.%s.%s'
+METRICS = ['requests', 'wall_ms'] + \
+    ['%s.%s' % (category, name) for category in CATEGORIES for name in ('count', 'ms')]
+
+_local = threading.local()
+_cache = memcache.Client()
+
+def category(service, call):
+    if service == 'datastore_v3':
+        return DATASTORE_CALLS.get(call, 'datastore.other')
+    if service == 'memcache':
+        return 'memcache'
+    return 'other'
+
+class Profile(object):
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.time()
+        self.wall = None
+        self.counts = Counter()
+        self.latency = Counter()
+        self._pending = {}
+
+    def rpc_started(self, rpc):
+        self._pending[id(rpc)] = time.time()
+
+    def rpc_finished(self, rpc, service, call):
+        started = self._pending.pop(id(rpc), None)
+        name = category(service, call)
+        self.counts[name] += 1
+        if started is not None:
+            self.latency[name] += time.time() - started
+
+    def stop(self):
+        self.wall = time.time() - self.started
+
+    def to_dict(self):
+        return dict(endpoint=self.endpoint,
+                    wall_ms=int(self.wall * 1000),
+                    rpcs=dict((name, dict(count=self.counts[name],
+                                          ms=int(self.latency[name] * 1000)))
+                              for name in self.counts))
+
+def _pre_call_hook(service, call, request, response, rpc):
+    profile = getattr(_local, 'profile', None)
+    if profile is not None:
+        profile.rpc_started(rpc)
+
+def _post_call_hook(service, call, request, response, rpc, error):
+    profile = getattr(_local, 'profile', None)
+    if profile is not None:
+        profile.rpc_finished(rpc, service, call)
+
+def install_hooks():
+    "register the RPC hooks in the current apiproxy (a no-op if already there)"
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('mejcrt.profiling', _pre_call_hook)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('mejcrt.profiling', _post_call_hook)
+
+@contextmanager
+def profiled(endpoint):
+    "profile the RPCs made by the thread inside the block"
+    # the apiproxy may be replaced (e.g. by testbed), check it every time
+    install_hooks()
+    profile = _local.profile = Profile(endpoint)
+    try:
+        yield profile
+    finally:
+        _local.profile = None
+        profile.stop()
+
+def record(profile):
+    "log profile and add it to the totals of its endpoint"
+    data = profile.to_dict()
+    logging.info(json.dumps(dict(profile=data), sort_keys=True))
+
+    deltas = {METRIC_KEY % (profile.endpoint, 'requests'): 1,
+              METRIC_KEY % (profile.endpoint, 'wall_ms'): data['wall_ms']}
+    for name, rpc in data['rpcs'].iteritems():
+        deltas[METRIC_KEY % (profile.endpoint, '%s.count' % name)] = rpc['count']
+        deltas[METRIC_KEY % (profile.endpoint, '%s.ms' % name)] = rpc['ms']
+    _cache.offset_multi(deltas, initial_value=0)
+
+    # the set of endpoints, a lost update only delays an endpoint to its next profile
+    endpoints = _cache.get(ENDPOINTS_KEY) or set()
+    if profile.endpoint not in endpoints:
+        endpoints.add(profile.endpoint)
+        _cache.set(ENDPOINTS_KEY, endpoints)
+
+def _record_logged(profile):
+    "record profile, a failure is only logged (it must not fail the request)"
+    try:
+        record(profile)
+    except Exception as e:
+        logging.error("Cannot record profile %r: %r" % (profile.endpoint, e))
+
+class ProfiledBody(object):
+    """The response iterable of a profiled request.
+
+    A streamed body makes RPCs while the server iterates it, they are added
+    to the profile, which is stopped and recorded when the server closes it.
+    """
+    def __init__(self, body, profile):
+        self.body = body
+        self.profile = profile
+
+    def __iter__(self):
+        body = iter(self.body)
+        while True:
+            _local.profile = self.profile
+            try:
+                chunk = next(body)
+            except StopIteration:
+                return
+            finally:
+                _local.profile = None
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.profile.stop()
+            _record_logged(self.profile)
+
+def ranking():
+    "totals of the profiled endpoints, the slowest (total wall time) first"
+    endpoints = sorted(_cache.get(ENDPOINTS_KEY) or set())
+    found = _cache.get_multi([METRIC_KEY % (endpoint, metric)
+                              for endpoint in endpoints for metric in METRICS])
+    ret = []
+    for endpoint in endpoints:
+        totals = dict((metric, int(found.get(METRIC_KEY % (endpoint, metric), 0)))
+                      for metric in METRICS)
+        requests = totals['requests'] or 1
+        ret.append(dict(endpoint=endpoint,
+                        requests=totals['requests'],
+                        wall_ms=totals['wall_ms'],
+                        avg_wall_ms=totals['wall_ms'] / requests,
+                        rpcs=dict((category, dict(count=totals['%s.count' % category],
+                                                  ms=totals['%s.ms' % category],
+                                                  avg_count=float(totals['%s.count' % category]) / requests))
+                                  for category in CATEGORIES
+                                  if totals['%s.count' % category])))
+    ret.sort(key=lambda e: e['wall_ms'], reverse=True)
+    return ret
+
+def reset():
+    endpoints = _cache.get(ENDPOINTS_KEY) or set()
+    _cache.delete_multi([METRIC_KEY % (endpoint, metric)
+                         for endpoint in endpoints for metric in METRICS] + [ENDPOINTS_KEY])
+
+class ProfilingMiddleware(object):
+    "WSGI middleware that profiles the sampled or requested requests of app"
+    def __init__(self, wsgi_app, url_map, sample_rate=None):
+        self.wsgi_app = wsgi_app
+        self.url_map = url_map
+        self.sample_rate = sample_rate
+
+    def _wanted(self, environ):
+        rate = SAMPLE_RATE if self.sample_rate is None else self.sample_rate
+        if rate and random.random() < rate:
+            return True
+        asked = environ.get(HEADER) or \
+            ARGUMENT in urlparse.parse_qs(environ.get('QUERY_STRING', ''),
+                                          keep_blank_values=True)
+        if not asked:
+            return False
+        # the admins of require_admin, from the authorization cache
+        authz = UserPrefs.get_current_authz()
+        return authz is not None and authz[0] is not False and bool(authz[1])
+
+    def _endpoint(self, environ):
+        try:
+            endpoint, _ = self.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            endpoint = environ.get('PATH_INFO', '')
+        return '%s %s' % (environ.get('REQUEST_METHOD'), endpoint)
+
+    def __call__(self, environ, start_response):
+        if not self._wanted(environ):
+            return self.wsgi_app(environ, start_response)
+
+        with profiled(self._endpoint(environ)) as profile:
+            body = self.wsgi_app(environ, start_response)
+        return ProfiledBody(body, profile)
@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Iuri Gomes Diniz
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Created on 18/10/2026
+
+Rebuild of the aggregates (the Patient count, the Transfusion tag counters
+and the rollups) from the entities themselves.
+
+A job splits each kind in key ranges (shards). Every shard walks its range
+with a cursor, in batches, and saves the cursor and its partial aggregates
+after each batch, so it can be stopped at any time (task deadline, error)
+and resumed. When the last shard is done the totals replace the stored
+counters and rollups.
+
+The aggregates still change meanwhile: a job holds the AggregatesLock from
+its start to its end, and the writes that change an aggregate (creating,
+deleting or retagging a transfusion, creating or deleting a patient) record
+their changes in the AggregatesJournal of the shard of each entity, which the
+totals include. Only while the totals replace the aggregates those writes
+fail with AggregatesLocked (the API answers 503, try again later). An
+abandoned job must be aborted to unlock the aggregates for another one.
+
+The counters are counted from the datastore until a job seeds them, run one
+after deploying a version that adds or changes an aggregate.
+
+A job with backfill also re-puts every entity it reads, each one in its own
+transaction, so the fields computed or copied on put are stored for the
+entities written before those fields existed. Entities stored before
+search_keys (Patient, Transfusion and UserPrefs) or Transfusion.patient_name
+are not found by a search until then: run one with backfill after deploying
+a version that adds such a field. A job with backfill but without aggregate
+only re-puts, it does not take the AggregatesLock. Until a job with backfill finishes, the
+searches also run their filters before search_keys (see SearchBackfill).
+The backfill also moves the 'logs' entries kept by the entities before
+AuditEvent to their history.
+
+Run it with the task queue (see controllers/admin.py) or locally against a
+datastore file of the development server:
+
+    python -m mejcrt.rebuild --app-id dev~mejc-rt path/to/datastore.db
+
+@author: Iuri Diniz <iuridiniz@gmail.com>
+'''
+
+from collections import Counter
+import argparse
+import time
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from .models import AggregatesJournal, AggregatesLock, AuditedModel, CounterShard, \
+    Patient, Rollup, SearchBackfill, Transfusion, UserPrefs, transfusion_tags, \
+    transact_multi_async
+
+BATCH = 200
+DEFAULT_SHARDS = 4
+# keys sampled per shard to choose the split points
+OVERSAMPLE = 32
+
+# the models of the aggregated kinds, each one with its _contribution
+AGGREGATED = {Patient._get_kind(): Patient,
+              Transfusion._get_kind(): Transfusion}
+# kinds with search_keys, only read by the jobs with backfill
+BACKFILL_ONLY = [UserPrefs._get_kind()]
+
+class RebuildJob(ndb.Model):
+    created_at = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    started = ndb.FloatProperty(required=True, indexed=False)
+    finished = ndb.FloatProperty(indexed=False)
+    aborted = ndb.BooleanProperty(default=False, indexed=False)
+    shards = ndb.KeyProperty(repeated=True, indexed=False)
+
+    def report(self):
+        "progress of the job and its throughput (entities/sec)"
+        shards = [shard for shard in ndb.get_multi(self.shards) if shard]
+        processed = sum(shard.processed for shard in shards)
+        elapsed = (self.finished or time.time()) - self.started
+        return dict(job=self.key.id(),
+                    done=self.finished is not None,
+                    aborted=self.aborted,
+                    shards=len(shards),
+                    shards_done=len([shard for shard in shards if shard.done]),
+                    processed=processed,
+                    elapsed=elapsed,
+                    throughput=processed / elapsed if elapsed else None)
+
+class RebuildShard(ndb.Model):
+    "a key range of kind, with the aggregates of the entities already read"
+    job = ndb.KeyProperty(RebuildJob, required=True, indexed=False)
+    kind = ndb.StringProperty(required=True, indexed=False)
+    backfill = ndb.BooleanProperty(default=False, indexed=False)
+    # the changes while the shard counts, None if it does not
+    journal = ndb.KeyProperty(AggregatesJournal, indexed=False)
+    start = ndb.KeyProperty(indexed=False)
+    end = ndb.KeyProperty(indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+    processed = ndb.IntegerProperty(default=0, indexed=False)
+    counters = ndb.PickleProperty(compressed=True)
+    rollups = ndb.PickleProperty(compressed=True)
+
+    def build_query(self):
+        model = ndb.Model._lookup_model(self.kind)
+        query = model.query()
+        if self.start is not None:
+            query = query.filter(model.key >= self.start)
+        if self.end is not None:
+            query = query.filter(model.key < self.end)
+        return query.order(model.key)
+
+def split(kind, shards):
+    """Return at most shards key ranges (start, end) that cover kind.
+
+    Split points come from a sample of keys ordered by __scatter__ (the
+    datastore sets it on a random subset of entities); if the kind has too
+    few scattered entities the first keys are used, which is still correct
+    but balanced only for small kinds.
+    """
+    model = ndb.Model._lookup_model(kind)
+    size = shards * OVERSAMPLE
+    keys = model.query().order(ndb.GenericProperty('__scatter__')).fetch(size, keys_only=True)
+    if len(keys) < shards:
+        keys = model.query().fetch(size, keys_only=True)
+    keys.sort()
+
+    points = []
+    for n in xrange(1, shards):
+        key = keys[len(keys) * n / shards] if keys else None
+        if key is not None and key not in points:
+            points.append(key)
+    bounds = [None] + points + [None]
+    return zip(bounds[:-1], bounds[1:])
+
+@ndb.tasklet
+def backfill_async(entities):
+    """re-put entities, each one read again in its own transaction, without
+    their legacy logs (stored as AuditEvents before)"""
+    patient_keys = list(set(e.patient for e in entities if isinstance(e, Transfusion)))
+    patients = yield ndb.get_multi_async(patient_keys)
+    patients = dict(zip(patient_keys, patients))
+    # the events keep their ids, a resumed batch stores them again
+    events = [event for e in entities if isinstance(e, AuditedModel)
+              for event in e.pop_legacy_logs()]
+    yield ndb.put_multi_async(events)
+
+    @ndb.tasklet
+    def refresh(key):
+        entity = yield key.get_async()
+        if entity is None:
+            return
+        if isinstance(entity, Transfusion) and patients.get(entity.patient):
+            entity.set_patient(patients[entity.patient])
+        if isinstance(entity, AuditedModel):
+            entity.pop_legacy_logs()
+        yield entity.put_async()
+
+    yield transact_multi_async(refresh, [e.key for e in entities])
+
+def start(shards=DEFAULT_SHARDS, kinds=None, backfill=False, aggregate=True):
+    """Create a job with up to shards shards per kind, return it.
+
+    Only a job with aggregate counts the aggregated kinds (and takes the
+    AggregatesLock), raise ValueError if it would do nothing.
+    """
+    if not (aggregate or backfill):
+        raise ValueError("A job must aggregate or backfill")
+    kinds = kinds or sorted(AGGREGATED) + (BACKFILL_ONLY if backfill else [])
+    job_id, _ = RebuildJob.allocate_ids(1)
+    job_key = ndb.Key(RebuildJob, job_id)
+    states, journals = [], []
+    for kind in kinds:
+        counted = aggregate and kind in AGGREGATED
+        for n, (start_key, end_key) in enumerate(split(kind, shards)):
+            shard_id = '%s.%s.%d' % (job_id, kind, n)
+            journal = None
+            if counted:
+                journals.append(AggregatesJournal(id=shard_id, kind=kind, counters=Counter(),
+                                                  rollups=Counter(), pending={}))
+                journal = journals[-1].key
+            states.append(RebuildShard(id=shard_id, job=job_key, kind=kind, start=start_key,
+                                       end=end_key, backfill=backfill, journal=journal,
+                                       counters=Counter(), rollups=Counter()))
+    if journals:
+        # the writes read the journals once the lock exists
+        ndb.put_multi(journals)
+        # raises AggregatesLocked while another job runs
+        AggregatesLock.acquire(job_id, [(state.kind, state.start, state.end, state.journal)
+                                        for state in states if state.journal])
+    job = RebuildJob(key=job_key, started=time.time())
+    job.put()
+    job.shards = ndb.put_multi(states)
+    job.put()
+    return job
+
+@ndb.tasklet
+def process_shard_async(shard_key, deadline=None):
+    """Read batches of the shard until it is done or deadline (a time.time()),
+    at least one.
+
+    Return the shard, shard.done tells if it must be resumed, or None if its
+    job was aborted.
+    """
+    shard = yield shard_key.get_async()
+    job = yield shard.job.get_async()
+    if job.aborted:
+        raise ndb.Return(None)
+    model = AGGREGATED[shard.kind] if shard.journal else None
+    query = shard.build_query()
+    while not shard.done:
+        if model is not None:
+            # the changes of the batch read now are kept apart (see
+            # AggregatesJournal.resolve)
+            yield _start_reading_async(shard.journal)
+        cursor = shard.cursor and Cursor(urlsafe=shard.cursor)
+        keys, cursor, more = yield query.fetch_page_async(
+            BATCH, start_cursor=cursor, keys_only=True)
+        # the entities as they are now, the index may be behind
+        entities = yield ndb.get_multi_async(keys, use_cache=False, use_memcache=False)
+        entities = [entity for entity in entities if entity is not None]
+        read = {}
+        if model is not None:
+            read = dict((entity.key, model._contribution(entity)) for entity in entities)
+        if shard.backfill:
+            yield backfill_async(entities)
+        shard = yield ndb.transaction_async(
+            lambda: _save_batch_async(shard, keys, cursor, more, len(entities), read),
+            xg=True)
+        if deadline is not None and time.time() >= deadline:
+            break
+    raise ndb.Return(shard)
+
+@ndb.tasklet
+def _start_reading_async(journal_key):
+    @ndb.tasklet
+    def start():
+        journal = yield journal_key.get_async()
+        if not journal.reading:
+            journal.reading = True
+            yield journal.put_async()
+    yield ndb.transaction_async(start)
+
+@ndb.tasklet
+def _save_batch_async(shard, keys, cursor, more, processed, read):
+    """Save the batch of keys read from shard (as it was before the batch),
+    processed entities found, read their contributions if the shard counts
+    them, in a transaction. Return the shard saved.
+
+    The cursor, the aggregates and the journal are saved together, a resumed
+    shard never counts an entity twice. A concurrent run of the shard (a task
+    run twice) that saved the batch first wins, its state is returned.
+    """
+    state = yield shard.key.get_async()
+    if state.cursor != shard.cursor or state.done:
+        raise ndb.Return(state)
+    for counters, rollups in read.itervalues():
+        state.counters.update(counters)
+        state.rollups.update(rollups)
+    state.processed += processed
+    state.cursor = cursor.urlsafe() if cursor else None
+    state.done = not more or cursor is None
+    writes = [state]
+    if state.journal:
+        journal = yield state.journal.get_async()
+        journal.resolve(keys[-1] if keys else None, state.done, read)
+        writes.append(journal)
+    yield ndb.put_multi_async(writes)
+    raise ndb.Return(state)
+
+def finish(job_key):
+    """Replace the aggregates by the totals of the job, then mark it finished
+    and unlock the aggregates, once.
+
+    Return False while some shard is not done.
+    """
+    job = job_key.get()
+    shards = ndb.get_multi(job.shards)
+    if job.finished is not None or not all(shard.done for shard in shards):
+        return False
+
+    # from now to the claim the changes of the aggregates wait, the
+    # journals do not change anymore
+    AggregatesLock.freeze(job_key.id())
+    journals = ndb.get_multi([shard.journal for shard in shards if shard.journal])
+    counters, rollups = Counter(), Counter()
+    for state in shards + journals:
+        counters.update(state.counters)
+        rollups.update(state.rollups)
+
+    # the replacements are idempotent, a finish that fails is run again by
+    # its task and two concurrent ones write the same totals
+    kinds = set(shard.kind for shard in shards if shard.journal)
+    names = []
+    if Patient._get_kind() in kinds:
+        names.append(Patient.COUNT_KEY)
+    if Transfusion._get_kind() in kinds:
+        names.extend(Transfusion._get_counter_name(tag)
+                     for tag in transfusion_tags + ('all',))
+        Rollup.reset(rollups)
+    for name in names:
+        CounterShard.reset(name, counters[name])
+    # their searches stop running the filters before search_keys
+    SearchBackfill.mark(set(shard.kind for shard in shards if shard.backfill))
+
+    @ndb.transactional(xg=True)
+    def claim():
+        job = job_key.get()
+        if job.finished is not None:
+            return False
+        job.finished = time.time()
+        job.put()
+        AggregatesLock.release(job_key.id())
+        return True
+    return claim()
+
+def abort(job_key):
+    "stop counting on the job and unlock the aggregates, return False if it was over"
+    @ndb.transactional(xg=True)
+    def abort():
+        job = job_key.get()
+        if job is None or job.finished is not None:
+            return False
+        job.finished, job.aborted = time.time(), True
+        job.put()
+        AggregatesLock.release(job_key.id())
+        return True
+    return abort()
+
+def run(shards=DEFAULT_SHARDS, kinds=None, backfill=False, aggregate=True):
+    "run a whole job in this process, the shards concurrently, return its report"
+    job = start(shards, kinds, backfill, aggregate)
+    futures = [process_shard_async(key) for key in job.shards]
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        future.get_result()
+    finish(job.key)
+    return job.key.get().report()
+
+def main(argv=None):
+    from google.appengine.ext import testbed
+
+    parser = argparse.ArgumentParser(description="Rebuild counters and rollups")
+    parser.add_argument('datastore', help="datastore file of the development server")
+    parser.add_argument('--app-id', default='dev~mejc-rt')
+    parser.add_argument('--sqlite', action='store_true', help="the file is a sqlite datastore")
+    parser.add_argument('--shards', type=int, default=DEFAULT_SHARDS)
+    parser.add_argument('--backfill', action='store_true',
+                        help="also re-put the entities (see the module documentation)")
+    parser.add_argument('--no-aggregate', dest='aggregate', action='store_false',
+                        help="only re-put the entities, with --backfill")
+    args = parser.parse_args(argv)
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id=args.app_id, overwrite=True)
+    if args.sqlite:
+        bed.init_datastore_v3_stub(datastore_file=args.datastore, use_sqlite=True)
+    else:
+        bed.init_datastore_v3_stub(datastore_file=args.datastore, save_changes=True)
+    bed.init_memcache_stub()
+    try:
+        report = run(args.shards, backfill=args.backfill, aggregate=args.aggregate)
+    finally:
+        bed.deactivate()
+    print "%d entities in %d shards, %.2fs (%.1f entities/sec)" % (
+        report['processed'], report['shards'], report['elapsed'],
+        report['throughput'] or 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Iuri Gomes Diniz
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Created on 18/10/2026
+
+Prefix search over a repeated indexed property (the postings).
+
+A text is indexed by the edge n-grams of each word plus the prefixes of
+the phrase that starts at each word, so the number of tokens is linear on
+the text length. A multi-word query is answered by intersecting the
+postings of its words: equality filters on the same property, merged by
+the datastore in a single query.
+
+All searchable fields of a model share one property, each key prefixed by
+its field (or by a group of fields searched together), see index_keys and
+plan.
+
+@author: Iuri Diniz <iuridiniz@gmail.com>
+'''
+
+from google.appengine.ext import ndb
+
+from .util import iconv, iter_tokens
+
+MINIMUM = 4
+MAXIMUM = 16
+
+def normalize(text):
+    "lowercase, without accents and with single spaces"
+    return ' '.join(iconv(text).lower().split())
+
+def index_tokens(text, minimum=MINIMUM, maximum=MAXIMUM):
+    text = normalize(text)
+    # whole text and short words, used to match complete names or codes
+    tokens = set([text])
+    tokens.update(word for word in text.split() if len(word) < minimum)
+    # edge n-grams and the ordered word-prefix of the phrase at each word
+    tokens.update(iter_tokens(text, minimum, maximum, combine=False))
+    return tokens
+
+def query_tokens(text, minimum=MINIMUM, maximum=MAXIMUM):
+    "tokens whose postings must be intersected to answer text"
+    words = normalize(text).split()
+    tokens = [word[:maximum] for word in words]
+    if len(words) > 1 and len(words[-1]) < minimum:
+        # last word is probably incomplete, search it with the previous one
+        phrase = ' '.join(words[-2:])
+        if len(phrase) <= maximum:
+            tokens[-2:] = [phrase]
+
+    ret = []
+    for token in tokens:
+        if token not in ret:
+            ret.append(token)
+    return ret
+
+def search_key(field, token, exact=False):
+    "a token of field, exact ones are whole normalized values"
+    return '%s%s%s' % (field, '=' if exact else ':', token)
+
+def group_name(group):
+    return '+'.join(group)
+
+def index_keys(values, groups=(), minimum=MINIMUM, maximum=MAXIMUM):
+    """Search keys of values, a dict {field: text} (None texts are ignored).
+
+    Every field has its own keys and every group, a tuple of fields, has the
+    keys of all its fields, so a search on all fields of a group is a single
+    query (see plan). The keys of a group are a copy of those of its fields,
+    declare only the groups that are searched.
+    """
+    tokens = {}
+    for field, text in values.iteritems():
+        if text is not None:
+            tokens[field] = (index_tokens(text, minimum, maximum), normalize(text))
+
+    keys = set()
+    for fields in [(field,) for field in tokens] + list(groups):
+        name = group_name(fields)
+        for field in fields:
+            if field in tokens:
+                prefixes, value = tokens[field]
+                keys.update(search_key(name, token) for token in prefixes)
+                keys.add(search_key(name, value, exact=True))
+    return sorted(keys)
+
+def _branch(prop, field, text, exact, minimum, maximum):
+    if exact:
+        return prop == search_key(field, normalize(text), exact=True)
+    tokens = query_tokens(text, minimum, maximum) or [normalize(text)]
+    return ndb.AND(*[prop == search_key(field, token) for token in tokens])
+
+def plan(prop, terms, groups=(), minimum=MINIMUM, maximum=MAXIMUM):
+    """Cheapest filter for entities matching any of terms.
+
+    terms is a list of tuples (field, text, exact) and prop must be filled by
+    index_keys with the same groups. Terms that cover all fields of a group
+    with the same text are answered by the group keys, one equality query,
+    the remaining ones are joined by ndb.OR (one query per branch).
+
+    A text of many words is not searched on a group: its words could match
+    different fields of the group.
+    """
+    def single(text, exact):
+        return exact or len(query_tokens(text, minimum, maximum)) <= 1
+
+    terms = [(field, text, bool(exact)) for field, text, exact in terms]
+    branches = []
+    for group in sorted(groups, key=len, reverse=True):
+        selected = [term for term in terms if term[0] in group]
+        if (len(selected) == len(group) and
+                len(set(term[1:] for term in selected)) == 1 and
+                single(*selected[0][1:])):
+            terms = [term for term in terms if term not in selected]
+            branches.append((group_name(group),) + selected[0][1:])
+    branches.extend(terms)
+
+    nodes = [_branch(prop, field, text, exact, minimum, maximum)
+             for field, text, exact in branches]
+    if len(nodes) == 1:
+        return nodes[0]
+    return ndb.OR(*nodes)
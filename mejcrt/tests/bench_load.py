@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 18/10/2026
+
+Load benchmark of the API against the App Engine testbed stubs.
+
+It generates a dataset (written in batches, like the import endpoints) and
+drives the Flask test client through the list, search, stats, create and
+update endpoints, then reports the latency percentiles and the datastore and
+memcache RPCs per request of each endpoint.
+
+Run it with (see tests.txt for the PYTHONPATH):
+
+    python -m mejcrt.tests.bench_load --transfusions 10000 --requests 50
+
+--compare-page adds the read path of /api/v1/transfusion?max=50 run step by
+step (as before the tasklet pipeline) and pipelined, from a cold cache. The
+stubs answer in process, the overlap of RPCs shows better against the
+datastore emulator or production.
+
+No comparison figures are recorded yet: the bench has not been run where
+the SDK and the datastore emulator are installed. Record them here, with
+the dataset size and where it ran, as the serial and pipelined rows of
+
+    python -m mejcrt.tests.bench_load --transfusions 10000 --requests 50 \
+        --compare-page
+
+Everything is kept in memory, 1M transfusions need some GBs of RAM.
+
+@author: Iuri Diniz <iuridiniz@gmail.com>
+'''
+
+import argparse
+from collections import OrderedDict
+import datetime
+from itertools import count
+import json
+import math
+import random
+import sys
+import time
+
+from google.appengine.api import memcache
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb, testbed
+
+from .. import models, profiling, rebuild
+from ..cache import count_query, count_query_async, COUNT_APPROX
+from .bench_tokenize import random_name
+
+ADMIN_USERID = "666"
+FIRST_CODE = 100000
+
+def setup_testbed():
+    tb = testbed.Testbed()
+    tb.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    tb.init_datastore_v3_stub(consistency_policy=policy)
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub()
+    tb.setup_env(user_email="admin@admin.com", user_id=ADMIN_USERID,
+                 user_is_admin='1', overwrite=True)
+    models.UserPrefs(id=ADMIN_USERID, name='admin', email="admin@admin.com",
+                     admin=True, authorized=True).put()
+    # every entity is written with its search keys
+    models.SearchBackfill.mark([models.Patient._get_kind(), models.Transfusion._get_kind(),
+                                models.UserPrefs._get_kind()])
+    return tb
+
+def random_transfusion(rnd, code, patient_key, today):
+    tr = models.Transfusion(id=str(code))
+    tr.patient = patient_key
+    tr.date = today - datetime.timedelta(days=rnd.randint(0, 3 * 365))
+    tr.local = rnd.choice(models.valid_locals)
+    tr.text = u'bench'
+    tr.bags = [models.BloodBag(type_=rnd.choice(models.blood_types),
+                               content=rnd.choice(models.blood_contents))
+               for _ in range(rnd.randint(1, 3))]
+    tr.tags = [rnd.choice(models.transfusion_tags)]
+    return tr
+
+def generate(transfusions, patients=None, batch=500, seed=42):
+    """Create patients and transfusions in batches of batch entities.
+
+    The batches are plain puts, without the per chunk transactions of the
+    import endpoints: a rebuild job then seeds the counters and rollups.
+    Return the keys of the patients and of the transfusions.
+    """
+    rnd = random.Random(seed)
+    code = count(FIRST_CODE)
+    patients = patients or max(1, transfusions / 5)
+    today = datetime.date.today()
+
+    patient_keys, by_key = [], {}
+    while len(patient_keys) < patients:
+        ps = []
+        for _ in xrange(min(batch, patients - len(patient_keys))):
+            p = models.Patient(id=str(code.next()))
+            p.name = random_name(rnd, rnd.randint(2, 6))
+            p.blood_type = rnd.choice(models.blood_types)
+            p.type_ = rnd.choice(models.patient_types)
+            ps.append(p)
+        patient_keys.extend(ndb.put_multi(ps))
+        by_key.update((p.key, p) for p in ps)
+
+    transfusion_keys = []
+    while len(transfusion_keys) < transfusions:
+        trs = [random_transfusion(rnd, code.next(), rnd.choice(patient_keys), today)
+               for _ in xrange(min(batch, transfusions - len(transfusion_keys)))]
+        for tr in trs:
+            tr.set_patient(by_key[tr.patient])
+        transfusion_keys.extend(ndb.put_multi(trs))
+        ndb.get_context().clear_cache()
+
+    rebuild.run()
+    ndb.get_context().clear_cache()
+    return patient_keys, transfusion_keys
+
+def percentile(values, p):
+    "nearest-rank percentile of sorted values"
+    if not values:
+        return 0.0
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+class Scenarios(object):
+    "requests of each benchmarked endpoint: (method, url, json body or None)"
+    def __init__(self, patient_keys, transfusion_keys, seed=42):
+        self.rnd = random.Random(seed)
+        self.patient_keys = patient_keys
+        self.transfusion_keys = transfusion_keys
+        self.codes = count(FIRST_CODE + len(patient_keys) + len(transfusion_keys))
+
+    def _patient(self):
+        return self.rnd.choice(self.patient_keys).get()
+
+    def transfusion_page(self):
+        return 'GET', '/api/v1/transfusion?max=50', None
+
+    def transfusion_list(self):
+        tag = self.rnd.choice(models.transfusion_tags)
+        return 'GET', '/api/v1/transfusion?max=20&tags=%s' % tag, None
+
+    def transfusion_search(self):
+        word = self._patient().name.split()[0]
+        return 'GET', '/api/v1/transfusion?max=20&fields=patient.name&q=%s' % word, None
+
+    def patient_list(self):
+        return 'GET', '/api/v1/patient/?max=20&offset=%d' % self.rnd.randint(0, 100), None
+
+    def patient_search(self):
+        word = self._patient().name.split()[-1]
+        return 'GET', '/api/v1/patient/?max=20&q=%s' % word, None
+
+    def transfusion_stats(self):
+        return 'GET', '/api/v1/transfusion/stats?tags=%s' % ','.join(models.transfusion_tags), None
+
+    def patient_stats(self):
+        return 'GET', '/api/v1/patient/stats', None
+
+    def transfusion_create(self):
+        data = {u'bags': [{u'content': self.rnd.choice(models.blood_contents),
+                           u'type': self.rnd.choice(models.blood_types)}],
+                u'date': datetime.date.today().isoformat(),
+                u'local': self.rnd.choice(models.valid_locals),
+                u'patient': dict(key=self.rnd.choice(self.patient_keys).urlsafe()),
+                u'code': unicode(self.codes.next()),
+                u'tags': [self.rnd.choice(models.transfusion_tags)],
+                u'text': u'bench'}
+        return 'POST', '/api/v1/transfusion', data
+
+    def transfusion_update(self):
+        tr = self.rnd.choice(self.transfusion_keys).get()
+        data = tr.to_dict()
+        data['tags'] = [self.rnd.choice(models.transfusion_tags)]
+        return 'PUT', '/api/v1/transfusion', data
+
+    ALL = ('transfusion_page', 'transfusion_list', 'transfusion_search', 'patient_list', 'patient_search',
+           'transfusion_stats', 'patient_stats', 'transfusion_create', 'transfusion_update')
+
+def drive(client, scenarios, requests=50, names=Scenarios.ALL):
+    """Make requests requests of each scenario in names.
+
+    Return {name: [(seconds, status, {rpc category: count}), ...]}.
+    """
+    results = OrderedDict()
+    for name in names:
+        for _ in xrange(requests):
+            method, url, data = getattr(scenarios, name)()
+            kwargs = {}
+            if data is not None:
+                kwargs = dict(data=json.dumps(data), content_type='application/json')
+            with profiling.profiled(name) as profile:
+                rv = client.open(url, method=method, **kwargs)
+            results.setdefault(name, []).append((profile.wall, rv.status_code, dict(profile.counts)))
+    return results
+
+def serial_page(max_=50):
+    "the read path of /api/v1/transfusion?max=50, each step waiting the last"
+    from ..controllers.patient import _fetch_page
+    query = models.Transfusion.query()
+    objs, _, _, _ = _fetch_page(query, max_, 0, None, {}).get_result()
+    data = models.Model.to_dict_multi(objs)
+    count = count_query(query, COUNT_APPROX)
+    total = models.Transfusion.count()
+    return data, count, total
+
+def pipelined_page(max_=50):
+    "the same read path as the paginator runs it, all its RPCs started at once"
+    from ..controllers.patient import _fetch_page_async
+    query = models.Transfusion.query()
+    total = models.Transfusion.count_async()
+    page = _fetch_page_async(query, max_, 0, None, {})
+    count = count_query_async(query, COUNT_APPROX)
+    return page.get_result()[0], count.get_result(), total.get_result()
+
+def compare_page(requests=50, max_=50):
+    """Time serial_page (before the tasklet pipeline) and pipelined_page
+    (after) from a cold cache, results like drive."""
+    results = OrderedDict()
+    for name, read in (('page%d serial' % max_, serial_page),
+                       ('page%d pipelined' % max_, pipelined_page)):
+        for _ in xrange(requests):
+            memcache.flush_all()
+            ndb.get_context().clear_cache()
+            with profiling.profiled(name) as profile:
+                read(max_)
+            results.setdefault(name, []).append((profile.wall, 200, dict(profile.counts)))
+    return results
+
+def report(results, out=sys.stdout):
+    categories = [c for c in profiling.CATEGORIES
+                  if any(c in counts for runs in results.values() for _, _, counts in runs)]
+    header = "%-20s %5s %5s %8s %8s %8s %8s %8s" % ('endpoint', 'n', 'err', 'p50 ms',
+                                                    'p90 ms', 'p95 ms', 'p99 ms', 'max ms')
+    out.write(header + ''.join(" %16s" % c for c in categories) + '\n')
+    for name, runs in results.iteritems():
+        walls = sorted(wall * 1000 for wall, _, _ in runs)
+        errors = sum(1 for _, status, _ in runs if status != 200)
+        line = "%-20s %5d %5d %8.1f %8.1f %8.1f %8.1f %8.1f" % (
+            name, len(runs), errors, percentile(walls, 50), percentile(walls, 90),
+            percentile(walls, 95), percentile(walls, 99), walls[-1])
+        rpcs = ["%16.1f" % (float(sum(counts.get(c, 0) for _, _, counts in runs)) / len(runs))
+                for c in categories]
+        out.write(line + ''.join(" " + r for r in rpcs) + '\n')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--transfusions', type=int, default=10000)
+    parser.add_argument('--patients', type=int, default=None,
+                        help="default: a fifth of the transfusions")
+    parser.add_argument('--requests', type=int, default=50,
+                        help="requests per endpoint")
+    parser.add_argument('--batch', type=int, default=500, help="entities per write")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--only', default=None,
+                        help="comma separated scenarios, one of: %s" % ', '.join(Scenarios.ALL))
+    parser.add_argument('--compare-page', action='store_true',
+                        help="also time the read path of ?max=50 before and after the "
+                             "tasklet pipeline")
+    args = parser.parse_args(argv)
+
+    from ..app import app
+    tb = setup_testbed()
+    try:
+        started = time.time()
+        patient_keys, transfusion_keys = generate(args.transfusions, args.patients,
+                                                  batch=args.batch, seed=args.seed)
+        sys.stdout.write("generated %d patients and %d transfusions in %.1fs\n" % (
+            len(patient_keys), len(transfusion_keys), time.time() - started))
+
+        names = args.only.split(',') if args.only else Scenarios.ALL
+        scenarios = Scenarios(patient_keys, transfusion_keys, seed=args.seed)
+        with app.test_request_context():
+            results = drive(app.test_client(), scenarios, args.requests, names)
+            if args.compare_page:
+                results.update(compare_page(args.requests))
+        report(results)
+    finally:
+        tb.deactivate()
+
+if __name__ == "__main__":
+    main()
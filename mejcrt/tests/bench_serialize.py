@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 18/10/2026
+
+Micro-benchmark of the serialization of list pages: Model.to_dict_multi (the
+compiled plan) against the generic to_dict + _parse_data walk, and compact
+JSON against the indented and sorted JSON of jsonify in debug mode.
+
+Run it with (see tests.txt for the PYTHONPATH):
+
+    python -m mejcrt.tests.bench_serialize [rows]
+
+@author: Iuri Diniz <iuridiniz@gmail.com>
+'''
+
+import json
+import sys
+import timeit
+
+from ..models import Model, Transfusion
+from .bench_load import generate, setup_testbed
+
+def legacy_to_dict_multi(objs):
+    "Model.to_dict_multi before the compiled plan, kept as reference"
+    raws = [o._to_raw_dict() for o in objs]
+    resolved = Model._resolve_keys(raws)
+    return [Model._parse_data(raw, resolved, frozenset([o.key]))
+            for o, raw in zip(objs, raws)]
+
+def legacy_dumps(data):
+    "jsonify in debug mode (Flask 0.10 defaults)"
+    return json.dumps(data, indent=2, sort_keys=True)
+
+def compact_dumps(data):
+    return json.dumps(data, separators=(',', ':'))
+
+def check(objs):
+    "the plan must serialize like the generic walk"
+    new = Model.to_dict_multi(objs)
+    assert new == legacy_to_dict_multi(objs)
+    assert [o.to_dict() for o in objs] == new
+    assert json.loads(compact_dumps(new)) == json.loads(legacy_dumps(new))
+
+def best(fn, number=5):
+    return min(timeit.Timer(fn).repeat(repeat=3, number=number)) / number
+
+def run(rows=500):
+    tb = setup_testbed()
+    try:
+        generate(rows, max(1, rows / 5), batch=500)
+        objs = Transfusion.query().fetch(rows)
+        check(objs)
+        data = Model.to_dict_multi(objs)
+
+        print "%-12s %14s %14s %8s" % ('step', 'legacy (us)', 'new (us)', 'speedup')
+        for step, legacy, new in (
+                ('to_dict', lambda: legacy_to_dict_multi(objs),
+                 lambda: Model.to_dict_multi(objs)),
+                ('json', lambda: legacy_dumps(data), lambda: compact_dumps(data))):
+            legacy_row = best(legacy) / len(objs) * 1e6
+            new_row = best(new) / len(objs) * 1e6
+            print "%-12s %14.1f %14.1f %7.1fx" % (step, legacy_row, new_row,
+                                                  legacy_row / new_row)
+        print "%-12s %14d %14d %7.1fx" % ('bytes/row', len(legacy_dumps(data)) / len(objs),
+                                          len(compact_dumps(data)) / len(objs),
+                                          float(len(legacy_dumps(data))) / len(compact_dumps(data)))
+    finally:
+        tb.deactivate()
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+'''
+Created on 18/10/2026
+
+Micro-benchmark of util.tokenize against the old powerset tokenizer.
+
+Run it with (see tests.txt for the PYTHONPATH):
+
+    python -m mejcrt.tests.bench_tokenize [names per size]
+
+@author: Iuri Diniz <iuridiniz@gmail.com>
+'''
+
+from itertools import chain, combinations
+import random
+import sys
+import timeit
+
+from .. import search
+from ..util import tokenize
+
+FIRST_NAMES = (u'Maria', u'Jos\xe9', u'Ana', u'Jo\xe3o', u'Ant\xf4nio', u'Francisca',
+               u'Carlos', u'Paulo', u'Adriana', u'Lucas', u'Juliana', u'Let\xedcia',
+               u'Gabriel', u'Vit\xf3ria', u'Heyder', u'Concei\xe7\xe3o', u'Gra\xe7as')
+SURNAMES = (u'Silva', u'Santos', u'Oliveira', u'Souza', u'Rodrigues', u'Ferreira',
+            u'Alves', u'Pereira', u'Lima', u'Gomes', u'Ribeiro', u'Carvalho',
+            u'Medeiros', u'Galv\xe3o', u'Albuquerque', u'Nascimento', u'Ara\xfajo')
+PARTICLES = (u'de', u'da', u'do', u'das', u'dos')
+
+def legacy_tokenize(phrase, minimum=None, maximum=None, onlystart=True, combine=True):
+    "util.tokenize before the bounded rewrite, kept as reference"
+    GOOD_NUMBER = 4
+    if minimum is not None and maximum is None:
+        maximum = minimum + GOOD_NUMBER
+    elif maximum is not None and minimum is None:
+        minimum = maximum - GOOD_NUMBER
+    elif maximum is None and minimum is None:
+        minimum = GOOD_NUMBER
+        maximum = minimum + GOOD_NUMBER
+
+    if minimum < 1:
+        minimum = 1
+    if maximum < 1:
+        maximum = 1
+
+    def powerset(iterable):
+        xs = list(iterable)
+        return chain.from_iterable(combinations(xs, n) for n in range(len(xs) + 1))
+
+    tokens = set()
+    words = str(phrase).split()
+    if not combine:
+        for word in words:
+            if word >= minimum:
+                tokens.add(word)
+    else:
+        for combination in [" ".join(s) for s in powerset(words)]:
+            if len(combination) >= minimum:
+                tokens.add(combination)
+
+    for n, w in enumerate(words):
+        remain = ' '.join(words[n:])
+        length = len(remain)
+        for i in xrange(1 if onlystart else len(w)):
+            first = i + minimum
+            last = maximum + i
+            if last > length:
+                last = length
+            if first > length:
+                first = length
+            for j in xrange(first, last + 1):
+                token = remain[i:j].strip()
+                if len(token) >= minimum:
+                    tokens.add(token)
+
+    return tokens
+
+def random_name(rnd, words):
+    "a brazilian-like name with words words (first names, particles and surnames)"
+    name = [rnd.choice(FIRST_NAMES)]
+    while len(name) < words:
+        if len(name) < words - 1 and rnd.random() < 0.3:
+            name.append(rnd.choice(PARTICLES))
+        else:
+            name.append(rnd.choice(SURNAMES + FIRST_NAMES))
+    return search.normalize(u' '.join(name[:words]))
+
+def corpus(sizes=range(2, 13), per_size=20, seed=42):
+    rnd = random.Random(seed)
+    return dict((size, [random_name(rnd, size) for _ in xrange(per_size)])
+                for size in sizes)
+
+def check(names):
+    "the token sets used by the search features must match the old ones"
+    for name in names:
+        words = name.split()
+        old = legacy_tokenize(name, minimum=4, maximum=16)
+        new = tokenize(name, minimum=4, maximum=16)
+        assert new <= old, name
+        # prefixes of the phrase at each word and whole words (search)
+        prefixes = legacy_tokenize(name, minimum=4, maximum=16, combine=False)
+        assert prefixes - set(words) <= new, name
+        assert set(w for w in words if len(w) >= 4) <= new, name
+        if len(words) <= 3:
+            assert new == old, name
+
+def run(per_size=20):
+    names = corpus(per_size=per_size)
+    print "%5s %12s %12s %8s %10s %10s" % ('words', 'legacy (ms)', 'new (ms)',
+                                           'speedup', 'legacy #', 'new #')
+    for size in sorted(names):
+        check(names[size])
+        legacy = timeit.Timer(lambda: [legacy_tokenize(n, minimum=4, maximum=16)
+                                       for n in names[size]]).timeit(number=3) / 3
+        new = timeit.Timer(lambda: [tokenize(n, minimum=4, maximum=16)
+                                    for n in names[size]]).timeit(number=3) / 3
+        legacy_count = sum(len(legacy_tokenize(n, minimum=4, maximum=16))
+                           for n in names[size]) / len(names[size])
+        new_count = sum(len(tokenize(n, minimum=4, maximum=16))
+                        for n in names[size]) / len(names[size])
+        print "%5d %12.3f %12.3f %7.1fx %10d %10d" % (size, legacy * 1000, new * 1000,
+                                                      legacy / new, legacy_count,
+                                                      new_count)
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
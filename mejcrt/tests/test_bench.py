@@ -0,0 +1,40 @@
+from .bench_load import Scenarios, compare_page, drive, generate, percentile, \
+    pipelined_page, serial_page
+from .test_controllers import TestBase
+
+
+class TestBenchLoad(TestBase):
+    def testPercentile(self):
+        values = range(1, 11)
+        self.assertEquals(percentile(values, 50), 5)
+        self.assertEquals(percentile(values, 90), 9)
+        self.assertEquals(percentile(values, 100), 10)
+        self.assertEquals(percentile([], 50), 0.0)
+
+    def testGenerateAndDrive(self):
+        from .. import models
+        self.fixtureCreateSomeData()
+        before = models.Transfusion.count()
+        patient_keys, transfusion_keys = generate(30, 7)
+        self.assertEquals(len(patient_keys), 7)
+        self.assertEquals(len(transfusion_keys), 30)
+        self.assertEquals(models.Transfusion.count(), before + 30)
+
+        self.login(is_admin=True)
+        results = drive(self.client, Scenarios(patient_keys, transfusion_keys), requests=2)
+        self.assertEquals(list(results), list(Scenarios.ALL))
+        for name, runs in results.items():
+            self.assertEquals(len(runs), 2)
+            for wall, status, counts in runs:
+                self.assertEquals(status, 200, name)
+                self.assertGreater(sum(counts.values()), 0, name)
+
+    def testComparePage(self):
+        self.fixtureCreateSomeData()
+        self.assertEquals(serial_page(), pipelined_page())
+        results = compare_page(requests=3)
+        self.assertEquals(list(results), ['page50 serial', 'page50 pipelined'])
+        for name, runs in results.items():
+            self.assertEquals(len(runs), 3)
+            for _, _, counts in runs:
+                self.assertGreater(counts.get('datastore.query', 0), 0, name)
@@ -28,11 +28,16 @@ class TestBase(TestCase):
         # Next, declare which service stubs you want to use.
         self.testbed.init_datastore_v3_stub(consistency_policy=policy)
         self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
         # Clear ndb's in-context cache between tests.
         # This prevents data from leaking between tests.
         # Alternatively, you could disable caching by
         # using ndb.get_context().set_cache_policy(False)
         ndb.get_context().clear_cache()
+        # every entity is written with its search keys
+        from ..models import SearchBackfill, Patient, Transfusion, UserPrefs
+        SearchBackfill.mark([Patient._get_kind(), Transfusion._get_kind(),
+                             UserPrefs._get_kind()])
 
     @classmethod
     def fixtureCreateSomeData(cls):
@@ -51,6 +56,32 @@ class TestBase(TestCase):
             user_is_admin='1' if is_admin else '0',
             overwrite=True)
 
+    def history(self, endpoint, key):
+        "actions of the history of key"
+        rv = self.client.get(url_for(endpoint, key=key))
+        self.assert200(rv)
+        return [event['action'] for event in rv.json['data']]
+
+    def run_tasks(self):
+        "run the queued tasks, and those they queue, return how many ran"
+        taskqueue = self.testbed.get_stub('taskqueue')
+        ran = 0
+        while True:
+            tasks = taskqueue.get_filtered_tasks()
+            if not tasks:
+                return ran
+            taskqueue.FlushQueue('default')
+            for task in tasks:
+                rv = self.client.post(task.url, data=task.payload,
+                                      content_type='application/x-www-form-urlencoded',
+                                      headers={'X-AppEngine-QueueName': 'default'})
+                self.assert200(rv)
+                ran += 1
+
+    def pop_last_modified(self, got_data):
+        self.assertIsNotNone(got_data.pop('last_modified_at'))
+        return got_data.pop('last_modified_by')
+
     def tearDown(self):
         self.testbed.deactivate()
 
@@ -147,6 +178,40 @@ class TestPatient(TestBase):
         self.assertEquals(len(data), 1)
         self.assertEquals(p.key.urlsafe(), data[0]['key'])
 
+    def testGetListQueryNameWords(self):
+        from ..models import Patient
+        self.login()
+        p = Patient.query().filter(Patient.search_keys == 'name:heyder').get()
+        self.assertIsNotNone(p)
+
+        # non consecutive words, accents, a phrase with an incomplete word
+        for q in (u'john medeiros', u'Galv\xe3o oliv', u'john hey', u'medeiros galvao'):
+            rv = self.client.get(url_for('patient.get', q=q, fields='name'))
+            self.assert200(rv)
+            keys = [o['key'] for o in rv.json['data']]
+            self.assertIn(p.key.urlsafe(), keys, "%r was not found by %r" % (p.name, q))
+
+        rv = self.client.get(url_for('patient.get', q='john zzzz', fields='name'))
+        self.assert200(rv)
+        self.assertEquals(len(rv.json['data']), 0)
+
+    def testGetListQueryNameOrCode(self):
+        from ..models import Patient
+        self.login()
+        p = Patient.query().get()
+        for q in (p.code, p.name.split()[0]):
+            rv = self.client.get(url_for('patient.get', q=q, fields='name,code'))
+            self.assert200(rv)
+            keys = [o['key'] for o in rv.json['data']]
+            self.assertIn(p.key.urlsafe(), keys)
+            # a single query supports cursors
+            self.assertIn('cursor', rv.json['next'])
+        # the words of a text match the same field
+        q = '%s %s' % (p.name.split()[0], p.code)
+        rv = self.client.get(url_for('patient.get', q=q, fields='name,code'))
+        self.assert200(rv)
+        self.assertNotIn(p.key.urlsafe(), [o['key'] for o in rv.json['data']])
+
     def testGetListMax(self):
         self.login()
         from ..models import Patient
@@ -157,6 +222,87 @@ class TestPatient(TestBase):
         data = rv.json['data']
         self.assertEquals(len(data), query['max'])
 
+    def testGetListSelect(self):
+        self.login()
+        from ..models import Patient
+        rv = self.client.get(url_for('patient.get', select='name,code', max=3))
+        self.assert200(rv)
+        data = rv.json['data']
+        self.assertEquals(len(data), 3)
+        for d in data:
+            self.assertEquals(set(d), set(['key', 'name', 'code']))
+            p = Patient.get_by_id(d['code'])
+            self.assertEquals((d['key'], d['name']), (p.key.urlsafe(), p.name))
+        self.assertIn('select=', rv.json['next'])
+        rv = self.client.get(rv.json['next'])
+        self.assert200(rv)
+        self.assertEquals(set(rv.json['data'][0]), set(['key', 'name', 'code']))
+
+    def testGetListSelectInvalid(self):
+        self.login()
+        rv = self.client.get(url_for('patient.get', select='name,search_keys'))
+        self.assert400(rv)
+
+    def testTimeline(self):
+        self.login()
+        from ..models import Transfusion
+        patient = Transfusion.query().get().patient
+        expected = sorted(Transfusion.query(Transfusion.patient == patient),
+                          key=lambda tr: (tr.date, tr.key))
+
+        got = []
+        url = url_for('patient.timeline', key=patient.urlsafe(), max=2)
+        while url:
+            rv = self.client.get(url)
+            self.assert200(rv)
+            self.assertLessEqual(len(rv.json['data']), 2)
+            got.extend(rv.json['data'])
+            url = rv.json['next']
+        self.assertEquals([d['key'] for d in got], [tr.key.urlsafe() for tr in expected])
+        self.assertEquals(got[0], expected[0].to_dict())
+
+    def testTimelineCacheInvalidation(self):
+        self.login(is_admin=True)
+        from ..models import Transfusion
+        from google.appengine.api import memcache
+        tr = Transfusion.query().get()
+        url = url_for('patient.timeline', key=tr.patient.urlsafe())
+        # the writes of the fixture have settled
+        memcache.flush_all()
+        rv = self.client.get(url)
+        self.assert200(rv)
+        etag = rv.headers['ETag']
+        rv = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEquals(rv.status_code, 304)
+
+        data = tr.to_dict()
+        data['text'] = u'changed'
+        rv = self.client.put(url_for('transfusion.upinsert'), data=json.dumps(data),
+                             content_type='application/json')
+        self.assert200(rv)
+        rv = self.client.get(url, headers={'If-None-Match': etag})
+        self.assert200(rv)
+        self.assertIn(u'changed', [d['text'] for d in rv.json['data']])
+        # the query may not see the change yet, the page is not kept
+        self.assertNotIn('ETag', rv.headers)
+
+        memcache.flush_all()
+        rv = self.client.get(url)
+        self.assert200(rv)
+        etag = rv.headers['ETag']
+        rv = self.client.delete(url_for('transfusion.delete', key=tr.key.urlsafe()))
+        self.assert200(rv)
+        rv = self.client.get(url, headers={'If-None-Match': etag})
+        self.assert200(rv)
+        self.assertNotIn(tr.key.urlsafe(), [d['key'] for d in rv.json['data']])
+
+    def testTimelineNotFound(self):
+        self.login()
+        from ..models import Transfusion
+        rv = self.client.get(url_for('patient.timeline',
+                                     key=Transfusion.query().get(keys_only=True).urlsafe()))
+        self.assert404(rv)
+
     def testGetListOffset(self):
         self.login()
         from ..models import Patient
@@ -168,6 +314,19 @@ class TestPatient(TestBase):
         data = rv.json['data']
         self.assertEquals(len(data), 2)
 
+    def testGetListOffsetNextIsCursor(self):
+        self.login()
+        from ..models import Patient
+        codes = [p.code for p in Patient.query().order(Patient.key)]
+        rv = self.client.get(url_for('patient.get', offset=2, max=2))
+        self.assert200(rv)
+        self.assertEquals([o['code'] for o in rv.json['data']], codes[2:4])
+        # the next page starts from a cursor, not from a larger offset
+        self.assertIn('cursor=', rv.json['next'])
+        rv = self.client.get(rv.json['next'])
+        self.assert200(rv)
+        self.assertEquals([o['code'] for o in rv.json['data']], codes[4:6])
+
     def testGetListPaginatorNext(self):
         self.login()
         from ..models import Patient
@@ -211,6 +370,40 @@ class TestPatient(TestBase):
             got_codes = sorted(self._interatePaginatorPrev(count, n, count))
             self.assertEquals(got_codes, expected_codes)
 
+    def testGetListCountStrategies(self):
+        self.login()
+        from ..models import Patient
+        n = Patient.query().count()
+        for strategy in ('exact', 'approx'):
+            rv = self.client.get(url_for('patient.get', count=strategy))
+            self.assert200(rv)
+            self.assertEquals(rv.json['count'], n)
+            self.assertTrue(rv.json['count_exact'])
+            self.assertIn('count=%s' % strategy, rv.json['next'])
+
+        rv = self.client.get(url_for('patient.get', count='none'))
+        self.assert200(rv)
+        self.assertIsNone(rv.json['count'])
+        self.assertFalse(rv.json['count_exact'])
+
+        rv = self.client.get(url_for('patient.get', count='invalid'))
+        self.assert400(rv)
+
+    def testGetListCountInvalidatedOnWrite(self):
+        self.login()
+        from ..models import Patient
+        n = Patient.query().count()
+        rv = self.client.get(url_for('patient.get', count='exact'))
+        self.assertEquals(rv.json['count'], n)
+
+        rv = self.client.post(url_for('patient.upinsert'),
+                              data=json.dumps(self.patient_data),
+                              content_type='application/json')
+        self.assert200(rv)
+
+        rv = self.client.get(url_for('patient.get', count='exact'))
+        self.assertEquals(rv.json['count'], n + 1)
+
     def testDeleteNotAdmin(self):
         self.login()
         from ..models import Patient
@@ -222,8 +415,13 @@ class TestPatient(TestBase):
         self.login(is_admin=True)
         from ..models import Patient
         p = Patient.query().get()
+        n = Patient.count()
         rv = self.client.delete(url_for('patient.delete', key=p.key.urlsafe()))
         self.assert200(rv)
+        self.assertEquals(Patient.count(), n - 1)
+        # a racing delete of the same patient is not counted twice
+        p.delete()
+        self.assertEquals(Patient.count(), n - 1)
 
     def testStats(self):
         self.login()
@@ -251,9 +449,8 @@ class TestPatient(TestBase):
         got_data = rv.json['data'][0]
         self.assert200(rv)
         data['key'] = key
-        self.assertEquals(len(got_data['logs']), 1)
-        self.assertEquals(got_data['logs'][0]['action'], 'create')
-        del got_data['logs']
+        self.assertEquals(self.history('patient.history', key), ['create'])
+        self.assertTrue(self.pop_last_modified(got_data)['admin'])
         self.assertEquals(data, got_data)
 
         # update
@@ -270,21 +467,47 @@ class TestPatient(TestBase):
         got_data = rv.json['data'][0]
         self.assert200(rv)
         data['key'] = key
-        self.assertEquals(len(got_data['logs']), 2)
-        self.assertEquals(got_data['logs'][0]['action'], 'create')
-        self.assertEquals(got_data['logs'][1]['action'], 'update')
-        del got_data['logs']
+        self.assertEquals(self.history('patient.history', key), ['create', 'update'])
+        self.pop_last_modified(got_data)
         self.assertEquals(data, got_data)
 
         # key = got_data['key']
         # delete
         rv = self.client.delete(url_for('patient.delete', key=key))
         self.assert200(rv)
+        self.assertEquals(self.history('patient.history', key),
+                          ['create', 'update', 'delete'])
 
         # get not found
         rv = self.client.get(url_for('patient.get', key=key))
         self.assert404(rv)
 
+    def testImportJsonLines(self):
+        self.login(is_admin=True)
+        from ..models import Patient
+        n = Patient.count()
+        records = [dict(self.patient_data, code='9001'),
+                   dict(self.patient_data, code='9002'),
+                   dict(self.patient_data, code='9001'),
+                   dict(self.patient_data, code='9003', blood_type='X+')]
+        body = '\n'.join(json.dumps(r) for r in records)
+        rv = self.client.post(url_for('patient.import'), data=body,
+                              content_type='application/x-ndjson')
+        self.assert200(rv)
+        data = rv.json['data']
+        self.assertEquals(data['created'], 2)
+        self.assertEquals([r['code'] for r in data['results']],
+                          ['OK', 'OK', 'Bad Request', 'Bad Request'])
+        self.assertIsInstance(Patient.get_by_code('9002'), Patient)
+        self.assertIsNone(Patient.get_by_code('9003'))
+        self.assertEquals(Patient.count(), n + 2)
+
+    def testImportNotAdmin(self):
+        self.login()
+        rv = self.client.post(url_for('patient.import'), data=json.dumps([self.patient_data]),
+                              content_type='application/json')
+        self.assert403(rv)
+
     def testGetPatientTypes(self):
         self.login()
         rv = self.client.get(url_for('patient.types'))
@@ -293,6 +516,94 @@ class TestPatient(TestBase):
         from .. import models
         self.assertListEqual(rv.json['data']['types'], list(models.patient_types))
 
+    def testGetConditional(self):
+        from .. import models
+        self.login(is_admin=True)
+        p = models.Patient.query().get()
+        url = url_for('patient.get', key=p.key.urlsafe())
+        rv = self.client.get(url)
+        self.assert200(rv)
+        etag = rv.headers['ETag']
+
+        rv = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertStatus(rv, 304)
+        self.assertEquals(rv.headers['ETag'], etag)
+
+        data = p.to_dict()
+        data['name'] = u'Outro Nome'
+        rv = self.client.put(url_for('patient.upinsert'), data=json.dumps(data),
+                             content_type='application/json')
+        self.assert200(rv)
+        rv = self.client.get(url, headers={'If-None-Match': etag})
+        self.assert200(rv)
+        self.assertNotEquals(rv.headers['ETag'], etag)
+        self.assertEquals(rv.json['data'][0]['name'], u'Outro Nome')
+
+    def testGetEntityCache(self):
+        from .. import models
+        self.login(is_admin=True)
+        p = models.Patient.query().get()
+        url = url_for('patient.get', key=p.key.urlsafe())
+
+        def stats():
+            rv = self.client.get(url_for('admin.cache.stats'))
+            self.assert200(rv)
+            return rv.json['data']['entity']['Patient']
+
+        before = stats()
+        first = self.client.get(url).json['data']
+        second = self.client.get(url).json['data']
+        self.assertEquals(first, second)
+        after = stats()
+        self.assertEquals(after['misses'] - before['misses'], 1)
+        self.assertEquals(after['hits'] - before['hits'], 1)
+
+        # a write changes the version, the cached payload is not used anymore
+        data = dict(first[0], name=u'Outro Nome')
+        rv = self.client.put(url_for('patient.upinsert'), data=json.dumps(data),
+                             content_type='application/json')
+        self.assert200(rv)
+        self.assertEquals(self.client.get(url).json['data'][0]['name'], u'Outro Nome')
+
+        rv = self.client.delete(url_for('patient.delete', key=p.key.urlsafe()))
+        self.assert200(rv)
+        self.assert404(self.client.get(url))
+        # a reader that got the patient before the delete does not cache it again
+        from ..cache import remember_entity_version, entity_etag
+        remember_entity_version(p.key, p.object_version)
+        self.assertIsNone(entity_etag(p.key))
+        self.assert404(self.client.get(url))
+
+    def testGetListConditional(self):
+        self.login(is_admin=True)
+        from google.appengine.api import memcache
+        url = url_for('patient.get', q='john', fields='name')
+        # the writes of the fixture have settled
+        memcache.flush_all()
+        rv = self.client.get(url)
+        self.assert200(rv)
+        etag = rv.headers['ETag']
+        rv = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertStatus(rv, 304)
+        # other page, other ETag
+        rv = self.client.get(url_for('patient.get', max=1), headers={'If-None-Match': etag})
+        self.assert200(rv)
+
+        rv = self.client.post(url_for('patient.upinsert'), data=json.dumps(self.patient_data),
+                              content_type='application/json')
+        self.assert200(rv)
+        rv = self.client.get(url, headers={'If-None-Match': etag})
+        self.assert200(rv)
+        # the query may not see the write yet, the list is not tagged
+        self.assertNotIn('ETag', rv.headers)
+
+    def testGetPatientTypesCacheControl(self):
+        self.login()
+        rv = self.client.get(url_for('patient.types'))
+        self.assert200(rv)
+        self.assertIn('max-age', rv.headers['Cache-Control'])
+        self.assertIn('private', rv.headers['Cache-Control'])
+
 class TestTransfusion(TestBase):
     tr_data = {u'bags': [{u'content': u'CHPLI', u'type': u'O-'}],
                 u'date': u'2015-05-22',
@@ -319,6 +630,73 @@ class TestTransfusion(TestBase):
         data = rv.json['data']
         self.assertEquals(c, data['stats']['all'])
 
+    def testBatchGet(self):
+        self.login(is_admin=True)
+        from ..models import Patient, Transfusion
+        trs = Transfusion.query().fetch(5)
+        missing = Transfusion(id='1').key.urlsafe()
+        other_kind = Patient.query().get(keys_only=True).urlsafe()
+        keys = [trs[3].key.urlsafe(), missing, trs[0].key.urlsafe(), 'garbage',
+                other_kind, trs[3].key.urlsafe()]
+
+        def stats():
+            rv = self.client.get(url_for('admin.cache.stats'))
+            return rv.json['data']['entity']['Transfusion']
+
+        for hits in (0, 2):
+            before = stats()
+            rv = self.client.post(url_for('transfusion.batch.get'),
+                                  data=json.dumps(dict(keys=keys)),
+                                  content_type='application/json')
+            self.assert200(rv)
+            data = rv.json['data']
+            self.assertEquals((data['found'], data['missing']), (3, 3))
+            self.assertEquals([r['key'] for r in data['results']], keys)
+            self.assertEquals([r['code'] for r in data['results']],
+                              ['OK', 'Not Found', 'OK', 'Bad Request', 'Bad Request', 'OK'])
+            self.assertEquals(data['results'][0]['data'], trs[3].to_dict())
+            self.assertEquals(data['results'][2]['data'], trs[0].to_dict())
+            after = stats()
+            self.assertEquals(after['hits'] - before['hits'], hits)
+
+    def testBatchGetTooMany(self):
+        self.login()
+        from .. import controllers
+        keys = ['x'] * (controllers.patient.MAX_BATCH_GET + 1)
+        rv = self.client.post(url_for('transfusion.batch.get'),
+                              data=json.dumps(dict(keys=keys)),
+                              content_type='application/json')
+        self.assert400(rv)
+        rv = self.client.post(url_for('transfusion.batch.get'), data='[]',
+                              content_type='application/json')
+        self.assert400(rv)
+
+    def testStatsTagsAfterUpdateAndCacheFlush(self):
+        self.login(is_admin=True)
+        from google.appengine.api import memcache
+        from ..models import Transfusion
+
+        rv = self.client.post(url_for('transfusion.upinsert'), data=json.dumps(self.data),
+                          content_type='application/json')
+        self.assert200(rv)
+        self.data['key'] = rv.json['data']['key']
+        self.data['tags'] = ['semrt']
+        rv = self.client.put(url_for('transfusion.upinsert'), data=json.dumps(self.data),
+                          content_type='application/json')
+        self.assert200(rv)
+        rv = self.client.delete(url_for('transfusion.delete', key=Transfusion.query().get(keys_only=True).urlsafe()))
+        self.assert200(rv)
+
+        # counters are durable, they must not depend on memcache
+        memcache.flush_all()
+
+        rv = self.client.get(url_for('transfusion.stats', tags='rt,semrt,naovisitado'))
+        self.assert200(rv)
+        stats = rv.json['data']['stats']
+        self.assertEquals(stats['all'], Transfusion.query().count())
+        for tag in ('rt', 'semrt', 'naovisitado'):
+            self.assertEquals(stats[tag], Transfusion.query(Transfusion.tags == tag).count())
+
     def testDeleteNotAdmin(self):
         self.login()
         from ..models import Transfusion
@@ -339,6 +717,277 @@ class TestTransfusion(TestBase):
                           content_type='application/json')
         self.assert200(rv)
 
+    def testImport(self):
+        self.login(is_admin=True)
+        from .. import models
+        n = models.Transfusion.count()
+        records = [dict(self.data, code='30001'),
+                   dict(self.data, code='30002', patient=None,
+                        record=models.Patient.query().get().code),
+                   dict(self.data, code='30001'),
+                   dict(self.data, code='30003', local='Nowhere'),
+                   dict(self.data, code='30004', patient=dict(key=models.Patient(id='1').key.urlsafe())),
+                   dict(self.data, code='30005', date=None),
+                   'not a record']
+        rv = self.client.post(url_for('transfusion.import'), data=json.dumps(records),
+                              content_type='application/json')
+        self.assert200(rv)
+        data = rv.json['data']
+        self.assertEquals([r['code'] for r in data['results']],
+                          ['OK', 'OK'] + ['Bad Request'] * 5)
+        self.assertEquals((data['created'], data['failed']), (2, 5))
+        self.assertEquals(models.Transfusion.count(), n + 2)
+        self.assertEquals(models.Transfusion.count('rt'),
+                          models.Transfusion.query(models.Transfusion.tags == 'rt').count())
+
+    def testImportFullBatchOfVariedRecords(self):
+        self.login(is_admin=True)
+        import random
+        from ..controllers.patient import IMPORT_BATCH
+        from .. import models
+        rnd = random.Random(7)
+        n = models.Transfusion.count()
+        bags = sum(len(tr.bags) for tr in models.Transfusion.query())
+        # every record on other counters and rollup buckets
+        records = [dict(self.data, code=str(40000 + i),
+                        date='20%02d-%02d-01' % (10 + i % 6, 1 + i % 12),
+                        local=rnd.choice(models.valid_locals),
+                        tags=[rnd.choice(models.transfusion_tags)],
+                        bags=[dict(type=rnd.choice(models.blood_types),
+                                   content=rnd.choice(models.blood_contents))
+                              for _ in range(rnd.randint(1, 3))])
+                   for i in range(IMPORT_BATCH)]
+        rv = self.client.post(url_for('transfusion.import'), data=json.dumps(records),
+                              content_type='application/json')
+        self.assert200(rv)
+        self.assertEquals(rv.json['data']['created'], IMPORT_BATCH)
+        self.assertEquals(models.Transfusion.count(), n + IMPORT_BATCH)
+        for tag in models.transfusion_tags:
+            self.assertEquals(models.Transfusion.count(tag),
+                              models.Transfusion.query(models.Transfusion.tags == tag).count())
+        rv = self.client.get(url_for('transfusion.analytics', group='month'))
+        self.assert200(rv)
+        self.assertEquals(rv.json['total'], bags + sum(len(r['bags']) for r in records))
+
+    def testTooManyAggregates(self):
+        self.login(is_admin=True)
+        from itertools import product
+        from .. import models
+        n = models.Transfusion.count()
+        # every bag on its own rollup bucket
+        bags = [dict(type=t, content=c) for t, c in
+                product(models.blood_types, models.blood_contents)][:20]
+        data = dict(self.data, code=u'20901', bags=bags)
+        rv = self.client.post(url_for('transfusion.upinsert'), data=json.dumps(data),
+                              content_type='application/json')
+        self.assert400(rv)
+        self.assertIn('entity groups', rv.json['error'])
+
+        rv = self.client.post(url_for('transfusion.import'),
+                              data=json.dumps([data, self.data]),
+                              content_type='application/json')
+        self.assert200(rv)
+        self.assertEquals(rv.json['data']['created'], 1)
+        self.assertEquals(models.Transfusion.count(), n + 1)
+
+    def testPutNewMultiExisting(self):
+        from .. import models
+        n = models.Transfusion.count()
+        old = models.Transfusion.query().get()
+        patient = models.Patient.query().get()
+        trs = [models.Transfusion(id=code, patient=patient.key, date=old.date,
+                                  local=old.local, bags=old.bags, tags=['rt'])
+               for code in (old.code, '30001', '30002')]
+        ret = models.Transfusion.put_new_multi(trs)
+        self.assertIsInstance(ret[0], models.BadValueError)
+        self.assertEquals(ret[1:], [tr.key for tr in trs[1:]])
+        # the existing transfusion was neither overwritten nor counted
+        self.assertEquals(ret[0].message, "Code %r is duplicated" % old.code)
+        self.assertEquals(models.Transfusion.get_by_code(old.code).tags, old.tags)
+        self.assertEquals(models.Transfusion.count(), n + 2)
+        self.assertEquals(models.Transfusion.count('rt'),
+                          models.Transfusion.query(models.Transfusion.tags == 'rt').count())
+
+    def testImportInvalidBody(self):
+        self.login(is_admin=True)
+        rv = self.client.post(url_for('transfusion.import'), data='[{',
+                              content_type='application/json')
+        self.assert400(rv)
+
+    def testExportCsv(self):
+        self.login(is_admin=True)
+        import csv
+        from ..models import Transfusion
+        rv = self.client.get(url_for('transfusion.export', format='csv'))
+        self.assert200(rv)
+        self.assertIn('attachment', rv.headers['Content-Disposition'])
+        rows = list(csv.reader(rv.data.splitlines()))
+        self.assertEquals(rows[0][:2], ['code', 'date'])
+        self.assertEquals(len(rows) - 1, Transfusion.query().count())
+        dates = [row[1] for row in rows[1:]]
+        self.assertEquals(dates, sorted(dates))
+
+    def testExportJsonLinesFilters(self):
+        self.login(is_admin=True)
+        from ..models import Transfusion
+        trs = Transfusion.query().order(Transfusion.date).fetch()
+        start, end = trs[len(trs) / 4].date, trs[len(trs) * 3 / 4].date
+        rv = self.client.get(url_for('transfusion.export', format='jsonl', tags='rt',
+                                     start=str(start), end=str(end)))
+        self.assert200(rv)
+        records = [json.loads(line) for line in rv.data.splitlines()]
+        expected = [tr for tr in trs if start <= tr.date <= end and 'rt' in tr.tags]
+        self.assertEquals(sorted(r['code'] for r in records),
+                          sorted(tr.code for tr in expected))
+        for r in records:
+            self.assertIn('rt', r['tags'])
+            self.assertIsNotNone(r['patient']['name'])
+
+    def testExportParts(self):
+        self.login(is_admin=True)
+        import csv
+        import re
+        from ..controllers import transfusion
+        from ..models import Transfusion
+        expected = [tr.code for tr in Transfusion.query().order(Transfusion.date, Transfusion.key)]
+        transfusion.EXPORT_MAX, old = 3, transfusion.EXPORT_MAX
+        try:
+            url, codes, parts = url_for('transfusion.export', format='csv'), [], 0
+            while url:
+                rv = self.client.get(url)
+                self.assert200(rv)
+                codes.extend(row[0] for row in csv.reader(rv.data.splitlines()))
+                parts += 1
+                link = re.match('<(.*)>; rel="next"', rv.headers.get('Link', ''))
+                url = link and link.group(1)
+        finally:
+            transfusion.EXPORT_MAX = old
+        # a single header, on the first part
+        self.assertEquals(codes, ['code'] + expected)
+        self.assertGreaterEqual(parts, len(expected) / 3)
+        rv = self.client.get(url_for('transfusion.export', cursor='garbage'))
+        self.assert400(rv)
+
+    def testExportInvalid(self):
+        self.login(is_admin=True)
+        rv = self.client.get(url_for('transfusion.export', format='xml'))
+        self.assert400(rv)
+        rv = self.client.get(url_for('transfusion.export', start='yesterday'))
+        self.assert400(rv)
+        rv = self.client.get(url_for('transfusion.export', tags='nope'))
+        self.assert400(rv)
+        self.login()
+        rv = self.client.get(url_for('transfusion.export'))
+        self.assert403(rv)
+
+    def testBulkTagsByQuery(self):
+        self.login(is_admin=True)
+        from ..models import Transfusion
+        n = Transfusion.count('naovisitado')
+        self.assertGreater(n, 0)
+        body = dict(query=dict(tags=['naovisitado']), add=['rt'], remove=['naovisitado'])
+        rv = self.client.post(url_for('transfusion.bulk.tags'), data=json.dumps(body),
+                              content_type='application/json')
+        self.assert200(rv)
+        self.assertEquals(rv.json['data']['count'], n)
+        self.assertFalse(rv.json['data']['more'])
+
+        for tag in ('naovisitado', 'rt', 'semrt'):
+            self.assertEquals(Transfusion.count(tag),
+                              Transfusion.query(Transfusion.tags == tag).count())
+        self.assertEquals(Transfusion.count('naovisitado'), 0)
+        key = rv.json['data']['keys'][0]
+        self.assertEquals(self.history('transfusion.history', key), ['update'])
+
+    def testBulkDeleteByKeys(self):
+        self.login(is_admin=True)
+        from ..models import Transfusion
+        keys = [k.urlsafe() for k in Transfusion.query().fetch(5, keys_only=True)]
+        rv = self.client.post(url_for('transfusion.bulk.delete'),
+                              data=json.dumps(dict(keys=keys + keys[:1])),
+                              content_type='application/json')
+        self.assert200(rv)
+        self.assertEquals(rv.json['data']['count'], 5)
+        self.assertEquals(Transfusion.count(), Transfusion.query().count())
+        for tag in ('naovisitado', 'rt', 'semrt'):
+            self.assertEquals(Transfusion.count(tag),
+                              Transfusion.query(Transfusion.tags == tag).count())
+
+    def testBulkInvalid(self):
+        self.login(is_admin=True)
+        from ..models import Patient
+        for endpoint, body in (('transfusion.bulk.delete', {}),
+                               ('transfusion.bulk.delete', dict(keys=['nokey'])),
+                               ('transfusion.bulk.delete',
+                                dict(keys=[Patient.query().get(keys_only=True).urlsafe()])),
+                               ('transfusion.bulk.delete', dict(query=dict(tags=['nope']))),
+                               ('transfusion.bulk.tags', dict(query={}, add=['nope'])),
+                               ('transfusion.bulk.tags', dict(query={}, add=[['rt']])),
+                               ('transfusion.bulk.tags', dict(query={}, remove=[{}])),
+                               ('transfusion.bulk.tags', ['rt'])):
+            rv = self.client.post(url_for(endpoint), data=json.dumps(body),
+                                  content_type='application/json')
+            self.assert400(rv)
+        self.login()
+        rv = self.client.post(url_for('transfusion.bulk.delete'), data=json.dumps(dict(keys=[])),
+                              content_type='application/json')
+        self.assert403(rv)
+
+    def testAnalytics(self):
+        self.login()
+        from collections import Counter
+        from ..models import Transfusion
+        trs = Transfusion.query().fetch()
+        expected = Counter()
+        for tr in trs:
+            for bag in tr.bags:
+                expected[(tr.date.strftime('%Y-%m'), bag.type_)] += 1
+
+        rv = self.client.get(url_for('transfusion.analytics', group='month,blood_type'))
+        self.assert200(rv)
+        got = dict(((d['month'], d['blood_type']), d['count']) for d in rv.json['data'])
+        self.assertEquals(got, dict(expected))
+        self.assertEquals(rv.json['total'], sum(len(tr.bags) for tr in trs))
+
+        month = trs[0].date.strftime('%Y-%m')
+        rv = self.client.get(url_for('transfusion.analytics', group='local',
+                                     start=month, end=month, local=trs[0].local))
+        self.assert200(rv)
+        self.assertEquals(rv.json['total'],
+                          sum(len(tr.bags) for tr in trs
+                              if tr.date.strftime('%Y-%m') == month and tr.local == trs[0].local))
+
+    def testAnalyticsAfterUpdateAndDelete(self):
+        self.login(is_admin=True)
+        rv = self.client.post(url_for('transfusion.upinsert'), data=json.dumps(self.data),
+                              content_type='application/json')
+        self.assert200(rv)
+        self.data['key'] = rv.json['data']['key']
+        query = dict(group='content', start='2015-05', end='2015-05')
+
+        def totals():
+            rv = self.client.get(url_for('transfusion.analytics', **query))
+            self.assert200(rv)
+            return dict((d['content'], d['count']) for d in rv.json['data'])
+
+        before = totals()
+        self.data['bags'] = [{u'content': u'CRIO', u'type': u'O-'}]
+        rv = self.client.put(url_for('transfusion.upinsert'), data=json.dumps(self.data),
+                             content_type='application/json')
+        self.assert200(rv)
+        after = totals()
+        self.assertEquals(after.get('CHPLI', 0), before.get('CHPLI', 0) - 1)
+        self.assertEquals(after.get('CRIO', 0), before.get('CRIO', 0) + 1)
+
+        rv = self.client.delete(url_for('transfusion.delete', key=self.data['key']))
+        self.assert200(rv)
+        self.assertEquals(totals().get('CRIO', 0), before.get('CRIO', 0))
+
+    def testAnalyticsInvalid(self):
+        self.login()
+        self.assert400(self.client.get(url_for('transfusion.analytics', group='patient')))
+        self.assert400(self.client.get(url_for('transfusion.analytics', start='2015')))
+
     def testCreateInvalidDate(self):
         self.login()
         data = self.data.copy()
@@ -434,6 +1083,45 @@ class TestTransfusion(TestBase):
         data = rv.json['data']
         self.assertEquals([k.urlsafe() for k in p.transfusions], [tr['key'] for tr in data])
 
+    def testGetListQueryFieldPatientNameAfterRename(self):
+        from .. import models
+        self.login(is_admin=True)
+        p = models.Patient.query().get()
+        expected = [k.urlsafe() for k in p.transfusions]
+
+        data = p.to_dict()
+        data['name'] = u'Zacarias Renomeado'
+        del data['last_modified_by'], data['last_modified_at']
+        rv = self.client.put(url_for('patient.upinsert'), data=json.dumps(data),
+                             content_type='application/json')
+        self.assert200(rv)
+
+        # the transfusions are synced by tasks, one batch each
+        from ..controllers import admin
+        batch, deadline = models.Patient.SYNC_BATCH, admin.TASK_DEADLINE
+        models.Patient.SYNC_BATCH, admin.TASK_DEADLINE = 1, 0
+        try:
+            self.assertGreaterEqual(self.run_tasks(), len(expected))
+        finally:
+            models.Patient.SYNC_BATCH, admin.TASK_DEADLINE = batch, deadline
+
+        rv = self.client.get(url_for('transfusion.get', q='zacarias reno',
+                                     fields='patient.name'))
+        self.assert200(rv)
+        self.assertEquals(expected, [tr['key'] for tr in rv.json['data']])
+
+        # an update that keeps the name queues nothing
+        rv = self.client.put(url_for('patient.upinsert'), data=json.dumps(data),
+                             content_type='application/json')
+        self.assert200(rv)
+        self.assertEquals(self.run_tasks(), 0)
+
+    def testGetListQueryFieldPatientIsOneQuery(self):
+        from .. import models
+        query = models.Transfusion.build_query(patient_name='john heyder')
+        self.assertNotIn('IN', repr(query.filters))
+        self.assertIsInstance(query.filters, ndb.AND)
+
     def testGetListQueryFieldPatientNameDoesNotExist(self):
         self.login()
         query = dict(fields='patient.name,code,patient.code', max='10', offset=0, q='NonExistentKKKK')
@@ -490,6 +1178,26 @@ class TestTransfusion(TestBase):
         data = rv.json['data']
         self.assertEquals(len(data), query['max'])
 
+    def testGetListSelect(self):
+        self.login()
+        from ..models import Transfusion
+        # code and date are projected, text is trimmed from whole entities
+        for select, fields in (('code,date', ['code', 'date']),
+                               ('code,text,tags', ['code', 'text', 'tags'])):
+            rv = self.client.get(url_for('transfusion.get', select=select, tags='rt'))
+            self.assert200(rv)
+            data = rv.json['data']
+            self.assertEquals([d['key'] for d in data],
+                              [k.urlsafe() for k in
+                               Transfusion.query(Transfusion.tags == 'rt').order(Transfusion.key)
+                               .fetch(20, keys_only=True)])
+            for d in data:
+                self.assertEquals(set(d), set(['key'] + fields))
+                tr = Transfusion.get_by_id(d['code'])
+                self.assertEquals(d['code'], tr.code)
+                if 'date' in d:
+                    self.assertEquals(d['date'], str(tr.date))
+
     def testGetListOffset(self):
         self.login()
         from ..models import Transfusion
@@ -520,6 +1228,36 @@ class TestTransfusion(TestBase):
         expected_keys = [k.urlsafe() for k in Transfusion.query().fetch(keys_only=True, limit=10)]
         self.assertEquals(keys, expected_keys)
 
+    def testGetListCursorNextPrev(self):
+        self.login()
+        from ..models import Transfusion
+        pages = []
+        url = url_for('transfusion.get', **{'max': 3})
+        for _ in range(4):
+            rv = self.client.get(url)
+            self.assert200(rv)
+            self.assertIn('cursor=', rv.json['next'])
+            pages.append(([o['key'] for o in rv.json['data']], rv.json['offset']))
+            url = rv.json['next']
+
+        expected_keys = [k.urlsafe() for k in Transfusion.query().fetch(keys_only=True, limit=12)]
+        self.assertEquals(sum([keys for keys, _ in pages], []), expected_keys)
+        self.assertEquals([offset for _, offset in pages], [0, 3, 6, 9])
+
+        # walk back using prev links
+        url = rv.json['prev']
+        for keys, offset in reversed(pages[:-1]):
+            rv = self.client.get(url)
+            self.assert200(rv)
+            self.assertEquals([o['key'] for o in rv.json['data']], keys)
+            self.assertEquals(rv.json['offset'], offset)
+            url = rv.json['prev']
+
+    def testGetListCursorInvalid(self):
+        self.login()
+        rv = self.client.get(url_for('transfusion.get', cursor='invalid'))
+        self.assert400(rv)
+
     def testGetNotLogged(self):
         rv = self.client.get(url_for('transfusion.get', key=123))
         self.assert401(rv)
@@ -540,9 +1278,8 @@ class TestTransfusion(TestBase):
         self.assert200(rv)
 
         got_data = rv.json['data'][0]
-        self.assertEquals(len(got_data['logs']), 1)
-        self.assertEquals(got_data['logs'][0]['action'], 'create')
-        del got_data['logs']
+        self.assertEquals(self.history('transfusion.history', data['key']), ['create'])
+        self.pop_last_modified(got_data)
 
         self.assertEquals(got_data['patient']['key'], data['patient']['key'])
         del got_data['patient']
@@ -561,10 +1298,9 @@ class TestTransfusion(TestBase):
         self.assert200(rv)
 
         got_data = rv.json['data'][0]
-        self.assertEquals(len(got_data['logs']), 2)
-        self.assertEquals(got_data['logs'][0]['action'], 'create')
-        self.assertEquals(got_data['logs'][1]['action'], 'update')
-        del got_data['logs']
+        self.assertEquals(self.history('transfusion.history', data['key']),
+                          ['create', 'update'])
+        self.pop_last_modified(got_data)
 
         self.assertEquals(got_data['patient']['key'], data['patient']['key'])
         del got_data['patient']
@@ -622,6 +1358,32 @@ class TestUser(TestBase):
         data = rv.json['data']
         self.assertEquals(data['user'], u.to_dict())
 
+    def testGetDoesNotWriteUser(self):
+        self.fixtureCreateSomeData()
+
+        from .. import models
+        u = models.UserPrefs.query(models.UserPrefs.admin == False).get()
+        self.login(email=u.email, id_=u.userid)
+
+        for _ in range(2):
+            rv = self.client.get(url_for('user.get', who='me'))
+            self.assert200(rv)
+        ndb.get_context().clear_cache()
+        self.assertEquals(u.key.get().updated_at, u.updated_at)
+
+    def testGetMeNewUser(self):
+        self.fixtureCreateSomeData()
+        self.login(email="new@new.com", id_="1234")
+
+        rv = self.client.get(url_for('user.get', who='me'))
+        # new users are created, but they are not authorized
+        self.assert403(rv)
+
+        from .. import models
+        u = models.UserPrefs.get_by_userid("1234")
+        self.assertIsNotNone(u)
+        self.assertFalse(u.authorized)
+
     def testGetMeNotLogged(self):
         self.fixtureCreateSomeData()
 
@@ -684,6 +1446,93 @@ class TestUser(TestBase):
                           content_type='application/json')
         self.assert200(rv)
 
+    def testAuthorizationCached(self):
+        self.fixtureCreateSomeData()
+
+        from .. import models
+        u = models.UserPrefs.query(models.UserPrefs.admin == False).get()
+        self.login(email=u.email, id_=u.userid)
+        rv = self.client.get(url_for('transfusion.stats'))
+        self.assert200(rv)
+
+        calls = []
+        get_current = models.UserPrefs.__dict__['get_current']
+        models.UserPrefs.get_current = classmethod(
+            lambda cls: calls.append(1) or get_current.__get__(None, cls)())
+        try:
+            for _ in range(3):
+                rv = self.client.get(url_for('transfusion.stats'))
+                self.assert200(rv)
+        finally:
+            models.UserPrefs.get_current = get_current
+        self.assertEquals(calls, [])
+
+    def testAuthorizationInvalidatedByUpdate(self):
+        self.fixtureCreateSomeData()
+
+        from .. import models
+        admin = models.UserPrefs.query(models.UserPrefs.admin == True).get()
+        u = models.UserPrefs.query(models.UserPrefs.admin == False).get()
+        self.login(email=u.email, id_=u.userid)
+        self.assert200(self.client.get(url_for('transfusion.stats')))
+
+        user_data = {'id': u.userid, 'authorized': False, 'email': u.email, 'name': u.name}
+        self.login(email=admin.email, id_=admin.userid, is_admin=True)
+        rv = self.client.put(url_for('user.update'), data=json.dumps(user_data),
+                             content_type='application/json')
+        self.assert200(rv)
+
+        # the rejection is cached as well, until the next update
+        self.login(email=u.email, id_=u.userid)
+        for _ in range(2):
+            self.assert403(self.client.get(url_for('transfusion.stats')))
+
+        user_data['authorized'] = True
+        self.login(email=admin.email, id_=admin.userid, is_admin=True)
+        rv = self.client.put(url_for('user.update'), data=json.dumps(user_data),
+                             content_type='application/json')
+        self.assert200(rv)
+        self.login(email=u.email, id_=u.userid)
+        self.assert200(self.client.get(url_for('transfusion.stats')))
+
+    def testAuthorizationRevokedWithStaleCurrent(self):
+        self.fixtureCreateSomeData()
+
+        from .. import models
+        u = models.UserPrefs.query(models.UserPrefs.admin == False).get()
+        self.login(email=u.email, id_=u.userid)
+        self.assert200(self.client.get(url_for('transfusion.stats')))
+
+        stale = models.UserPrefs(id=u.userid, name=u.name, email=u.email,
+                                 admin=False, authorized=True)
+        u.authorized = False
+        u.put()
+        # a request racing with the revocation caches the copy it read before
+        models.UserPrefs._cache.set(models.UserPrefs.CACHE_KEY % u.userid, stale, time=60)
+        for _ in range(2):
+            self.assert403(self.client.get(url_for('transfusion.stats')))
+
+    def testUpdateUserRevokedAdminWithStaleCurrent(self):
+        self.fixtureCreateSomeData()
+
+        from .. import models
+        admin = models.UserPrefs.query(models.UserPrefs.admin == True).get()
+        u = models.UserPrefs.query(models.UserPrefs.admin == False).get()
+        stale = models.UserPrefs(id=admin.userid, name=admin.name, email=admin.email,
+                                 admin=True, authorized=True)
+        admin.admin = False
+        admin.put()
+        # a request racing with the revocation caches the copy it read before
+        models.UserPrefs._cache.set(models.UserPrefs.CACHE_KEY % admin.userid, stale, time=60)
+        self.login(email=admin.email, id_=admin.userid)
+
+        user_data = {'id': u.userid, 'authorized': not u.authorized, 'email': u.email,
+                     'name': u.name}
+        rv = self.client.put(url_for('user.update'), data=json.dumps(user_data),
+                             content_type='application/json')
+        self.assert403(rv)
+        self.assertEquals(models.UserPrefs.get_by_userid(u.userid).authorized, u.authorized)
+
     def testUpdateUserLoggedAsHimself(self):
         self.fixtureCreateSomeData()
 
@@ -0,0 +1,204 @@
+import unittest
+
+from google.appengine.ext import ndb
+
+from .test_controllers import TestBase
+
+
+class TestSerializer(TestBase):
+    def setUp(self):
+        super(TestSerializer, self).setUp()
+        self.fixtureCreateSomeData()
+
+    def testToDictMultiEqualsToDict(self):
+        from .. import models
+        trs = models.Transfusion.query().fetch(10)
+        expected = [tr.to_dict() for tr in trs]
+        self.assertEquals(models.Model.to_dict_multi(trs), expected)
+
+    def testToDictMultiBatchesGets(self):
+        from .. import models
+        trs = models.Transfusion.query().fetch(20)
+        calls = []
+        get_multi_async = ndb.get_multi_async
+
+        def counting_get_multi_async(keys, **kwargs):
+            calls.append(len(keys))
+            return get_multi_async(keys, **kwargs)
+
+        ndb.get_multi_async = counting_get_multi_async
+        try:
+            data = models.Model.to_dict_multi(trs)
+        finally:
+            ndb.get_multi_async = get_multi_async
+
+        self.assertEquals(len(data), len(trs))
+        # only one level of references: the patients
+        self.assertEquals(calls, [len(set(tr.patient for tr in trs))])
+        for tr, d in zip(trs, data):
+            self.assertEquals(d['patient']['key'], tr.patient.urlsafe())
+
+    def testAsyncPipelineEqualsSync(self):
+        from .. import models
+        from ..cache import count_query, count_query_async, COUNT_EXACT
+        trs = models.Transfusion.query().fetch(10)
+        query = models.Transfusion.query(models.Transfusion.tags == 'rt')
+        # start everything before waiting for any result
+        data = models.Model.to_dict_multi_async(trs)
+        total = models.Transfusion.count_async()
+        count = count_query_async(query, COUNT_EXACT)
+        self.assertEquals(data.get_result(), [tr.to_dict() for tr in trs])
+        self.assertEquals(total.get_result(), models.Transfusion.query().count())
+        self.assertEquals(count.get_result(), count_query(query, COUNT_EXACT))
+        self.assertIsNone(models.Transfusion.count_async('nope').get_result())
+
+    def testCircularReference(self):
+        from .. import models
+
+        class Node(models.Model):
+            __dict_include__ = ['key', 'next_']
+            next_ = ndb.KeyProperty()
+
+        a, b = ndb.Key(Node, 'a'), ndb.Key(Node, 'b')
+        ndb.put_multi([Node(key=a, next_=b), Node(key=b, next_=a)])
+
+        d = a.get().to_dict()
+        self.assertEquals(d['next']['key'], b.urlsafe())
+        self.assertEquals(d['next']['next'], {'key': a.urlsafe()})
+
+    def testPlanEqualsGenericWalk(self):
+        from .. import models
+        from .bench_serialize import check
+        check(models.Transfusion.query().fetch(20))
+        check(models.Patient.query().fetch(5))
+        check(models.UserPrefs.query().fetch())
+
+    def testPlanSharesLeafReferences(self):
+        from .. import models
+        patient = models.Transfusion.query().get().patient
+        trs = models.Transfusion.query(models.Transfusion.patient == patient).fetch()
+        data = models.Model.to_dict_multi(trs)
+        self.assertEquals(len(set(id(d['patient']) for d in data)), 1)
+        # repeated values are copies
+        data[0]['tags'].append('x')
+        self.assertNotIn('x', trs[0].tags)
+
+    def testSelectProjection(self):
+        from .. import models
+        Patient, Transfusion = models.Patient, models.Transfusion
+        only = Patient.select_fields(['key', 'name', 'code'])
+        self.assertEquals(only, frozenset(['name', 'code']))
+        self.assertEquals(Patient.select_projection(only, Patient.query()), ('code', 'name'))
+        self.assertEquals(Transfusion.select_projection(Transfusion.select_fields(['code', 'date']),
+                                                        Transfusion.query(Transfusion.tags == 'rt')),
+                          ('code', 'date'))
+        # no composite index for it
+        self.assertIsNone(Patient.select_projection(Patient.select_fields(['name']),
+                                                    Patient.query()))
+        # equality filter on a projected property
+        self.assertIsNone(Patient.select_projection(only, Patient.query(Patient.name == 'x')))
+        # repeated, unindexed or structured properties
+        for names in (['tags'], ['text'], ['bags'], ['local']):
+            self.assertIsNone(Transfusion.select_projection(Transfusion.select_fields(names),
+                                                            Transfusion.query()))
+        self.assertRaises(models.BadValueError, Patient.select_fields, ['search_keys'])
+
+        p = Patient.query().get()
+        d = models.Model.to_dict_multi([p], only=Patient.select_fields(['type']))[0]
+        self.assertEquals(d, dict(key=p.key.urlsafe(), type=p.type_))
+
+    def testCompactJSON(self):
+        from flask.helpers import url_for
+        self.login()
+        rv = self.client.get(url_for('transfusion.stats'))
+        self.assertNotIn(' ', rv.data)
+        self.assertNotIn('\n', rv.data)
+
+class TestSearch(unittest.TestCase):
+    def testIndexTokensAreLinear(self):
+        from .. import search
+        name = ' '.join(['word%02d' % n for n in range(10)])
+        tokens = search.index_tokens(name)
+        # the old powerset tokenizer generated more than 2 ** 10 tokens
+        self.assertLess(len(tokens), 10 * (search.MAXIMUM + 1))
+        for n in range(10):
+            self.assertIn('word%02d' % n, tokens)
+        self.assertIn('word00 word01', tokens)
+        self.assertIn(name, tokens)
+
+    def testQueryTokens(self):
+        from .. import search
+        self.assertEquals(search.query_tokens(u'  Jo\xe3o   SILVA '), ['joao', 'silva'])
+        self.assertEquals(search.query_tokens('john he'), ['john he'])
+        self.assertEquals(search.query_tokens('a' * 20), ['a' * search.MAXIMUM])
+        for query in ('john medeiros', 'john he', 'oliveira de'):
+            tokens = search.index_tokens('john heyder oliveira de medeiros')
+            for token in search.query_tokens(query):
+                self.assertIn(token, tokens)
+
+    def testPlanUsesGroups(self):
+        from .. import models, search
+        prop = models.Patient.search_keys
+        groups = models.Patient.SEARCH_GROUPS
+        node = search.plan(prop, [('name', 'john', False), ('code', 'john', False)], groups)
+        self.assertEquals(node, prop == 'name+code:john')
+        node = search.plan(prop, [('name', 'john', True)], groups)
+        self.assertEquals(node, prop == 'name=john')
+        # different texts can not share the group keys
+        node = search.plan(prop, [('name', 'john', False), ('code', '2440', False)], groups)
+        self.assertIsInstance(node, ndb.OR)
+        # nor the words of a text, one could match the name and other the code
+        node = search.plan(prop, [('name', 'john 2440', False), ('code', 'john 2440', False)],
+                           groups)
+        self.assertIsInstance(node, ndb.OR)
+
+    def testIndexKeys(self):
+        from .. import search
+        keys = search.index_keys(dict(name=u'Jo\xe3o Silva', code='24400', other=None),
+                                 [('name', 'code')])
+        for key in ('name:joao', 'name=joao silva', 'code:2440', 'code=24400',
+                    'name+code:silva', 'name+code:2440'):
+            self.assertIn(key, keys)
+        self.assertFalse([k for k in keys if k.startswith('other')])
+
+class TestBatchWrites(TestBase):
+    def setUp(self):
+        super(TestBatchWrites, self).setUp()
+        self.fixtureCreateSomeData()
+
+    def testChunkByGroups(self):
+        from ..models import chunk_by_groups
+        groups = {'a': set([1, 2]), 'b': set([2, 3]), 'c': set([4, 5]), 'd': set(range(9))}
+        chunks = list(chunk_by_groups('abcd', groups.get, limit=4))
+        self.assertEquals(chunks, [['a', 'b'], ['c'], ['d']])
+
+    def testPutNewMultiByChunks(self):
+        from .. import models
+        n = models.Patient.count()
+        patients = [models.Patient(id=str(90000 + i), name=u'Name %d' % i,
+                                   blood_type=models.blood_types[0],
+                                   type_=models.patient_types[0])
+                    for i in range(30)]
+        calls = []
+        transaction_async = ndb.transaction_async
+
+        def counting_transaction_async(*args, **kwargs):
+            calls.append(1)
+            return transaction_async(*args, **kwargs)
+
+        ndb.transaction_async = counting_transaction_async
+        try:
+            created = models.Patient.put_new_multi(patients + patients[:1])
+            again = models.Patient.put_new_multi(patients[:2])
+        finally:
+            ndb.transaction_async = transaction_async
+
+        # the count and the lock are shared: 18 patients by transaction
+        self.assertEquals(len(calls), 2 + 1)
+        self.assertEquals(created[:30], [p.key for p in patients])
+        self.assertIsInstance(created[30], models.BadValueError)
+        self.assertTrue(all(isinstance(r, models.BadValueError) for r in again))
+        self.assertEquals(models.Patient.count(), n + 30)
+
+if __name__ == "__main__":
+    unittest.main()
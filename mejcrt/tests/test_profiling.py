@@ -0,0 +1,90 @@
+import json
+import logging
+
+from flask.helpers import url_for
+from .test_controllers import TestBase
+
+
+class TestProfiling(TestBase):
+    def setUp(self):
+        super(TestProfiling, self).setUp()
+        self.fixtureCreateSomeData()
+
+    def ranking(self):
+        rv = self.client.get(url_for('admin.profile'))
+        self.assert200(rv)
+        return dict((e['endpoint'], e) for e in rv.json['data'])
+
+    def testNotProfiledByDefault(self):
+        self.login(is_admin=True)
+        self.client.get(url_for('transfusion.stats'))
+        self.assertEquals(self.ranking(), {})
+
+    def testProfileRequested(self):
+        self.login(is_admin=True)
+        logged = []
+        info = logging.info
+        logging.info = lambda msg, *args: logged.append(msg)
+        try:
+            rv = self.client.get(url_for('transfusion.stats'),
+                                 headers={'X-Mejcrt-Profile': '1'}, buffered=True)
+        finally:
+            logging.info = info
+        self.assert200(rv)
+        logged, = [json.loads(msg)['profile'] for msg in logged
+                   if msg.startswith('{"profile"')]
+        self.assertEquals(logged['endpoint'], 'GET transfusion.stats')
+
+        rv = self.client.get(url_for('transfusion.stats', _profile=1), buffered=True)
+        self.assert200(rv)
+
+        got = self.ranking()['GET transfusion.stats']
+        self.assertEquals(got['requests'], 2)
+        self.assertGreater(got['rpcs']['memcache']['count'], 0)
+
+    def testProfileStreamed(self):
+        self.login(is_admin=True)
+        rv = self.client.get(url_for('transfusion.export', format='jsonl', _profile=1))
+        # the body is not read yet
+        self.assertEquals(self.ranking(), {})
+        self.assertTrue(rv.data)
+        rv.close()
+
+        got = self.ranking()['GET transfusion.export']
+        self.assertEquals(got['requests'], 1)
+        # the entities are read while the body streams
+        self.assertGreater(got['rpcs']['datastore.get']['count'], 0)
+
+    def testProfileAdminOnly(self):
+        self.login()
+        self.client.get(url_for('transfusion.stats'), headers={'X-Mejcrt-Profile': '1'}, buffered=True)
+        self.login(is_admin=True)
+        self.assertEquals(self.ranking(), {})
+
+    def testProfileAppAdmin(self):
+        from ..models import UserPrefs
+        # an admin of the application that is not an admin of the project
+        admin = UserPrefs.query(UserPrefs.admin == True).get()
+        self.login(email=admin.email, id_=admin.userid)
+        rv = self.client.get(url_for('transfusion.stats', _profile=''), buffered=True)
+        self.assert200(rv)
+        self.assertIn('GET transfusion.stats', self.ranking())
+
+    def testProfileArgumentOnly(self):
+        self.login(is_admin=True)
+        rv = self.client.get(url_for('transfusion.stats', no_profile=1))
+        self.assert200(rv)
+        rv = self.client.get(url_for('transfusion.stats', text='_profile=1'))
+        self.assert200(rv)
+        self.assertEquals(self.ranking(), {})
+
+    def testSampled(self):
+        from .. import profiling
+        self.login()
+        profiling.SAMPLE_RATE = 1.0
+        try:
+            self.client.get(url_for('transfusion.stats'), buffered=True)
+        finally:
+            profiling.SAMPLE_RATE = 0.0
+        self.login(is_admin=True)
+        self.assertIn('GET transfusion.stats', self.ranking())
@@ -0,0 +1,312 @@
+from collections import Counter
+
+from flask.helpers import url_for
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from .test_controllers import TestBase
+
+
+class TestRebuild(TestBase):
+    def setUp(self):
+        super(TestRebuild, self).setUp()
+        self.fixtureCreateSomeData()
+
+    def drift(self):
+        "corrupt the counters and the rollups"
+        from ..models import CounterShard, Patient, Rollup, Transfusion
+        CounterShard.reset(Transfusion._get_counter_name('rt'), 999)
+        CounterShard.reset(Patient.COUNT_KEY, 0)
+        ndb.delete_multi(Rollup.query().fetch(3, keys_only=True))
+        Rollup(id='bogus', month='1999-01', local='x', blood_type='x', content='x',
+               count=7).put()
+        memcache.flush_all()
+
+    def assertAggregates(self):
+        from ..models import Patient, Rollup, Transfusion, transfusion_tags
+        memcache.flush_all()
+        self.assertEquals(Patient.count(), Patient.query().count())
+        for tag in transfusion_tags:
+            self.assertEquals(Transfusion.count(tag),
+                              Transfusion.query(Transfusion.tags == tag).count())
+        self.assertEquals(Transfusion.count(), Transfusion.query().count())
+
+        expected = Counter()
+        for tr in Transfusion.query():
+            for bag in tr.bags:
+                expected[Rollup.bucket(tr.date, tr.local, bag)] += 1
+        got = Counter()
+        for r in Rollup.query():
+            got[tuple(getattr(r, d) for d in Rollup.DIMENSIONS)] += r.count
+        self.assertEquals(dict((bucket, count) for bucket, count in got.items() if count),
+                          dict(expected))
+
+    def testRun(self):
+        from .. import rebuild
+        from ..models import Patient, Transfusion
+        self.drift()
+        report = rebuild.run(shards=3)
+        self.assertTrue(report['done'])
+        self.assertEquals(report['processed'],
+                          Patient.query().count() + Transfusion.query().count())
+        self.assertGreater(report['shards'], 2)
+        self.assertAggregates()
+
+    def testResume(self):
+        from .. import rebuild
+        self.drift()
+        batch = rebuild.BATCH
+        rebuild.BATCH = 3
+        try:
+            job = rebuild.start(shards=2)
+            finished = []
+            calls = 0
+            for key in job.shards:
+                # one batch per call, as if every task hit its deadline
+                calls += 1
+                while not rebuild.process_shard_async(key, deadline=0).get_result().done:
+                    calls += 1
+                finished.append(rebuild.finish(job.key))
+        finally:
+            rebuild.BATCH = batch
+        self.assertGreater(calls, len(job.shards))
+        # only the last shard finishes the job, only once
+        self.assertEquals(finished, [False] * (len(job.shards) - 1) + [True])
+        self.assertFalse(rebuild.finish(job.key))
+        self.assertAggregates()
+
+    def testTaskQueue(self):
+        self.login(is_admin=True)
+        self.drift()
+        rv = self.client.post(url_for('admin.rebuild', shards=2))
+        self.assert200(rv)
+        job = rv.json['data']['job']
+
+        taskqueue = self.testbed.get_stub('taskqueue')
+        tasks = taskqueue.get_filtered_tasks()
+        self.assertEquals(len(tasks), rv.json['data']['shards'])
+
+        rv = self.client.post(tasks[0].url, data=tasks[0].payload,
+                              content_type='application/x-www-form-urlencoded')
+        self.assert403(rv)
+        for task in tasks:
+            rv = self.client.post(task.url, data=task.payload,
+                                  content_type='application/x-www-form-urlencoded',
+                                  headers={'X-AppEngine-QueueName': 'default'})
+            self.assert200(rv)
+
+        rv = self.client.get(url_for('admin.rebuild.get', job=job))
+        self.assert200(rv)
+        self.assertTrue(rv.json['data']['done'])
+        self.assertAggregates()
+
+    def testUnseededCounterIsCounted(self):
+        from .. import rebuild
+        from ..models import CounterSeed, CounterShard, Patient
+        # shards written before any rebuild hold only the later changes
+        ndb.transaction(lambda: CounterShard.incr({Patient.COUNT_KEY: 1}))
+        memcache.flush_all()
+        self.assertIsNone(CounterSeed.get_by_id(Patient.COUNT_KEY))
+        self.assertEquals(Patient.count(), Patient.query().count())
+
+        rebuild.run(shards=2)
+        self.assertIsNotNone(CounterSeed.get_by_id(Patient.COUNT_KEY))
+        self.assertAggregates()
+
+    def testBackfill(self):
+        from .. import rebuild
+        from ..models import Transfusion
+        # a transfusion stored before it had a copy of the patient name
+        tr = Transfusion.query().get()
+        tr.patient_name = None
+        tr.put_async().get_result()
+        name = tr.patient.get().name
+        query = Transfusion.build_query(patient_name=name, exact=True)
+        self.assertNotIn(tr.key, query.fetch(keys_only=True))
+
+        rebuild.run(shards=2)
+        self.assertNotIn(tr.key, query.fetch(keys_only=True))
+        rebuild.run(shards=2, backfill=True)
+        self.assertEquals(tr.key.get(use_cache=False, use_memcache=False).patient_name, name)
+        self.assertIn(tr.key, query.fetch(keys_only=True))
+        self.assertAggregates()
+
+    def testBackfillSearchKeys(self):
+        from google.appengine.api import datastore
+        from .. import rebuild
+        from ..models import Patient, UserPrefs
+        patient, user = Patient.query().get(), UserPrefs.query().get()
+        queries = [Patient.build_query(code=patient.code, exact=True),
+                   UserPrefs.build_query(admin=user.admin, authorized=user.authorized)]
+        # entities stored before they had search keys
+        for key in (patient.key, user.key):
+            entity = datastore.Get(key.to_old_key())
+            del entity['search_keys']
+            datastore.Put(entity)
+        ndb.get_context().clear_cache()
+        memcache.flush_all()
+        for query, key in zip(queries, (patient.key, user.key)):
+            self.assertNotIn(key, query.fetch(keys_only=True))
+
+        rebuild.run(shards=2, backfill=True)
+        for query, key in zip(queries, (patient.key, user.key)):
+            self.assertIn(key, query.fetch(keys_only=True))
+        self.assertAggregates()
+
+    def testBackfillLegacyLogs(self):
+        import datetime
+        from google.appengine.api import datastore
+        from .. import rebuild
+        from ..models import AuditEvent, Patient, UserPrefs
+        patient, user = Patient.query().get(), UserPrefs.query().get()
+        when = datetime.datetime(2015, 5, 22, 10, 0)
+        # a patient stored with the log entries of the version before AuditEvent
+        entity = datastore.Get(patient.key.to_old_key())
+        entity['logs.user'] = [user.key.to_old_key()] * 2
+        entity['logs.when'] = [when, when + datetime.timedelta(days=1)]
+        entity['logs.action'] = ['create', 'update']
+        datastore.Put(entity)
+        ndb.get_context().clear_cache()
+        self.assertNotIn('logs', patient.key.get().to_dict())
+        self.assertNotIn('logs', patient.key.get().to_dict(exclude=['search_keys']))
+
+        rebuild.run(shards=2, backfill=True)
+        rebuild.run(shards=2, backfill=True)
+        events = AuditEvent.build_query(patient.key).fetch()
+        self.assertEquals([(e.action, e.when, e.user) for e in events],
+                          [('create', when, user.key),
+                           ('update', when + datetime.timedelta(days=1), user.key)])
+        entity = datastore.Get(patient.key.to_old_key())
+        self.assertFalse([name for name in entity if name.startswith('logs')])
+
+    def testLegacySearchUntilBackfilled(self):
+        from google.appengine.api import datastore
+        from .. import rebuild
+        from ..models import Patient, SearchBackfill, Transfusion
+        ndb.delete_multi(SearchBackfill.query().fetch(keys_only=True))
+        memcache.flush_all()
+        patient, tr = Patient.query().get(), Transfusion.query().get()
+        # entities stored before they had search keys
+        for key in (patient.key, tr.key):
+            entity = datastore.Get(key.to_old_key())
+            del entity['search_keys']
+            if key == patient.key:
+                entity['code_tags'] = [patient.code]
+            datastore.Put(entity)
+        ndb.get_context().clear_cache()
+        self.assertIn(patient.key, Patient.build_query(code=patient.code).fetch(keys_only=True))
+        self.assertIn(tr.key, Transfusion.build_query(code=tr.code).fetch(keys_only=True))
+        self.assertFalse(SearchBackfill.done(Patient._get_kind()))
+
+        rebuild.run(shards=2, backfill=True)
+        self.assertTrue(SearchBackfill.done(Patient._get_kind()))
+        self.assertTrue(SearchBackfill.done(Transfusion._get_kind()))
+        self.assertIn(patient.key, Patient.build_query(code=patient.code).fetch(keys_only=True))
+        self.assertIn(tr.key, Transfusion.build_query(code=tr.code).fetch(keys_only=True))
+
+    def testWritesWhileRunning(self):
+        from .. import rebuild
+        from ..models import AggregatesLocked, Patient, Transfusion, transfusion_tags
+        self.drift()
+        trs = iter(Transfusion.query().fetch())
+        codes = iter(xrange(77770, 77900))
+        made = []
+
+        def write():
+            "create and delete patients, retag and delete transfusions"
+            patient = Patient.query().get()
+            made.append(Patient(id=str(next(codes)), name=u'During',
+                                blood_type=patient.blood_type, type_=patient.type_))
+            made[-1].put()
+            if len(made) > 2:
+                made.pop(0).delete()
+            tr = next(trs, None)
+            if tr is not None:
+                tag = transfusion_tags[0]
+                if tag in tr.tags:
+                    Transfusion.update_tags_multi([tr.key], remove=[tag])
+                else:
+                    Transfusion.update_tags_multi([tr.key], add=[tag])
+            tr = next(trs, None)
+            if tr is not None:
+                Transfusion.delete_multi([tr.key])
+
+        backfill, batch = rebuild.backfill_async, rebuild.BATCH
+
+        @ndb.tasklet
+        def backfill_async(entities):
+            # between the read of a batch and its save
+            write()
+            yield backfill(entities)
+
+        rebuild.backfill_async, rebuild.BATCH = backfill_async, 2
+        try:
+            job = rebuild.start(shards=2, backfill=True)
+            self.assertRaises(AggregatesLocked, rebuild.start)
+            write()
+            for key in job.shards:
+                while not rebuild.process_shard_async(key, deadline=0).get_result().done:
+                    write()
+            write()
+            self.assertTrue(rebuild.finish(job.key))
+        finally:
+            rebuild.backfill_async, rebuild.BATCH = backfill, batch
+        self.assertAggregates()
+
+    def testLockedWhileReplacing(self):
+        from .. import rebuild
+        from ..models import AggregatesLock, AggregatesLocked, Patient
+        self.login(is_admin=True)
+        job = rebuild.start(shards=2)
+        rv = self.client.post(url_for('admin.rebuild', shards=2))
+        self.assertEquals(rv.status_code, 503)
+        self.assertIn('Retry-After', rv.headers)
+
+        for key in job.shards:
+            rebuild.process_shard_async(key).get_result()
+        AggregatesLock.freeze(job.key.id())
+        patient = Patient.query().get()
+        new = Patient(id='77777', name='Locked', blood_type=patient.blood_type,
+                      type_=patient.type_)
+        self.assertRaises(AggregatesLocked, new.put)
+        rv = self.client.delete(url_for('patient.delete', key=patient.key.urlsafe()))
+        self.assertEquals(rv.status_code, 503)
+        self.assertIn('Retry-After', rv.headers)
+        # a write that does not change the aggregates goes on
+        patient.blood_type = patient.blood_type
+        patient.put(update=True)
+
+        self.assertTrue(rebuild.finish(job.key))
+        new.put()
+        self.assertAggregates()
+
+    def testBackfillWithoutAggregate(self):
+        from .. import rebuild
+        from ..models import AggregatesLock, Patient
+        self.drift()
+        job = rebuild.start(shards=2, backfill=True, aggregate=False)
+        self.assertIsNone(AggregatesLock.get_running())
+        for key in job.shards:
+            rebuild.process_shard_async(key).get_result()
+        self.assertTrue(rebuild.finish(job.key))
+        # the aggregates are left as they were
+        self.assertEquals(Patient.count(), 0)
+        self.assertRaises(ValueError, rebuild.start, backfill=False, aggregate=False)
+
+    def testAbort(self):
+        from .. import rebuild
+        from ..models import Patient
+        self.login(is_admin=True)
+        job = rebuild.start(shards=2)
+        rv = self.client.delete(url_for('admin.rebuild.abort', job=job.key.id()))
+        self.assert200(rv)
+        self.assertTrue(rv.json['data']['aborted'])
+        rv = self.client.delete(url_for('admin.rebuild.abort', job=job.key.id()))
+        self.assert404(rv)
+
+        self.assertIsNone(rebuild.process_shard_async(job.shards[0]).get_result())
+        self.assertFalse(rebuild.finish(job.key))
+        patient = Patient.query().get()
+        Patient(id='77777', name='Unlocked', blood_type=patient.blood_type,
+                type_=patient.type_).put()
+        self.assertAggregates()
@@ -0,0 +1,40 @@
+import types
+import unittest
+
+from mejcrt.util import iter_tokens, tokenize
+
+from .bench_tokenize import corpus, check, legacy_tokenize
+
+
+class TestTokenize(unittest.TestCase):
+    def testSameTokensAsLegacy(self):
+        for names in corpus(per_size=5).values():
+            check(names)
+
+    def testSmallPhrases(self):
+        for phrase in ('john', 'john heyder', 'john heyder oliveira', '24400'):
+            self.assertEquals(tokenize(phrase, minimum=4, maximum=16),
+                              legacy_tokenize(phrase, minimum=4, maximum=16))
+            self.assertEquals(tokenize(phrase, onlystart=False),
+                              legacy_tokenize(phrase, onlystart=False))
+
+    def testStreaming(self):
+        tokens = iter_tokens('john heyder oliveira', minimum=4, maximum=16)
+        self.assertIsInstance(tokens, types.GeneratorType)
+        tokens = list(tokens)
+        self.assertEquals(len(tokens), len(set(tokens)))
+
+    def testCaps(self):
+        phrase = ' '.join(['word%02d' % n for n in range(30)])
+        self.assertEquals(len(tokenize(phrase, minimum=4, maximum=16, max_tokens=100)), 100)
+        tokens = tokenize(phrase, minimum=4, maximum=16, max_tokens=10000, max_combination=2)
+        self.assertNotIn('word00 word01 word02', tokens)
+        self.assertIn('word00 word29', tokens)
+
+    def testNoCombineMinimum(self):
+        # short words are not tokens by themselves, only inside phrases
+        self.assertEquals(tokenize('de oliveira', minimum=4, maximum=4, combine=False),
+                          set(['de o', 'oliv', 'oliveira']))
+
+if __name__ == "__main__":
+    unittest.main()
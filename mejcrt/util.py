@@ -39,13 +39,28 @@ def iconv(input_str):
 def onlynumbers(input_str, *args, **kwargs):
     return ''.join(filter(lambda x: x.isdigit(), str(input_str)))
 
+def bool2str(b):
+    return '1' if b else '0'
+
 def powerset(iterable):
     # from https://docs.python.org/2/library/itertools.html#recipes
     xs = list(iterable)
     # note we return an iterator rather than a list
     return chain.from_iterable(combinations(xs, n) for n in range(len(xs) + 1))
 
-def tokenize(phrase, minimum=None, maximum=None, onlystart=True, combine=True):
+# caps of the tokenizer, the number of combinations grows exponentially
+MAX_TOKENS = 512
+MAX_COMBINATION = 3
+
+def iter_tokens(phrase, minimum=None, maximum=None, onlystart=True, combine=True,
+                max_tokens=MAX_TOKENS, max_combination=MAX_COMBINATION):
+    """Generate the distinct tokens of phrase, at most max_tokens of them.
+
+    Tokens are the substrings of minimum..maximum chars that start at each
+    word (or anywhere inside a word if not onlystart), plus the words
+    themselves or, if combine, the ordered combinations of up to
+    max_combination words.
+    """
     GOOD_NUMBER = 4
     if minimum is not None and maximum is None:
         # only minimum defined
@@ -63,31 +78,39 @@ def tokenize(phrase, minimum=None, maximum=None, onlystart=True, combine=True):
     if maximum < 1:
         maximum = 1
 
-    tokens = set()
+    seen = set()
     words = str(phrase).split()
-    # add each word and word combination
-    if not combine:
-        for word in words:
-            if word >= minimum:
-                tokens.add(word)
-    else:
-        for combination in [" ".join(s) for s in  powerset(words)]:
-            if len(combination) >= minimum:
-                tokens.add(combination)
+    text = ' '.join(words)
 
-    for n, w in enumerate(words):
-        remain = ' '.join(words[n:])
-        length = len(remain)
+    # substrings starting at each word, only a window of maximum chars is
+    # sliced instead of the whole remaining phrase
+    start = 0
+    for w in words:
         for i in xrange(1 if onlystart else len(w)):
-            first = i + minimum
-            last = maximum + i
-            if last > length:
-                last = length
-            if first > length:
-                first = length
-            for j in xrange(first, last + 1):
-                token = remain[i:j].strip()
-                if len(token) >= minimum:
-                    tokens.add(token)
+            window = text[start + i:start + i + maximum]
+            for j in xrange(minimum, len(window) + 1):
+                token = window[:j].strip()
+                if len(token) >= minimum and token not in seen:
+                    seen.add(token)
+                    yield token
+                    if len(seen) >= max_tokens:
+                        return
+        start += len(w) + 1
+
+    # words and word combinations
+    sizes = xrange(1, (max_combination if combine else 1) + 1)
+    for n in sizes:
+        for combination in combinations(words, n):
+            token = " ".join(combination)
+            if len(token) >= minimum and token not in seen:
+                seen.add(token)
+                yield token
+                if len(seen) >= max_tokens:
+                    return
 
-    return tokens
+def tokenize(phrase, minimum=None, maximum=None, onlystart=True, combine=True,
+             max_tokens=MAX_TOKENS, max_combination=MAX_COMBINATION):
+    return set(iter_tokens(phrase, minimum=minimum, maximum=maximum,
+                           onlystart=onlystart, combine=combine,
+                           max_tokens=max_tokens,
+                           max_combination=max_combination))
@@ -36,7 +36,9 @@
                 if (data.offset > 0) {
                     ctrl.prev_link = data.prev;
                 }
-                if (data.offset + transfusions.length < data.count) {
+                // an approximate count is only a lower bound
+                if (data.offset + transfusions.length < data.count ||
+                        (!data.count_exact && transfusions.length == data.max)) {
                     ctrl.next_link = data.next;
                 }
                 ctrl.offset = data.offset;